@@ -1,26 +1,315 @@
-from machine import Pin, ADC, PWM, reset
+from machine import Pin, ADC, PWM, Timer, reset, unique_id
 import network
-import socket
+import micropython
 import _thread
 from wlan import SSID, PASSWORD
-from time import sleep
+try:
+    import uasyncio as asyncio # Asynchronous I/O on the device
+except ImportError:
+    import asyncio
+try:
+    from umqtt.simple import MQTTClient # MQTT client of micropython-lib, only needed for the MQTT mode
+except ImportError:
+    MQTTClient = None
+from binascii import hexlify
+from time import sleep, ticks_ms, ticks_us, ticks_diff, time
+import gc
+from random import getrandbits
+from array import array
+import struct
+import socket
+import json
+import os
+
+
+class BlindsState:
+    """
+    Authoritative state of the blinds. Every change goes through it and increases the version,
+    so the JSON reply is only formatted again after a change.
+    """
+    __slots__ = ("position", "follow", "version", "cached", "cached_etag", "cached_version")
+
+    def __init__(self):
+        self.position = 0 # Position of the blinds (0 to 100)
+        self.follow = 0 # 1 while the blinds follow the potentiometer
+        self.version = 0 # Increased on every change
+        self.cached = b"" # JSON reply of the state
+        self.cached_etag = b"" # ETag of the state
+        self.cached_version = -1 # Version the JSON reply was formatted for
+
+    def set_position(self, position):
+        """
+        Record a new position of the blinds.
+
+        Args:
+            position (int): The position of the blinds (0 to 100).
+        """
+        if position != self.position:
+            self.position = position
+            self.version += 1
+
+    def set_follow(self, follow):
+        """
+        Record whether the blinds follow the potentiometer.
+
+        Args:
+            follow (int): 1 to follow the potentiometer, 0 to stop following it.
+        """
+        if follow != self.follow:
+            self.follow = follow
+            self.version += 1
+
+    def json(self):
+        """
+        Get the JSON reply with the blinds position, formatted again only after a change.
+
+        Returns:
+            bytes: The JSON-formatted blinds position (0 to 100) and follow mode (1 or 0).
+        """
+        if self.cached_version != self.version:
+            self.cached = ('{"percentage": ' + str(self.position) + ', "follow": ' + str(self.follow) + '}').encode()
+            self.cached_etag = ('"' + BOOT_ID + '-' + str(self.version) + '"').encode()
+            self.cached_version = self.version
+        return self.cached
+
+    def etag(self):
+        """
+        Get the entity tag of the state, sent in the ETag header of the status replies.
+
+        Returns:
+            bytes: The quoted tag, made of the boot identifier and the version.
+        """
+        self.json() # The tag is formatted along with the JSON after a change
+        return self.cached_etag
+
+
+class Potentiometer:
+    """
+    Filtered reading of the potentiometer. Every sample averages several ADC readings, a median
+    of the last samples drops the spikes and an exponential moving average smooths the rest, so
+    the blinds land at the same spot for the same position of the knob.
+    """
+    __slots__ = ("adc", "samples", "index", "average")
+
+    def __init__(self, adc, window):
+        """
+        Args:
+            adc (ADC): The ADC the potentiometer is connected to.
+            window (int): Number of samples the median is taken from.
+        """
+        self.adc = adc
+        self.samples = array("H", [adc.read_u16()] * window)
+        self.index = 0
+        self.average = self.samples[0] << KNOB_SMOOTHING # Moving average, scaled to keep its fraction
+
+    def sample(self):
+        """
+        Take a new oversampled reading and update the filter.
+        """
+        total = 0
+        for _ in range(KNOB_OVERSAMPLING):
+            total += self.adc.read_u16()
+        self.samples[self.index] = total // KNOB_OVERSAMPLING
+        self.index = (self.index + 1) % len(self.samples)
+
+        median = sorted(self.samples)[len(self.samples) // 2]
+        self.average += median - (self.average >> KNOB_SMOOTHING)
+
+    def read(self):
+        """
+        Returns:
+            int: The filtered reading (0 to 65535).
+        """
+        return self.average >> KNOB_SMOOTHING
+
+
+def braking_distance(speed):
+    """
+    Compute the distance the servo covers while it slows down to a stop.
+
+    Args:
+        speed (int): The current change of the duty cycle per step.
+
+    Returns:
+        int: The change of the duty cycle until the servo stops.
+    """
+    steps = speed // STEP_ACCEL
+    return steps * speed - STEP_ACCEL * steps * (steps + 1) // 2
+
+
+def motion_step(duty, velocity, target):
+    """
+    Compute the next step of a trapezoidal motion profile: the servo speeds up with a
+    limited acceleration, cruises at a limited speed and slows down to stop at the target.
+
+    Args:
+        duty (int): The current duty cycle of the servo.
+        velocity (int): The current change of the duty cycle per step (negative when closing).
+        target (int): The duty cycle to move to.
+
+    Returns:
+        tuple: (duty, velocity) after the step.
+    """
+    error = target - duty
+    if error >= 0:
+        direction = 1
+    else:
+        direction = -1
+    distance = error * direction
+    speed = velocity * direction # Speed towards the target, negative when moving away from it
+
+    # Take the fastest speed (speeding up, keeping it or slowing down) that still lets
+    # the servo brake before the target
+    fastest = speed - STEP_ACCEL
+    for candidate in (min(speed + STEP_ACCEL, STEP_SPEED), speed):
+        if candidate <= 0 or candidate + braking_distance(candidate) <= distance:
+            fastest = candidate
+            break
+    speed = fastest
+
+    # Stop at the target when it is reached in this step, or closer than the smallest step
+    if speed >= distance or (speed >= 0 and distance < STEP_ACCEL):
+        return target, 0
+    return duty + speed * direction, speed * direction
+
+
+class MotionPlanner:
+    """
+    Moves the servo to its target duty cycle along a trapezoidal profile, one step on every tick
+    of a hardware timer, so requests never wait for the blinds and the servo never draws the
+    current spike of a sudden jump. The target can be changed at any time, even during a move.
+    """
+    __slots__ = ("duty", "velocity", "target", "timer")
+
+    def __init__(self, duty):
+        """
+        Args:
+            duty (int): The duty cycle the servo starts at.
+        """
+        self.duty = duty
+        self.velocity = 0 # Change of the duty cycle per step
+        self.target = duty
+        self.timer = Timer(period=MOTION_PERIOD_MS, mode=Timer.PERIODIC, callback=self.tick)
+
+    def move_to(self, target):
+        """
+        Set the duty cycle to move the servo to, starting from where it is now.
+
+        Args:
+            target (int): The duty cycle to move to.
+        """
+        self.target = target
+
+    def moving(self):
+        """
+        Returns:
+            bool: Whether the servo has not reached its target yet.
+        """
+        return self.duty != self.target or self.velocity != 0
+
+    def tick(self, timer):
+        """
+        Timer callback that moves the servo one step towards its target.
+
+        Args:
+            timer (Timer): The timer calling back.
+        """
+        if self.duty != self.target or self.velocity != 0:
+            self.duty, self.velocity = motion_step(self.duty, self.velocity, self.target)
+            servo.duty_u16(self.duty)
+
+    def eta_ms(self):
+        """
+        Estimate the time until the servo reaches its target.
+
+        Returns:
+            int: The remaining time in ms (0 if the servo is stopped at the target).
+        """
+        duty = self.duty
+        velocity = self.velocity
+        target = self.target
+        steps = 0
+        while duty != target or velocity != 0:
+            duty, velocity = motion_step(duty, velocity, target)
+            steps += 1
+        return steps * MOTION_PERIOD_MS
 
 
 def set_position_blinds(percent):
     """
     Set the position of the blinds based on the given percentage.
+    The servo moves there in the background.
+
+    Args:
+        percent (int): The percentage to set the blinds to (0 to 100).
+    """
+    planner.move_to(duty_table[percent]) # Move the servo to the calibrated duty cycle
+    state.set_position(percent) # Update the state of the blinds
+
+
+def load_calibration():
+    """
+    Load the calibration points stored in the flash, on top of the default ones.
+
+    Returns:
+        dict: The duty cycle of the servo for every calibrated percentage.
+    """
+    points = dict(DEFAULT_CALIBRATION)
+    try:
+        with open(CALIBRATION_FILE) as file:
+            for percent, duty in json.load(file):
+                points[percent] = duty
+    except (OSError, ValueError):
+        pass # Nothing stored yet, the defaults are used
+    return points
+
+
+def save_calibration(points):
+    """
+    Store the calibration points in the flash, so they are kept across restarts.
 
     Args:
-        percent (float): The percentage to set the blinds to (0 to 1.0).
+        points (dict): The duty cycle of the servo for every calibrated percentage.
     """
-    global percentage
-    max = 7700 # Maximum duty cycle for the servo (fully open)
-    min = 1400 # Minimum duty cycle for the servo (fully closed)
+    with open(CALIBRATION_FILE, "w") as file:
+        json.dump(sorted(points.items()), file)
+
 
-    # Calculate the duty cycle based on the percentage
-    duty = ((max - min) * percent) + min
-    servo.duty_u16(int(duty)) # Set the duty cycle for the servo
-    percentage = percent # Update the global percentage variable
+def build_duty_table(points):
+    """
+    Build the duty cycle of every percentage, interpolating between the calibration points.
+
+    Args:
+        points (dict): The duty cycle of the servo for every calibrated percentage.
+
+    Returns:
+        array: The duty cycle of the servo for every percentage from 0 to 100.
+    """
+    table = array("H", [0] * 101)
+    percentages = sorted(points)
+    for index in range(len(percentages) - 1):
+        start = percentages[index]
+        end = percentages[index + 1]
+        for percent in range(start, end + 1):
+            table[percent] = points[start] + (points[end] - points[start]) * (percent - start) // (end - start)
+    return table
+
+
+def duty_to_percentage(duty):
+    """
+    Find the percentage of a duty cycle of the servo in the calibrated table.
+
+    Args:
+        duty (int): The duty cycle of the servo.
+
+    Returns:
+        int: The percentage with the closest duty cycle (0 to 100).
+    """
+    closest = 0
+    for percent in range(101):
+        if abs(duty_table[percent] - duty) < abs(duty_table[closest] - duty):
+            closest = percent
+    return closest
 
 
 # Initialize PWM for the servo motor connected to Pin 16
@@ -28,9 +317,105 @@ servo = PWM(Pin(16))
 servo.freq(50) # Set PWM frequency to 50Hz for controlling the servo
 servo.duty_u16(0)# Start with blinds closed (duty cycle = 0)
 
+# Servo calibration, the duty cycle of the servo for some percentages of the blinds
+DEFAULT_CALIBRATION = {0: 1400, 100: 7700} # Fully closed and fully open
+CALIBRATION_FILE = "calibration.json" # File in the flash keeping the calibration points
+calibration = load_calibration()
+duty_table = build_duty_table(calibration) # Duty cycle of every percentage (0 to 100)
+
+# Servo motion configuration
+MOTION_PERIOD_MS = 20 # Time in ms between two steps of the servo (one period of the PWM)
+MAX_SPEED = 5000 # Maximum speed of the servo in duty cycle units per second
+ACCELERATION = 10000 # Acceleration and deceleration of the servo in duty cycle units per second squared
+STEP_SPEED = MAX_SPEED * MOTION_PERIOD_MS // 1000 # Maximum change of the duty cycle in a step
+STEP_ACCEL = ACCELERATION * MOTION_PERIOD_MS * MOTION_PERIOD_MS // 1000000 # Change of the speed in a step
+
+# Motion planner moving the servo, from the closed position
+planner = MotionPlanner(duty_table[0])
+
+# Potentiometer configuration
+KNOB_INTERVAL_MS = 20 # Time in ms between two samples of the potentiometer
+KNOB_OVERSAMPLING = 8 # ADC readings averaged in every sample
+KNOB_WINDOW = 5 # Samples the median filter is taken from
+KNOB_SMOOTHING = 3 # Weight of a new sample in the moving average (1/2^KNOB_SMOOTHING)
+KNOB_HYSTERESIS = 650 # Change of the reading (about 1%) that moves the blinds in follow mode
+
+# Initialize potentiometer on Analog Pin 26 for the manual control
+potentiometer = Potentiometer(ADC(Pin(26)), KNOB_WINDOW)
+
 # Thread synchronization lock
 spLock = _thread.allocate_lock()
-percentage = 0 # Default blinds position (0%)
+state = BlindsState() # State of the blinds served to the clients, closed by default (0%)
+
+# HTTP server configuration
+PORT = 80 # Port the web server listens on
+BACKLOG = 5 # Maximum number of pending client connections
+READ_TIMEOUT = 5 # Seconds to wait for a client to send its request
+KEEPALIVE_TIMEOUT = 10 # Seconds an idle persistent connection is kept open
+MAX_REQUESTS = 100 # Requests served on a persistent connection before closing it
+MAX_REQUEST_SIZE = 1024 # Maximum size in bytes of a request (head and body)
+MAX_BATCH = 16 # Maximum number of operations in a batch request
+UPDATE_INTERVAL_MS = 50 # Minimum time in ms between two positions applied, newer ones replace the pending one
+
+# Binary control protocol over UDP, for the updates sent continuously (such as a slider being dragged)
+UDP_ENABLED = True # Whether the UDP port is served alongside the HTTP API
+UDP_PORT = 5005 # Port the binary control messages are received on
+UDP_MAX_SIZE = 64 # Maximum size in bytes of a message
+UDP_POLL_MS = 5 # Time in ms between two polls of the UDP socket while it is idle
+UDP_MAX_CLIENTS = 8 # Clients whose last sequence number is kept
+# Handler run for every opcode: (method, endpoint, struct layout of the payload, parameters filled with the payload)
+UDP_OPCODES = {
+    1: ("POST", "turn_blinds_percentage", ">B", "percentage=%d"),
+    2: ("POST", "follow_knob", "", "status=on"),
+    3: ("POST", "follow_knob", "", "status=off"),
+    16: ("GET", "check_status", "", ""),
+}
+
+# MQTT configuration, the state is published retained and the commands are received through a broker
+MQTT_ENABLED = False # Whether to connect to the broker (needs the umqtt.simple library)
+MQTT_BROKER = "192.168.1.200" # Address of the MQTT broker
+MQTT_PORT = 1883 # Port of the MQTT broker
+MQTT_TOPIC = b"home/blinds" # Prefix of the topics of this device
+MQTT_CLIENT_ID = b"blinds-" + hexlify(unique_id()) # Unique client identifier
+MQTT_QOS = 1 # Quality of service of the state and the commands (0 or 1)
+MQTT_KEEPALIVE = 60 # Seconds the broker waits for a message before dropping the session
+MQTT_POLL_MS = 50 # Time in ms between two checks of the session
+MQTT_BACKOFF_MIN = 1 # Seconds to wait before reconnecting after the first failure
+MQTT_BACKOFF_MAX = 60 # Maximum seconds to wait before reconnecting, doubled after every failure
+
+# Metrics configuration
+PHASES = ("receive", "parse", "lock", "handler", "send") # Phases of a request timed by the metrics
+PHASE_RECEIVE = 0 # Index of the time waiting for the rest of a request
+PHASE_PARSE = 1 # Index of the time parsing a request
+PHASE_LOCK = 2 # Index of the time waiting for spLock
+PHASE_HANDLER = 3 # Index of the time running the handler
+PHASE_SEND = 4 # Index of the time sending the reply
+METRICS_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000) # Upper bounds of the histograms
+METRICS_MAX_SERIES = 32 # Pairs of endpoint and status code counted apart, the rest are counted as 'other'
+BOOT_TIME = time() # Time of the boot in seconds, for the uptime
+
+# Content types of the replies
+CONTENT_TYPES = ("text/plain", "application/json", "text/event-stream")
+CONTENT_TEXT = 0 # Index of the plain text content type
+CONTENT_JSON = 1 # Index of the JSON content type
+CONTENT_EVENTS = 2 # Index of the Server-Sent Events content type
+
+# Identifier of this boot in the ETag of the state, so tags from before a restart never match
+BOOT_ID = str(getrandbits(24))
+
+# Receive buffers reused across connections
+buffer_pool = [bytearray(MAX_REQUEST_SIZE) for _ in range(BACKLOG)]
+
+# Events configuration
+EVENT_QUEUE_SIZE = 8 # Pending events kept for a slow subscriber, the oldest ones are dropped
+MAX_SUBSCRIBERS = 4 # Maximum number of clients streaming events or long-polling at once
+LONG_POLL_MAX = 60 # Maximum seconds a long-poll request waits for a change
+EVENTS_PING = 15 # Seconds between the comments that keep an idle event stream open
+
+# Button configuration
+DEBOUNCE_MS = 30 # Time in ms the button contacts need to settle
+LONG_PRESS_MS = 1000 # Minimum time in ms the button is held for a long press
+DOUBLE_PRESS_MS = 300 # Maximum time in ms between the two presses of a double press
 
 
 def connect():
@@ -60,79 +445,273 @@ def connect():
     return ip
 
 
-def open_socket(ip):
+def build_header_table(statuses):
     """
-    Open a socket for communication.
+    Pre-encode the headers of the replies for every status code and content type.
 
     Args:
-        ip (str): The IP address of the device.
+        statuses (tuple): Pairs of (status_code, reason) for the status codes used.
+
+    Returns:
+        dict: For each status code, a list indexed by content type with the encoded
+              headers up to the value of the Content-Length header.
+    """
+    table = {}
+    for status_code, reason in statuses:
+        table[status_code] = [("HTTP/1.1 " + str(status_code) + " " + reason + "\r\n"
+                               + "Content-Type: " + content_type + "\r\n"
+                               + "Access-Control-Allow-Origin: *\r\n"
+                               + "Content-Length: ").encode() for content_type in CONTENT_TYPES]
+    return table
+
+
+# Pre-encoded headers of the replies
+response_headers = build_header_table(((200, "OK"), (400, "Bad Request"), (405, "Method Not Allowed"), (503, "Service Unavailable")))
+KEEP_ALIVE_END = ("\r\nConnection: keep-alive\r\nKeep-Alive: timeout=" + str(KEEPALIVE_TIMEOUT) \
+    + ", max=" + str(MAX_REQUESTS) + "\r\n\r\n").encode()
+CLOSE_END = b"\r\nConnection: close\r\n\r\n"
+ETAG_HEADER = b"\r\nETag: "
+NOT_MODIFIED_HEAD = b"HTTP/1.1 304 Not Modified\r\nAccess-Control-Allow-Origin: *\r\nETag: " # 304 replies have no body nor length
+
+# Pre-encoded headers of the Server-Sent Events stream, which lasts until the connection closes
+EVENTS_HEAD = response_headers[200][CONTENT_EVENTS].replace(b"Content-Length: ", b"Cache-Control: no-cache") + CLOSE_END
+
+
+def build_response(status_code, content_type, data, keep_alive, etag=None):
+    """
+    Build a complete HTTP reply from the pre-encoded headers.
+
+    Args:
+        status_code (int): The HTTP status code (200, 304, 400, 405, 503).
+        content_type (int): The content type of the data (CONTENT_TEXT or CONTENT_JSON).
+        data (bytes): The data sent after the headers.
+        keep_alive (bool): Whether the connection is kept open after the reply.
+        etag (bytes): The tag of the state sent in the ETag header, or None.
 
     Returns:
-        socket: The opened socket for communication.
+        bytes: The headers followed by the data, to be sent with a single write.
     """
-    address = (ip, 80) # IP address and port for the socket
-    connection = socket.socket() # Create a new socket
-    connection.bind(address) # Bind the socket to the address
-    connection.listen(1) # Listen for incoming connections
-    return connection
+    if keep_alive:
+        headers_end = KEEP_ALIVE_END
+    else:
+        headers_end = CLOSE_END
+
+    if etag is None:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), headers_end, data))
+    elif status_code == 304:
+        return b"".join((NOT_MODIFIED_HEAD, etag, headers_end))
+    else:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), ETAG_HEADER, etag, headers_end, data))
+
+
+@micropython.viper
+def find_byte(buffer, start: int, end: int, byte: int) -> int:
+    """
+    Find the first occurrence of a byte in buffer[start:end].
+
+    Args:
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+        byte (int): The byte value to look for.
+
+    Returns:
+        int: The position of the byte, or -1 if it is not found.
+    """
+    data = ptr8(buffer)
+    position = start
+    while position < end:
+        if data[position] == byte:
+            return position
+        position += 1
+    return -1
 
 
-def status_code_set(status_code):
+@micropython.viper
+def find_head_end(buffer, start: int, end: int) -> int:
     """
-    Generate the HTTP status response based on the given status code.
+    Find the blank line that ends the head of a request in buffer[start:end].
 
     Args:
-        status_code (int): The status code (e.g., 200, 400, 405).
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
 
     Returns:
-        str: The corresponding HTTP status response.
+        int: The position of the blank line, or -1 if it is not found.
+    """
+    data = ptr8(buffer)
+    position = start
+    while position + 3 < end:
+        if data[position] == 13 and data[position + 1] == 10 \
+            and data[position + 2] == 13 and data[position + 3] == 10:
+            return position
+        position += 1
+    return -1
+
+
+@micropython.viper
+def header_matches(buffer, start: int, end: int, name) -> bool:
     """
-    if status_code == 200:
-        status_send = "HTTP/1.0 200 OK\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 400:
-        status_send = "HTTP/1.0 400 Bad Request\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 405:
-        status_send = "HTTP/1.0 405 Method Not Allowed\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
+    Compare buffer[start:end] with a lowercase name, ignoring the case of the buffer.
 
-    return status_send
+    Args:
+        buffer (bytearray): The buffer holding the header.
+        start (int): Position where the header name or value starts.
+        end (int): Position where the header name or value ends.
+        name (bytes): The lowercase name to compare with (e.g., b"connection").
+
+    Returns:
+        bool: True if both are equal, False otherwise.
+    """
+    length = int(len(name))
+    if end - start != length:
+        return False
+    data = ptr8(buffer)
+    expected = ptr8(name)
+    index = 0
+    while index < length:
+        if (data[start + index] | 0x20) != expected[index]:
+            return False
+        index += 1
+    return True
 
 
-def request_data_extractor(request):
+def parse_request(buffer, start, end):
     """
-    Extract the HTTP method, endpoint, and parameters from the incoming request.
+    Parse the request stored in buffer[start:end] without copying the buffer.
 
     Args:
-        request (str): The raw HTTP request string.
+        buffer (bytearray): The receive buffer of the connection.
+        start (int): Position where the request starts.
+        end (int): Position where the received data ends.
 
     Returns:
-        tuple: (method, endpoint, parameters) extracted from the request.
+        tuple: (method, endpoint, parameters, body, size, keep_alive, if_none_match) where
+               body is a memoryview over the buffer, size is the length of the whole request
+               and if_none_match the value of the If-None-Match header (None if missing),
+               or None if the request has not been completely received yet.
+
+    Raises:
+        ValueError: If the request is malformed or does not fit in the buffer.
     """
-    request = request.split()
-    method = request[0][2:] # Extract HTTP method (GET, POST, etc.)       
-    request = request[1].split("/")
-    request = request[1].split("?")
-    endpoint = request[0] # Extract endpoint
+    head_end = find_head_end(buffer, start, end)
+    if head_end < 0:
+        if end - start >= MAX_REQUEST_SIZE:
+            raise ValueError("Request too large")
+        return None # Wait for the rest of the head
+    view = memoryview(buffer)
 
-    # Extract parameters (if any)
-    if len(request) == 1:
+    # Request line (e.g., "POST /endpoint?key=value HTTP/1.1")
+    line_end = find_byte(buffer, start, head_end + 2, 13)
+    method_end = find_byte(buffer, start, line_end, 32)
+    if method_end < 0:
+        raise ValueError("Malformed request line")
+    target_end = find_byte(buffer, method_end + 1, line_end, 32)
+    if target_end < 0 or buffer[method_end + 1] != 47:
+        raise ValueError("Malformed request line")
+    method = str(view[start:method_end], "utf-8") # Extract HTTP method (GET, POST, etc.)
+    query = find_byte(buffer, method_end + 2, target_end, 63)
+    if query < 0:
+        endpoint = str(view[method_end + 2:target_end], "utf-8") # Extract endpoint
         parameters = None
     else:
-        parameters = request[1]
-    
-    return method, endpoint, parameters
+        endpoint = str(view[method_end + 2:query], "utf-8") # Extract endpoint
+        parameters = str(view[query + 1:target_end], "utf-8") # Extract parameters
+
+    # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones must ask for it
+    keep_alive = buffer[line_end - 1] == 49
+    length = 0
+    if_none_match = None
 
+    # Headers, only the ones needed by the server are looked at
+    position = line_end + 2
+    while position < head_end:
+        line_end = find_byte(buffer, position, head_end + 2, 13)
+        colon = find_byte(buffer, position, line_end, 58)
+        if colon > 0:
+            value = colon + 1
+            while value < line_end and buffer[value] == 32:
+                value += 1
+            if header_matches(buffer, position, colon, b"content-length"):
+                length = int(str(view[value:line_end], "utf-8"))
+            elif header_matches(buffer, position, colon, b"connection"):
+                keep_alive = header_matches(buffer, value, line_end, b"keep-alive")
+            elif header_matches(buffer, position, colon, b"if-none-match"):
+                if_none_match = bytes(view[value:line_end])
+        position = line_end + 2
 
-def turn_blinds_percentage(method, parameters):
+    body = head_end + 4
+    size = body + length - start
+    if size > MAX_REQUEST_SIZE:
+        raise ValueError("Request too large")
+    if start + size > end:
+        return None # Wait for the rest of the body
+
+    return method, endpoint, parameters, view[body:body + length], size, keep_alive, if_none_match
+
+
+def not_modified(if_none_match):
+    """
+    Check whether the client already has the current state, from the tags it sent.
+
+    Args:
+        if_none_match (bytes): The value of the If-None-Match header, or None.
+
+    Returns:
+        bool: True if one of the tags sent is the tag of the current state.
+    """
+    if if_none_match is None:
+        return False
+    return if_none_match == b"*" or state.etag() in if_none_match
+
+
+async def sample_potentiometer():
+    """
+    Task that samples the potentiometer continuously, so a button press uses an already
+    filtered reading, and moves the blinds with the knob while the follow mode is on.
+    """
+    followed = potentiometer.read() # Reading the blinds were last moved to
+    while True:
+        potentiometer.sample()
+        reading = potentiometer.read()
+        if state.follow == 1 and abs(reading - followed) >= KNOB_HYSTERESIS:
+            followed = reading
+            spLock.acquire()
+            try:
+                if state.follow == 1:
+                    set_position_blinds((reading * 100 + 32767) // 65535)
+                    notify_change()
+            finally:
+                spLock.release()
+        elif state.follow == 0:
+            followed = -KNOB_HYSTERESIS # Move to the knob as soon as the follow mode starts
+        await asyncio.sleep_ms(KNOB_INTERVAL_MS)
+
+
+def move_blinds(percentage):
+    """
+    Move the blinds to a position sent by a client, which stops following the potentiometer.
+
+    Args:
+        percentage (int): The percentage to set the blinds to (0 to 100).
+    """
+    state.set_follow(0) # A position sent stops following the potentiometer
+    set_position_blinds(percentage) # Set blinds' position
+
+
+def turn_blinds_percentage(method, parameters, updates=None):
     """
     Process the 'turn_blinds_percentage' request to set blinds' position.
 
     Args:
         method (str): The HTTP method used (should be 'POST').
         parameters (str): The request parameters (percentage of blinds position).
+        updates (Coalescer): Where to hand the position over instead of moving the blinds at once,
+                             or None to move them now.
 
     Returns:
-        tuple: (status_code, percentage) where status_code is HTTP status and 
-               percentage is the updated blinds position.
+        int: The corresponding HTTP status code.
     """
     if method == 'POST':
         try:
@@ -147,41 +726,200 @@ def turn_blinds_percentage(method, parameters):
                     found = True
             if found == True:
                 if percentage >= 0 and percentage <=100:
-                    percentage = percentage/100 # Convert percentage to float (0 to 1)
-                    set_position_blinds(percentage) # Set blinds' position
+                    if updates is None:
+                        move_blinds(percentage)
+                    else:
+                        updates.submit(percentage) # Replaces the position still pending, if any
                     status_code = 200 # OK status
                 else:
                     status_code = 400 # Bad Request
-                    percentage = None
             else:
                 status_code = 400 # Bad Request
-                percentage = None
         except:
             status_code = 400 # Bad Request (invalid parameters)
-            percentage = None
     else:
         status_code = 405 # Method Not Allowed (only POST is allowed)
-        percentage = None
     
-    return status_code, percentage
+    return status_code
+
+
+def follow_knob(method, parameters):
+    """
+    Process the 'follow_knob' request to make the blinds follow the potentiometer or stop it.
+
+    Args:
+        method (str): The HTTP method used (should be 'POST').
+        parameters (str): The request parameters (status of the follow mode, on or off).
+
+    Returns:
+        int: The corresponding HTTP status code.
+    """
+    if method == 'POST':
+        try:
+            parameters = parameters.split("&") # Split parameters by "&"
+            status = None
+            for parameter in parameters:
+                key, value = parameter.split("=")
+                if key == "status":
+                    status = value # Extract the status (on/off)
+            if status == 'on':
+                state.set_follow(1) # The sampler moves the blinds to the knob
+                status_code = 200 # OK status
+            elif status == 'off':
+                state.set_follow(0)
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad Request
+        except:
+            status_code = 400 # Bad Request (invalid parameters)
+    else:
+        status_code = 405 # Method Not Allowed (only POST is allowed)
+
+    return status_code
+
+
+def calibrate(method, parameters):
+    """
+    Process the 'calibrate' request to calibrate the positions of the servo.
+    A POST with a 'duty' moves the servo to that duty cycle, to find where the blinds reach
+    a position, and adding a 'percentage' stores that duty cycle for the percentage.
+    A POST with 'reset=1' restores the default calibration, and a GET returns the points.
+
+    Args:
+        method (str): The HTTP method used ('POST' to calibrate, 'GET' to check the calibration).
+        parameters (str): The request parameters ('duty' and 'percentage', or 'reset').
+
+    Returns:
+        tuple: (status_code, data_send, data) where status_code is HTTP status,
+               data_send is a flag if data should be sent, and data is the calibration as JSON bytes.
+    """
+    global duty_table
+    data_send = False
+    data = None
+
+    if method == 'POST':
+        try:
+            parameters = parameters.split("&") # Split parameters by "&"
+            values = {}
+            for parameter in parameters:
+                key, value = parameter.split("=")
+                values[key] = int(value)
+
+            if 'reset' in values:
+                calibration.clear()
+                calibration.update(DEFAULT_CALIBRATION)
+                try:
+                    os.remove(CALIBRATION_FILE)
+                except OSError:
+                    pass # Nothing was stored
+                duty_table = build_duty_table(calibration)
+                status_code = 200 # OK status
+            elif 'duty' in values and 0 < values['duty'] <= 65535 \
+                and ('percentage' not in values or 0 <= values['percentage'] <= 100):
+                state.set_follow(0) # The knob would move the servo away from the duty cycle
+                planner.move_to(values['duty'])
+                if 'percentage' in values:
+                    calibration[values['percentage']] = values['duty']
+                    save_calibration(calibration)
+                    duty_table = build_duty_table(calibration) # Only rebuilt when calibrating
+                    state.set_position(values['percentage'])
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad Request
+        except:
+            status_code = 400 # Bad Request (invalid parameters)
+
+    elif method == 'GET':
+        points = []
+        for percent in sorted(calibration):
+            points.append('[' + str(percent) + ', ' + str(calibration[percent]) + ']')
+        data = ('{"points": [' + ', '.join(points) + ']}').encode()
+        data_send = True
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only POST and GET are allowed)
+
+    return status_code, data_send, data
+
+
+def check_coalescing(method):
+    """
+    Handles the 'coalescing' endpoint, which returns how many positions were received, applied and
+    dropped for a newer one.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+
+    Returns:
+        status_code (int): The HTTP status code (200 or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The JSON-formatted counters.
+    """
+    if method == 'GET':
+        data_send = True
+        data = position_updates.json()
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only GET is allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
+
+
+def check_metrics(method):
+    """
+    Handles the 'metrics' endpoint, which returns the counters of the web server.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+
+    Returns:
+        status_code (int): The HTTP status code (200 or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The metrics in the Prometheus text format.
+    """
+    if method == 'GET':
+        data_send = True
+        data = metrics.text()
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only GET is allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
 
 
-def check_status(method, percentage):
+def check_status(method, if_none_match, moving):
     """
     Process the 'check_status' request to return current blinds' position.
+    While the servo moves, the reply also holds its current position and the time left.
 
     Args:
         method (str): The HTTP method used (should be 'GET').
-        percentage (float): The current position of the blinds.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+        moving (bool): Whether the servo was moving when the request was routed.
 
     Returns:
         tuple: (status_code, data_send, data) where status_code is HTTP status, 
-               data_send is a flag if data should be sent, and data is the blinds' position.
+               data_send is a flag if data should be sent, and data is the blinds' position as JSON bytes.
     """
     if method == 'GET':
-        data_send = True
-        data = str(percentage*100) # Convert percentage back to a string (0 to 100)
-        status_code = 200 # OK status
+        if moving == False and not_modified(if_none_match):
+            data_send = False
+            data = None
+            status_code = 304 # Not Modified, the client already has the current state
+        elif moving == True:
+            # Complete the JSON of the target position with the position of the servo on its way
+            data_send = True
+            data = state.json()[:-1] + (', "position": ' + str(duty_to_percentage(planner.duty)) \
+                + ', "eta_ms": ' + str(planner.eta_ms()) + '}').encode()
+            status_code = 200 # OK status
+        else:
+            data_send = True
+            data = state.json() # Blinds position (0 to 100) as cached JSON
+            status_code = 200 # OK status
     else:
         data_send = False
         data = None
@@ -190,81 +928,847 @@ def check_status(method, percentage):
     return status_code, data_send, data
 
 
-def serve(connection):
+
+class Subscriber:
     """
-    Start a web server to handle client requests and control blinds.
+    Bounded queue of the state change events waiting to be sent to a client.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size (int): Maximum number of pending events, the oldest ones are dropped.
+        """
+        self.size = size
+        self.queue = []
+        self.event = asyncio.Event()
+
+    def put(self, event):
+        """
+        Queue an event, dropping the oldest one if the client is too slow.
+
+        Args:
+            event (bytes): The encoded event.
+        """
+        if len(self.queue) >= self.size:
+            self.queue.pop(0)
+        self.queue.append(event)
+        self.event.set()
+
+    async def get(self, timeout):
+        """
+        Wait for the next event.
+
+        Args:
+            timeout (int): Maximum seconds to wait.
+
+        Returns:
+            bytes: The encoded event, or None if none arrived in time.
+        """
+        if not self.queue:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.pop(0)
+
+
+def notify_change():
+    """
+    Send the state to the subscribers as an event if it changed since the last one.
+    """
+    global last_version
+    if state.version != last_version:
+        last_version = state.version
+        event = b"data: " + state.json() + b"\n\n" # Encoded once for every subscriber
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+async def wait_for_change(parameters):
+    """
+    Hold a long-poll request until the state changes or its 'wait' time passes.
+
+    Args:
+        parameters (str): The request parameters, the seconds to wait are in 'wait'.
+    """
+    wait = 0
+    try:
+        for parameter in parameters.split("&"):
+            key, value = parameter.split("=")
+            if key == "wait":
+                wait = min(int(value), LONG_POLL_MAX)
+    except:
+        return # Invalid parameters are left to the handler
+    if wait <= 0 or len(subscribers) >= MAX_SUBSCRIBERS:
+        return
+
+    subscriber = Subscriber(1)
+    subscribers.append(subscriber)
+    try:
+        await subscriber.get(wait)
+    finally:
+        subscribers.remove(subscriber)
+
+
+async def stream_events(writer):
+    """
+    Stream the state changes to the client as Server-Sent Events until it disconnects.
 
     Args:
-        connection (socket): The socket connection to handle.
+        writer (StreamWriter): The stream to send the events to.
+    """
+    subscriber = Subscriber(EVENT_QUEUE_SIZE)
+    subscribers.append(subscriber)
+    try:
+        writer.write(EVENTS_HEAD)
+        writer.write(b"data: " + state.json() + b"\n\n") # Start with the current state
+        await writer.drain()
+        while True:
+            event = await subscriber.get(EVENTS_PING)
+            if event is None:
+                writer.write(b": ping\n\n")
+            else:
+                writer.write(event)
+            await writer.drain()
+    finally:
+        subscribers.remove(subscriber)
+
+
+# Clients waiting for state changes and the version of the last state sent to them
+subscribers = []
+last_version = -1
+
+
+class Coalescer:
+    """
+    Keeps only the latest pending value of an actuator and applies it at a bounded rate, so a flood
+    of updates (such as a slider being dragged) never queues up and the actuator goes straight to the
+    last one. The updates are answered as soon as they are accepted.
+    """
+    __slots__ = ("apply", "interval_ms", "pending", "event", "received", "applied", "coalesced")
+
+    def __init__(self, apply, interval_ms):
+        """
+        Args:
+            apply (function): Called with the value to apply, holding spLock.
+            interval_ms (int): Minimum time in ms between two values applied.
+        """
+        self.apply = apply
+        self.interval_ms = interval_ms
+        self.pending = None # Value waiting to be applied
+        self.event = asyncio.Event() # Set when a value is pending
+        self.received = 0 # Values submitted
+        self.applied = 0 # Values applied
+        self.coalesced = 0 # Values dropped for a newer one before being applied
+
+    def submit(self, value):
+        """
+        Set the value to apply next, replacing the pending one.
+
+        Args:
+            value: The value to apply.
+        """
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = value
+        self.received += 1
+        self.event.set()
+
+    def cancel(self):
+        """
+        Drop the pending value, superseded by a command applied directly.
+        """
+        if self.pending is not None:
+            self.coalesced += 1
+            self.pending = None
+
+    async def run(self):
+        """
+        Task that applies the pending value, waiting the interval after every one.
+        """
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            if self.pending is None:
+                continue # Cancelled meanwhile
+            value = self.pending
+            self.pending = None
+            spLock.acquire() # Lock to avoid race conditions
+            try:
+                self.apply(value)
+                notify_change() # Send the new state to the subscribers if it changed
+            finally:
+                spLock.release() # Release the lock
+            self.applied += 1
+            await asyncio.sleep_ms(self.interval_ms)
+
+    def json(self):
+        """
+        Get the counters of the updates.
+
+        Returns:
+            bytes: The JSON-formatted number of updates received, applied and coalesced.
+        """
+        return ('{"received": ' + str(self.received) + ', "applied": ' + str(self.applied) \
+                + ', "coalesced": ' + str(self.coalesced) + '}').encode()
+
+
+# Positions sent by the clients, applied at a bounded rate
+position_updates = Coalescer(move_blinds, UPDATE_INTERVAL_MS)
+
+
+def dispatch(method, endpoint, parameters, if_none_match):
+    """
+    Run the handler of an endpoint. The caller holds spLock.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply.
     """
-    global percentage
     data_send = False
+    data = None
+    content_type = CONTENT_TEXT
+    etag = None
+
+    if method == 'POST':
+        position_updates.cancel() # A command applied directly supersedes the pending one
+
+    if endpoint == 'turn_blinds_percentage':
+        status_code = turn_blinds_percentage(method, parameters)
+
+    elif endpoint == 'follow_knob':
+        status_code = follow_knob(method, parameters)
+
+    elif endpoint == 'calibrate':
+        status_code, data_send, data = calibrate(method, parameters)
+        content_type = CONTENT_JSON
+
+    elif endpoint == 'coalescing':
+        status_code, data_send, data = check_coalescing(method)
+        content_type = CONTENT_JSON
+
+    elif endpoint == 'check_status':
+        moving = planner.moving() # The timer keeps moving the servo meanwhile
+        status_code, data_send, data = check_status(method, if_none_match, moving)
+        content_type = CONTENT_JSON
+        if (status_code == 200 or status_code == 304) and moving == False:
+            etag = state.etag() # Replies during a move change on every step, so they get no tag
+
+    elif endpoint == 'metrics':
+        status_code, data_send, data = check_metrics(method)
+
+    else:
+        status_code = 400 # Bad Request for invalid endpoints
+
+    if data_send == False:
+        data = b""
+
+    return status_code, content_type, data, etag
+
+
+def run_batch(method, body):
+    """
+    Runs a list of operations one after the other and gathers their replies, so a client can
+    change several values and read the state in one request. The caller holds spLock.
+
+    Args:
+        method (str): The HTTP method (only accepts 'POST').
+        body (memoryview): JSON list of the operations, each one an object with the endpoint
+                           ('op'), and optionally its parameters ('params', a query string or
+                           an object) and its HTTP method ('method', 'POST' by default).
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+        data (bytes): JSON list with the status code of every operation and its reply if any.
+    """
+    if method != 'POST':
+        return 405, b"" # Method Not Allowed (only POST is allowed)
+
+    # Check the whole list before running anything, so a malformed batch changes nothing
+    try:
+        operations = []
+        for operation in json.loads(bytes(body)):
+            parameters = operation.get("params", "")
+            if isinstance(parameters, dict):
+                parameters = "&".join([key + "=" + str(value) for key, value in parameters.items()])
+            operations.append((operation.get("method", "POST"), operation["op"], parameters))
+    except:
+        return 400, b"" # Bad Request
+    if len(operations) == 0 or len(operations) > MAX_BATCH:
+        return 400, b"" # Bad Request
+
+    results = []
+    for method, endpoint, parameters in operations:
+        if endpoint == 'batch':
+            status_code = 400 # Bad Request, batches can not be nested
+            content_type = CONTENT_TEXT
+            data = b""
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None)
+        result = b'{"op": ' + json.dumps(endpoint).encode() + b', "status": ' + str(status_code).encode()
+        if content_type == CONTENT_JSON and len(data) > 0:
+            result += b', "data": ' + data
+        results.append(result + b"}")
+
+    return 200, b"[" + b", ".join(results) + b"]"
+
+
+def submit_update(method, endpoint, parameters):
+    """
+    Hand a position over to the coalescing task instead of applying it at once, for the requests
+    that arrive in floods (HTTP and UDP). The batches and the MQTT commands are applied directly.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+
+    Returns:
+        int: The HTTP status code, or None if the request is not coalesced.
+    """
+    if endpoint == 'turn_blinds_percentage' and method == 'POST':
+        return turn_blinds_percentage(method, parameters, position_updates)
+    return None
+
+
+def route_request(method, endpoint, parameters, body, if_none_match):
+    """
+    Route the request to the appropriate handler based on the endpoint.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        body (memoryview): The body of the request.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply.
+    """
+    started = ticks_us()
+    status_code = submit_update(method, endpoint, parameters)
+    if status_code is not None:
+        metrics.observe(PHASE_HANDLER, ticks_diff(ticks_us(), started))
+        return status_code, CONTENT_TEXT, b"", None # Answered before the update is applied
+
+    spLock.acquire() # Lock to avoid race conditions
+    locked = ticks_us()
+    metrics.observe(PHASE_LOCK, ticks_diff(locked, started))
+    try:
+        if endpoint == 'batch':
+            status_code, data = run_batch(method, body) # Every operation runs under this single lock
+            content_type = CONTENT_JSON
+            etag = None
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, if_none_match)
+
+        notify_change() # Send the new state to the subscribers if it changed, once for a whole batch
+    finally:
+        spLock.release() # Release the lock
+    metrics.observe(PHASE_HANDLER, ticks_diff(ticks_us(), locked))
+
+    return status_code, content_type, data, etag
+
+
+class Metrics:
+    """
+    Lightweight counters of the web server, served in the Prometheus text format by '/metrics'.
+    The time of every phase of the requests is counted in a histogram of fixed buckets, so
+    recording it only increases two numbers.
+    """
+    __slots__ = ("counts", "sums", "requests", "connections")
+
+    def __init__(self):
+        # Times counted in every bucket of every phase, the last bucket is above all the bounds
+        self.counts = [[0] * (len(METRICS_BUCKETS_US) + 1) for _ in PHASES]
+        self.sums = [0] * len(PHASES) # Total time in us of every phase
+        self.requests = {} # Requests answered for every pair of endpoint and status code
+        self.connections = 0 # Connections accepted
+
+    def observe(self, phase, us):
+        """
+        Count the time taken by a phase of a request.
+
+        Args:
+            phase (int): The index of the phase in PHASES.
+            us (int): The time taken in us.
+        """
+        index = 0
+        for bound in METRICS_BUCKETS_US:
+            if us <= bound:
+                break
+            index += 1
+        self.counts[phase][index] += 1
+        self.sums[phase] += us
+
+    def count(self, endpoint, status_code):
+        """
+        Count a request answered.
+
+        Args:
+            endpoint (str): The requested endpoint, None if the request was malformed.
+            status_code (int): The HTTP status code of the reply.
+        """
+        key = (endpoint or "", status_code)
+        if key not in self.requests and len(self.requests) >= METRICS_MAX_SERIES:
+            key = ("other", status_code) # Endpoints sent by the clients could fill the memory
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def text(self):
+        """
+        Format the metrics in the Prometheus text format.
+
+        Returns:
+            bytes: One line for every value, with the histograms in us.
+        """
+        lines = ["# HELP request_phase_us Time spent in every phase of the requests in us",
+                 "# TYPE request_phase_us histogram"]
+        for phase in range(len(PHASES)):
+            label = 'request_phase_us_bucket{phase="' + PHASES[phase] + '",le="'
+            counts = self.counts[phase]
+            total = 0
+            for index in range(len(METRICS_BUCKETS_US)):
+                total += counts[index]
+                lines.append(label + str(METRICS_BUCKETS_US[index]) + '"} ' + str(total))
+            total += counts[-1]
+            lines.append(label + '+Inf"} ' + str(total))
+            lines.append('request_phase_us_sum{phase="' + PHASES[phase] + '"} ' + str(self.sums[phase]))
+            lines.append('request_phase_us_count{phase="' + PHASES[phase] + '"} ' + str(total))
+
+        lines.append("# HELP requests_total Requests answered by endpoint and status code")
+        lines.append("# TYPE requests_total counter")
+        for key, value in self.requests.items():
+            endpoint = key[0].replace("\\", "\\\\").replace('"', '\\"') # Escaped for the label
+            lines.append('requests_total{endpoint="' + endpoint + '",status="' + str(key[1]) + '"} ' + str(value))
+
+        lines.append("# HELP connections_total Connections accepted")
+        lines.append("# TYPE connections_total counter")
+        lines.append("connections_total " + str(self.connections))
+        lines.append("# HELP memory_free_bytes Free memory of the heap")
+        lines.append("# TYPE memory_free_bytes gauge")
+        lines.append("memory_free_bytes " + str(gc.mem_free()))
+        lines.append("# HELP memory_allocated_bytes Allocated memory of the heap")
+        lines.append("# TYPE memory_allocated_bytes gauge")
+        lines.append("memory_allocated_bytes " + str(gc.mem_alloc()))
+        lines.append("# HELP uptime_seconds Time since the boot")
+        lines.append("# TYPE uptime_seconds gauge")
+        lines.append("uptime_seconds " + str(time() - BOOT_TIME))
+        return ("\n".join(lines) + "\n").encode()
+
+
+metrics = Metrics() # Counters of the web server
+
+
+async def receive_into(reader, view):
+    """
+    Receive data from the client directly into a preallocated buffer.
+
+    Args:
+        reader (StreamReader): The stream to receive the data from.
+        view (memoryview): The free part of the receive buffer.
+
+    Returns:
+        int: The number of bytes received, 0 if the connection was closed.
+    """
+    if hasattr(reader, "readinto"):
+        return await reader.readinto(view)
+    chunk = await reader.read(len(view)) # CPython streams have no readinto()
+    view[:len(chunk)] = chunk
+    return len(chunk)
+
+
+async def handle_client(reader, writer):
+    """
+    Handle a persistent client connection, answering pipelined requests in order.
+
+    Args:
+        reader (StreamReader): The stream to receive the requests from.
+        writer (StreamWriter): The stream to send the replies to.
+    """
+    # Requests are received into a preallocated buffer and parsed in place
+    buffer = buffer_pool.pop() if buffer_pool else bytearray(MAX_REQUEST_SIZE)
+    view = memoryview(buffer)
+    start = 0 # Position of the next request in the buffer
+    end = 0 # Position where the received data ends
+    served = 0
+    keep_alive = True
+    metrics.connections += 1
+    try:
+        while keep_alive:
+            parsing = ticks_us()
+            try:
+                request = parse_request(buffer, start, end)
+            except ValueError as e:
+                print(e) # Malformed request, reply and close the connection
+                request = (None, None, None, None, end - start, False, None)
+
+            if request is None:
+                # Move the partial request to the front of the buffer and receive the rest
+                if start > 0:
+                    view[:end - start] = view[start:end]
+                    end -= start
+                    start = 0
+                timeout = READ_TIMEOUT if end else KEEPALIVE_TIMEOUT
+                waiting = ticks_us()
+                received = await asyncio.wait_for(receive_into(reader, view[end:]), timeout)
+                if not received:
+                    return # Connection closed by the client
+                if end:
+                    metrics.observe(PHASE_RECEIVE, ticks_diff(ticks_us(), waiting)) # Not the idle time between requests
+                end += received
+                continue
+
+            metrics.observe(PHASE_PARSE, ticks_diff(ticks_us(), parsing))
+
+            method, endpoint, parameters, body, size, keep_alive, if_none_match = request
+            start += size
+            if start == end:
+                start = end = 0
+            served += 1
+            if served >= MAX_REQUESTS:
+                keep_alive = False
+            print(method, endpoint, parameters)
+
+            if endpoint == 'events':
+                # Server-Sent Events keep the connection until the client leaves
+                if method != 'GET':
+                    status_code, content_type, data, etag = 405, CONTENT_TEXT, b"", None
+                elif len(subscribers) >= MAX_SUBSCRIBERS:
+                    status_code, content_type, data, etag = 503, CONTENT_TEXT, b"", None
+                else:
+                    metrics.count(endpoint, 200)
+                    await stream_events(writer)
+                    break
+            else:
+                # Long-poll requests ('wait' parameter) are answered on the next change
+                if endpoint == 'check_status' and parameters != None:
+                    await wait_for_change(parameters)
+                status_code, content_type, data, etag = route_request(method, endpoint, parameters, body, if_none_match)
+
+            metrics.count(endpoint, status_code)
+
+            # Send HTTP status code and data in a single write
+            sending = ticks_us()
+            writer.write(build_response(status_code, content_type, data, keep_alive, etag))
+
+            # Replies to pipelined requests are flushed together
+            if not keep_alive or find_head_end(buffer, start, end) < 0:
+                await writer.drain()
+            metrics.observe(PHASE_SEND, ticks_diff(ticks_us(), sending))
+    except Exception as e:
+        print(e) # Timed out or connection lost
+    finally:
+        if len(buffer_pool) < BACKLOG:
+            buffer_pool.append(buffer) # Keep the buffer for the next connection
+        writer.close() # Close the client connection
+        await writer.wait_closed()
+
+
+def run_opcode(opcode, payload):
+    """
+    Run the handler of a binary control message, as an HTTP request to the same endpoint would.
+
+    Args:
+        opcode (int): The operation, a key of UDP_OPCODES.
+        payload (memoryview): The values of the operation, packed as its layout tells.
+
+    Returns:
+        status_code (int): The HTTP status code of the handler (400 for unknown or malformed messages).
+        data (bytes): The JSON reply of the handler, empty if it has none.
+    """
+    if opcode not in UDP_OPCODES:
+        return 400, b"" # Bad Request for unknown opcodes
+    method, endpoint, layout, template = UDP_OPCODES[opcode]
+    try:
+        parameters = template % struct.unpack(layout, payload)
+    except:
+        return 400, b"" # Bad Request, the payload does not fit the layout
+
+    status_code = submit_update(method, endpoint, parameters)
+    if status_code is not None:
+        return status_code, b"" # Answered before the update is applied
+
+    spLock.acquire() # Lock to avoid race conditions
+    try:
+        status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None)
+        notify_change() # Send the new state to the subscribers if it changed
+    finally:
+        spLock.release() # Release the lock
+
+    return status_code, data
+
+
+async def serve_udp(ip):
+    """
+    Serve the binary control messages received on the UDP port, polling the socket between the
+    other tasks. A message holds the opcode (1 byte), a sequence number (2 bytes, big-endian, one
+    more for every message of the client) and the payload. Messages older than the last one of the
+    same client are dropped, and the rest are answered with the opcode, the sequence number, the
+    HTTP status code (2 bytes, big-endian) and the JSON reply if any.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(socket.getaddrinfo(ip, UDP_PORT)[0][-1])
+    sock.setblocking(False)
+    sequences = {} # Last sequence number received from every client
+
     while True:
-        client = connection.accept()[0] # Accept a client connection
-        request = client.recv(1024) # Receive the request
-        request = str(request)
-        print(request)
         try:
-            method, endpoint, parameters = request_data_extractor(request) # Extract request details
-        except:
-            endpoint = None    
-        
-        spLock.acquire() # Lock to avoid race conditions
-        
-        # Route the request to the appropriate handler based on the endpoint
-        if endpoint == 'turn_blinds_percentage':
-            status_code, new_percentage = turn_blinds_percentage(method, parameters)
-            if new_percentage != None:
-                percentage = new_percentage # Update global percentage
-        
-        elif endpoint == 'check_status':
-            status_code, data_send, data = check_status(method, percentage)
-        
-        else:
-            status_code = 400 # Bad Request for invalid endpoints
+            packet, address = sock.recvfrom(UDP_MAX_SIZE)
+        except OSError:
+            await asyncio.sleep_ms(UDP_POLL_MS) # Nothing received
+            continue
+        if len(packet) < 3:
+            continue # Too short to be a message
 
+        # Drop the messages overtaken by a newer one, a client starts again from 0 after a restart
+        opcode = packet[0]
+        sequence = packet[1] << 8 | packet[2]
+        last = sequences.get(address)
+        if last is not None and sequence != 0 and not 0 < (sequence - last) & 0xFFFF < 0x8000:
+            continue
+        if last is None and len(sequences) >= UDP_MAX_CLIENTS:
+            sequences.clear() # Forget the clients gone quiet
+        sequences[address] = sequence
+
+        status_code, data = run_opcode(opcode, memoryview(packet)[3:])
+        try:
+            sock.sendto(struct.pack(">BHH", opcode, sequence, status_code) + data, address)
+        except OSError:
+            pass # The reply is lost like any datagram, the next message carries the new state anyway
+        await asyncio.sleep_ms(0) # Let the other tasks run between two messages
+
+
+def mqtt_command(topic, message):
+    """
+    Run a command received from the broker, as a POST request to the endpoint named by the last
+    level of its topic would.
+
+    Args:
+        topic (bytes): The topic of the command, '<MQTT_TOPIC>/cmd/<endpoint>'.
+        message (bytes): The parameters of the command, such as 'percentage=50'.
+    """
+    endpoint = topic[len(MQTT_TOPIC) + 5:].decode()
+    try:
+        parameters = message.decode()
+    except:
+        return # Not text, ignored like a malformed request
+
+    spLock.acquire() # Lock to avoid race conditions
+    try:
+        status_code, content_type, data, etag = dispatch("POST", endpoint, parameters, None)
+        notify_change() # Send the new state to the subscribers if it changed
+    finally:
         spLock.release() # Release the lock
-        
-        # Send HTTP status code
-        client.send(status_code_set(status_code))
-        
-        # Send data if needed
-        if data_send == True:
-            client.send(data)
-            data_send = False
-        
-        client.close() # Close the client connection
+
+    if status_code != 200:
+        print("MQTT command", endpoint, "failed with", status_code)
 
 
-def button_task():
+async def run_mqtt():
     """
-    Task to handle button press and adjust blinds position using a potentiometer.
+    Keep a session with the MQTT broker: publish the state retained on '<MQTT_TOPIC>/state' every
+    time it changes and run the commands received on '<MQTT_TOPIC>/cmd/<endpoint>', reconnecting
+    with an increasing backoff when the broker is lost. The retained '<MQTT_TOPIC>/online' topic
+    tells whether the device is connected.
     """
+    backoff = MQTT_BACKOFF_MIN
+    while True:
+        client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        try:
+            client.set_callback(mqtt_command)
+            client.set_last_will(MQTT_TOPIC + b"/online", b"0", True)
+            client.connect()
+            client.publish(MQTT_TOPIC + b"/online", b"1", True)
+            client.subscribe(MQTT_TOPIC + b"/cmd/+", MQTT_QOS)
+            backoff = MQTT_BACKOFF_MIN
+            published = -1 # Version of the state last published
+            last_sent = ticks_ms()
 
-    old_value_button = 0
-    potentiometer = ADC(Pin(26)) # Initialize potentiometer on Analog Pin 26
-    button = Pin(18, Pin.IN) # Initialize push button on Pin 18 as input
+            while True:
+                client.check_msg() # Run the commands received, if any
+                if state.version != published:
+                    spLock.acquire() # Lock to avoid race conditions
+                    try:
+                        published = state.version
+                        message = state.json()
+                    finally:
+                        spLock.release() # Release the lock
+                    client.publish(MQTT_TOPIC + b"/state", message, True, MQTT_QOS)
+                    last_sent = ticks_ms()
+                elif ticks_diff(ticks_ms(), last_sent) >= MQTT_KEEPALIVE * 500:
+                    client.ping() # Keep the session alive while the state does not change
+                    last_sent = ticks_ms()
+                await asyncio.sleep_ms(MQTT_POLL_MS)
+        except OSError as error:
+            print("MQTT broker lost:", error)
 
+        try:
+            client.sock.close()
+        except:
+            pass # The connection never opened
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MQTT_BACKOFF_MAX)
+
+
+async def serve(ip):
+    """
+    Start the button task and a web server that handles client requests for controlling the blinds concurrently.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    asyncio.create_task(button.run()) # Handle the physical button presses
+    asyncio.create_task(position_updates.run()) # Apply the positions sent, dropping the stale ones
+    asyncio.create_task(sample_potentiometer()) # Filter the potentiometer readings in the background
+    if UDP_ENABLED:
+        asyncio.create_task(serve_udp(ip)) # Serve the binary control messages
+    if MQTT_ENABLED and MQTTClient is not None:
+        asyncio.create_task(run_mqtt()) # Publish the state and receive the commands through the broker
+    await asyncio.start_server(handle_client, ip, PORT, backlog=BACKLOG)
     while True:
-        new_value_button = button.value() # Read button state
-        
-        # Detect button press (from 0 to 1)
-        if old_value_button == 0 and new_value_button == 1:
-            spLock.acquire()
-            percentage = float(potentiometer.read_u16())/65535 # Get percentage from potentiometer
-            print(percentage)
-            set_position_blinds(percentage) # Set blinds position
-            spLock.release()
-        old_value_button = new_value_button # Update button state
+        await asyncio.sleep(3600) # Keep serving forever
+
+
+class Button:
+    """
+    Push button read through pin interrupts, debounced and classified into
+    press, long press and double press without polling.
+    """
+
+    def __init__(self, pin, on_press, on_long_press=None, on_double_press=None,
+                 debounce_ms=DEBOUNCE_MS, long_press_ms=LONG_PRESS_MS, double_press_ms=DOUBLE_PRESS_MS):
+        """
+        Args:
+            pin (Pin): The input pin of the button (1 when pressed).
+            on_press (function): Called on a short press.
+            on_long_press (function): Called when the button is released after being held,
+                                      a short press is reported instead if it is None.
+            on_double_press (function): Called on two short presses in a row, if it is None
+                                        short presses are reported without waiting.
+            debounce_ms (int): Time in ms the contacts need to settle after an edge.
+            long_press_ms (int): Minimum time in ms the button is held for a long press.
+            double_press_ms (int): Maximum time in ms between the presses of a double press.
+        """
+        self.pin = pin
+        self.on_press = on_press
+        self.on_long_press = on_long_press
+        self.on_double_press = on_double_press
+        self.debounce_ms = debounce_ms
+        self.long_press_ms = long_press_ms
+        self.double_press_ms = double_press_ms
+        self.flag = asyncio.ThreadSafeFlag()
+        self.pin.irq(handler=self.edge, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, hard=True)
+
+    def edge(self, pin):
+        """
+        Interrupt handler of the pin, it only wakes up the button task.
+
+        Args:
+            pin (Pin): The pin that triggered the interrupt.
+        """
+        self.flag.set()
+
+    async def run(self):
+        """
+        Task that classifies the debounced presses and runs their actions.
+        """
+        pressed = False
+        pressed_at = 0
+        released_at = 0
+        waiting_double = False # A short press may still become a double press
+
+        while True:
+            # Sleep until an edge arrives, or until the double press window ends
+            if waiting_double:
+                remaining = self.double_press_ms - ticks_diff(ticks_ms(), released_at)
+                try:
+                    await asyncio.wait_for_ms(self.flag.wait(), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    waiting_double = False
+                    self.on_press()
+                    continue
+            else:
+                await self.flag.wait()
+
+            # Ignore the bounces, only the settled level counts
+            edge_at = ticks_ms()
+            await asyncio.sleep_ms(self.debounce_ms)
+            value = self.pin.value()
 
+            if value == 1 and not pressed:
+                pressed = True
+                pressed_at = edge_at
+            elif value == 0 and pressed:
+                pressed = False
+                if self.on_long_press is not None and ticks_diff(edge_at, pressed_at) >= self.long_press_ms:
+                    waiting_double = False
+                    self.on_long_press()
+                elif self.on_double_press is None:
+                    self.on_press()
+                elif waiting_double:
+                    waiting_double = False
+                    self.on_double_press()
+                else:
+                    waiting_double = True
+                    released_at = edge_at
+
+
+def button_pressed():
+    """
+    Set the blinds position from the potentiometer when the physical button is pressed.
+    """
+    spLock.acquire()
+    position_updates.cancel() # The button supersedes the position still pending
+    percentage = (potentiometer.read() * 100 + 32767) // 65535 # Get percentage from the filtered potentiometer reading
+    print(percentage)
+    set_position_blinds(percentage) # Set blinds position
+    notify_change()
+    spLock.release()
+
+
+def button_long_pressed():
+    """
+    Close the blinds completely when the physical button is held.
+    """
+    spLock.acquire()
+    position_updates.cancel() # The button supersedes the position still pending
+    state.set_follow(0)
+    set_position_blinds(0)
+    notify_change()
+    spLock.release()
+
+
+def button_double_pressed():
+    """
+    Start or stop following the potentiometer when the physical button is pressed twice.
+    """
+    spLock.acquire()
+    position_updates.cancel() # The button supersedes the position still pending
+    state.set_follow(1 - state.follow)
+    notify_change()
+    spLock.release()
 
 
 # Main code execution
 try:
-    _thread.start_new_thread(button_task, ()) # Start button task in a new thread
+    button = Button(Pin(18, Pin.IN), button_pressed, button_long_pressed, button_double_pressed) # Push button on Pin 18
     ip = connect() # Connect to the WLAN and get IP address
-    connection = open_socket(ip) # Open socket for communication
-    serve(connection) # Start serving requests
+    asyncio.run(serve(ip)) # Start serving requests
 except KeyboardInterrupt:
     reset() # Reset the device if interrupted
 
@@ -1,23 +1,339 @@
 import network
-import socket
-from time import sleep
+import micropython
+from time import sleep, ticks_ms, ticks_us, ticks_diff, time
+import gc
+from random import getrandbits
 from machine import Pin, PWM
 import machine
+import json
+from array import array
+import struct
+import socket
 import _thread
 from wlan import SSID, PASSWORD
+try:
+    import uasyncio as asyncio # Asynchronous I/O on the device
+except ImportError:
+    import asyncio
+try:
+    from umqtt.simple import MQTTClient # MQTT client of micropython-lib, only needed for the MQTT mode
+except ImportError:
+    MQTTClient = None
+from binascii import hexlify
+
+
+class FanState:
+    """
+    Authoritative state of the fan. Every change goes through it and increases the version,
+    so the JSON reply is only formatted again after a change.
+    """
+    __slots__ = ("status", "speed", "auto", "setpoint", "rpm", "stalled", "version", "cached", "cached_etag", "cached_version")
+
+    def __init__(self):
+        self.status = 0 # 1 for on, 0 for off
+        self.speed = 100 # Speed of the fan while it is on (0 to 100)
+        self.auto = 0 # 1 while the temperature controls the fan
+        self.setpoint = DEFAULT_SETPOINT # Temperature the closed loop mode keeps
+        self.rpm = 0 # Speed measured by the tachometer, in revolutions per minute
+        self.stalled = 0 # 1 if the fan is on but does not spin
+        self.version = 0 # Increased on every change
+        self.cached = b"" # JSON reply of the state
+        self.cached_etag = b"" # ETag of the state
+        self.cached_version = -1 # Version the JSON reply was formatted for
+
+    def set_status(self, status):
+        """
+        Turn the fan on or off.
+
+        Args:
+            status (int): 1 to turn it on, 0 to turn it off.
+        """
+        fan.value(status)
+        if status != self.status:
+            self.status = status
+            self.version += 1
+
+    def set_speed(self, speed):
+        """
+        Set the speed of the fan, which ramps to it while it is on.
+
+        Args:
+            speed (int): The speed of the fan (0 to 100).
+        """
+        if speed != self.speed:
+            self.speed = speed
+            self.version += 1
 
+    def set_auto(self, auto, setpoint):
+        """
+        Start or stop the closed loop mode.
+
+        Args:
+            auto (int): 1 to control the fan from the temperature, 0 to control it manually.
+            setpoint (float): The temperature the closed loop mode keeps.
+        """
+        if auto != self.auto or setpoint != self.setpoint:
+            self.auto = auto
+            self.setpoint = setpoint
+            self.version += 1
+
+    def set_rpm(self, rpm):
+        """
+        Record the speed measured by the tachometer.
+
+        Args:
+            rpm (int): The speed of the fan in revolutions per minute.
+        """
+        if rpm != self.rpm:
+            self.rpm = rpm
+            self.version += 1
+
+    def set_stalled(self, stalled):
+        """
+        Record whether the fan is stalled.
+
+        Args:
+            stalled (int): 1 if the fan is on but does not spin, 0 otherwise.
+        """
+        if stalled != self.stalled:
+            self.stalled = stalled
+            self.version += 1
+
+    def json(self):
+        """
+        Get the JSON reply with the fan status, formatted again only after a change.
+
+        Returns:
+            bytes: The JSON-formatted status (1 for on, 0 for off), speed, mode, setpoint,
+                   measured speed and stall flag.
+        """
+        if self.cached_version != self.version:
+            self.cached = ('{"status": ' + str(self.status) + ', "speed": ' + str(self.speed) + ', "auto": ' + str(self.auto) \
+                + ', "setpoint": ' + str(self.setpoint) + ', "rpm": ' + str(self.rpm) + ', "stalled": ' + str(self.stalled) + '}').encode()
+            self.cached_etag = ('"' + BOOT_ID + '-' + str(self.version) + '"').encode()
+            self.cached_version = self.version
+        return self.cached
+
+    def etag(self):
+        """
+        Get the entity tag of the state, sent in the ETag header of the status replies.
+
+        Returns:
+            bytes: The quoted tag, made of the boot identifier and the version.
+        """
+        self.json() # The tag is formatted along with the JSON after a change
+        return self.cached_etag
+
+
+class Controller:
+    """
+    PID controller of the fan speed from the temperature. Around the setpoint there is a
+    hysteresis band, so the fan is only turned on or off when the temperature leaves it.
+    """
+    __slots__ = ("integral", "last_error")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the past errors, when the closed loop mode starts.
+        """
+        self.integral = 0
+        self.last_error = None
+
+    def update(self, temperature, setpoint, status):
+        """
+        Compute the status and speed of the fan for a new temperature reading.
+
+        Args:
+            temperature (float): The temperature read.
+            setpoint (float): The temperature to keep.
+            status (int): The current status of the fan (1 for on, 0 for off).
+
+        Returns:
+            tuple: (status, speed) of the fan.
+        """
+        error = temperature - setpoint
+        if error >= CONTROL_HYSTERESIS:
+            status = 1 # Too warm, start cooling
+        elif error <= -CONTROL_HYSTERESIS:
+            status = 0 # Cool enough, stop
+            self.reset()
+
+        if status == 0:
+            return 0, MIN_SPEED
+
+        # The integral is limited so it never asks for more than full speed (anti-windup)
+        self.integral = min(max(self.integral + error * CONTROL_INTERVAL, 0), 100 / CONTROL_KI)
+        if self.last_error is None:
+            derivative = 0
+        else:
+            derivative = (error - self.last_error) / CONTROL_INTERVAL
+        self.last_error = error
+
+        output = CONTROL_KP * error + CONTROL_KI * self.integral + CONTROL_KD * derivative
+        return 1, int(min(max(output, MIN_SPEED), 100))
+
+
+class Tachometer:
+    """
+    Measures the speed of the fan from the pulses of its tachometer output. An interrupt
+    counts the pulses and the counts of the last intervals are kept in a sliding window.
+    """
+    __slots__ = ("count", "window", "index", "last_count")
+
+    def __init__(self, pin, window):
+        """
+        Args:
+            pin (Pin): The input connected to the tachometer output of the fan.
+            window (int): Number of intervals the speed is averaged over.
+        """
+        self.count = array("L", [0]) # Pulses counted by the interrupt
+        self.window = array("H", [0] * window) # Pulses of every interval of the window
+        self.index = 0
+        self.last_count = 0
+        pin.irq(trigger=Pin.IRQ_FALLING, handler=self.pulse, hard=True)
+
+    def pulse(self, pin):
+        """
+        Interrupt handler counting a pulse, it only increases the counter.
+
+        Args:
+            pin (Pin): The pin that triggered the interrupt.
+        """
+        self.count[0] += 1
+
+    def sample(self):
+        """
+        Close the current interval, moving its pulses into the window.
+        """
+        count = self.count[0]
+        self.window[self.index] = min(count - self.last_count, 65535)
+        self.last_count = count
+        self.index = (self.index + 1) % len(self.window)
+
+    def rpm(self):
+        """
+        Returns:
+            int: The speed of the fan over the window, in revolutions per minute.
+        """
+        return sum(self.window) * 60000 // (TACH_PULSES_PER_REV * len(self.window) * TACH_INTERVAL_MS)
+
+
+# Closed loop configuration
+TEMPERATURE_URL = "http://192.168.1.250/check_dht" # Temperature reading, from the temperature device
+DEFAULT_SETPOINT = 26 # Temperature in degrees the closed loop mode keeps by default
+CONTROL_INTERVAL = 10 # Seconds between two temperature readings
+CONTROL_HYSTERESIS = 1 # Degrees above the setpoint that turn the fan on, and below it that turn it off
+CONTROL_KP = 20 # Proportional gain (speed per degree)
+CONTROL_KI = 0.2 # Integral gain (speed per degree and second)
+CONTROL_KD = 10 # Derivative gain (speed per degree per second)
+CONTROL_FAILURES = 3 # Failed readings in a row after which the fan runs at full speed to be safe
+FETCH_TIMEOUT = 5 # Seconds to wait for the temperature reading
+
+# Speed configuration
+MIN_SPEED = 30 # Lowest speed the closed loop mode runs the fan at, so it does not stall
+RAMP_STEP = 2 # Change of the speed in every step of the ramp
+RAMP_INTERVAL_MS = 50 # Time in ms between two steps of the ramp
+
+# Tachometer configuration
+TACH_PULSES_PER_REV = 2 # Pulses of the tachometer in every revolution of the fan
+TACH_INTERVAL_MS = 250 # Time in ms between two samples of the pulse count
+TACH_WINDOW = 8 # Samples the speed is averaged over (2 seconds)
+RPM_HYSTERESIS = 60 # Change of the measured speed reported to the clients
+STALL_RPM = 200 # Speed below which a fan that is on is considered stopped
+STALL_MS = 3000 # Time in ms a fan that is on can stay stopped (spinning up) before it is stalled
 
 # Initialize the fan control (Pin 14) and set it to OFF
 fan = Pin(14, Pin.OUT)
 fan.off()
+state = FanState() # State of the fan served to the clients
+controller = Controller() # Controller of the closed loop mode
 
 # Initialize PWM for controlling fan speed (Pin 16)
 fan_speed = PWM(Pin(16))
 fan_speed.freq(60) # Set PWM frequency to 50Hz
+fan_speed.duty_u16(0) # The speed ramps up when the fan is turned on
+
+# Tachometer output of the fan (Pin 17), pulled up as it is open collector
+tachometer = Tachometer(Pin(17, Pin.IN, Pin.PULL_UP), TACH_WINDOW)
 
 # Thread synchronization lock
 spLock = _thread.allocate_lock()
 
+# HTTP server configuration
+PORT = 80 # Port the web server listens on
+BACKLOG = 5 # Maximum number of pending client connections
+READ_TIMEOUT = 5 # Seconds to wait for a client to send its request
+KEEPALIVE_TIMEOUT = 10 # Seconds an idle persistent connection is kept open
+MAX_REQUESTS = 100 # Requests served on a persistent connection before closing it
+MAX_REQUEST_SIZE = 1024 # Maximum size in bytes of a request (head and body)
+MAX_BATCH = 16 # Maximum number of operations in a batch request
+
+# Binary control protocol over UDP, for the updates sent continuously (such as a slider being dragged)
+UDP_ENABLED = True # Whether the UDP port is served alongside the HTTP API
+UDP_PORT = 5005 # Port the binary control messages are received on
+UDP_MAX_SIZE = 64 # Maximum size in bytes of a message
+UDP_POLL_MS = 5 # Time in ms between two polls of the UDP socket while it is idle
+UDP_MAX_CLIENTS = 8 # Clients whose last sequence number is kept
+# Handler run for every opcode: (method, endpoint, struct layout of the payload, parameters filled with the payload)
+UDP_OPCODES = {
+    1: ("POST", "change_status_fan", "", "status=on"),
+    2: ("POST", "change_status_fan", "", "status=off"),
+    3: ("POST", "toggle_fan", "", ""),
+    4: ("POST", "set_speed_fan", ">B", "speed=%d"),
+    5: ("POST", "auto_fan", ">b", "status=on&setpoint=%d"),
+    6: ("POST", "auto_fan", "", "status=off"),
+    16: ("GET", "check_status_fan", "", ""),
+}
+
+# MQTT configuration, the state is published retained and the commands are received through a broker
+MQTT_ENABLED = False # Whether to connect to the broker (needs the umqtt.simple library)
+MQTT_BROKER = "192.168.1.200" # Address of the MQTT broker
+MQTT_PORT = 1883 # Port of the MQTT broker
+MQTT_TOPIC = b"home/fan" # Prefix of the topics of this device
+MQTT_CLIENT_ID = b"fan-" + hexlify(machine.unique_id()) # Unique client identifier
+MQTT_QOS = 1 # Quality of service of the state and the commands (0 or 1)
+MQTT_KEEPALIVE = 60 # Seconds the broker waits for a message before dropping the session
+MQTT_POLL_MS = 50 # Time in ms between two checks of the session
+MQTT_BACKOFF_MIN = 1 # Seconds to wait before reconnecting after the first failure
+MQTT_BACKOFF_MAX = 60 # Maximum seconds to wait before reconnecting, doubled after every failure
+
+# Metrics configuration
+PHASES = ("receive", "parse", "lock", "handler", "send") # Phases of a request timed by the metrics
+PHASE_RECEIVE = 0 # Index of the time waiting for the rest of a request
+PHASE_PARSE = 1 # Index of the time parsing a request
+PHASE_LOCK = 2 # Index of the time waiting for spLock
+PHASE_HANDLER = 3 # Index of the time running the handler
+PHASE_SEND = 4 # Index of the time sending the reply
+METRICS_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000) # Upper bounds of the histograms
+METRICS_MAX_SERIES = 32 # Pairs of endpoint and status code counted apart, the rest are counted as 'other'
+BOOT_TIME = time() # Time of the boot in seconds, for the uptime
+
+# Content types of the replies
+CONTENT_TYPES = ("text/plain", "application/json", "text/event-stream")
+CONTENT_TEXT = 0 # Index of the plain text content type
+CONTENT_JSON = 1 # Index of the JSON content type
+CONTENT_EVENTS = 2 # Index of the Server-Sent Events content type
+
+# Identifier of this boot in the ETag of the state, so tags from before a restart never match
+BOOT_ID = str(getrandbits(24))
+
+# Receive buffers reused across connections
+buffer_pool = [bytearray(MAX_REQUEST_SIZE) for _ in range(BACKLOG)]
+
+# Events configuration
+EVENT_QUEUE_SIZE = 8 # Pending events kept for a slow subscriber, the oldest ones are dropped
+MAX_SUBSCRIBERS = 4 # Maximum number of clients streaming events or long-polling at once
+LONG_POLL_MAX = 60 # Maximum seconds a long-poll request waits for a change
+EVENTS_PING = 15 # Seconds between the comments that keep an idle event stream open
+
+# Button configuration
+DEBOUNCE_MS = 30 # Time in ms the button contacts need to settle
+LONG_PRESS_MS = 1000 # Minimum time in ms the button is held for a long press
+DOUBLE_PRESS_MS = 300 # Maximum time in ms between the two presses of a double press
+
 
 def connect():
     """
@@ -45,69 +361,225 @@ def connect():
     return ip
     
 
-def open_socket(ip):
+def build_header_table(statuses):
     """
-    Open a socket for communication.
+    Pre-encode the headers of the replies for every status code and content type.
 
     Args:
-        ip (str): The IP address of the device.
+        statuses (tuple): Pairs of (status_code, reason) for the status codes used.
 
     Returns:
-        socket: The opened socket for communication.
+        dict: For each status code, a list indexed by content type with the encoded
+              headers up to the value of the Content-Length header.
     """
-    address = (ip, 80) # IP address and port for the socket
-    connection = socket.socket() # Create a new socket
-    connection.bind(address) # Bind the socket to the address
-    connection.listen(1) # Listen for incoming connections
+    table = {}
+    for status_code, reason in statuses:
+        table[status_code] = [("HTTP/1.1 " + str(status_code) + " " + reason + "\r\n"
+                               + "Content-Type: " + content_type + "\r\n"
+                               + "Access-Control-Allow-Origin: *\r\n"
+                               + "Content-Length: ").encode() for content_type in CONTENT_TYPES]
+    return table
 
-    return connection
 
+# Pre-encoded headers of the replies
+response_headers = build_header_table(((200, "OK"), (400, "Bad Request"), (405, "Method Not Allowed"), (500, "Internal Server Error"), (503, "Service Unavailable")))
+KEEP_ALIVE_END = ("\r\nConnection: keep-alive\r\nKeep-Alive: timeout=" + str(KEEPALIVE_TIMEOUT) \
+    + ", max=" + str(MAX_REQUESTS) + "\r\n\r\n").encode()
+CLOSE_END = b"\r\nConnection: close\r\n\r\n"
+ETAG_HEADER = b"\r\nETag: "
+NOT_MODIFIED_HEAD = b"HTTP/1.1 304 Not Modified\r\nAccess-Control-Allow-Origin: *\r\nETag: " # 304 replies have no body nor length
 
-def status_code_set(status_code):
+# Pre-encoded headers of the Server-Sent Events stream, which lasts until the connection closes
+EVENTS_HEAD = response_headers[200][CONTENT_EVENTS].replace(b"Content-Length: ", b"Cache-Control: no-cache") + CLOSE_END
+
+
+def build_response(status_code, content_type, data, keep_alive, etag=None):
     """
-    Generate HTTP status response based on the given status code.
+    Build a complete HTTP reply from the pre-encoded headers.
 
     Args:
-        status_code (int): The HTTP status code (200, 400, 405, 500).
+        status_code (int): The HTTP status code (200, 304, 400, 405, 500, 503).
+        content_type (int): The content type of the data (CONTENT_TEXT or CONTENT_JSON).
+        data (bytes): The data sent after the headers.
+        keep_alive (bool): Whether the connection is kept open after the reply.
+        etag (bytes): The tag of the state sent in the ETag header, or None.
 
     Returns:
-        str: The corresponding HTTP status response.
+        bytes: The headers followed by the data, to be sent with a single write.
     """
-    if status_code == 200:
-        status_send = "HTTP/1.0 200 OK\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 400:
-        status_send = "HTTP/1.0 400 Bad Request\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 405:
-        status_send = "HTTP/1.0 405 Method Not Allowed\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 500:
-        status_send = "HTTP/1.0 500 Internal Server Error\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
+    if keep_alive:
+        headers_end = KEEP_ALIVE_END
+    else:
+        headers_end = CLOSE_END
 
-    return status_send
+    if etag is None:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), headers_end, data))
+    elif status_code == 304:
+        return b"".join((NOT_MODIFIED_HEAD, etag, headers_end))
+    else:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), ETAG_HEADER, etag, headers_end, data))
 
 
-def request_data_extractor(request):
+@micropython.viper
+def find_byte(buffer, start: int, end: int, byte: int) -> int:
     """
-    Extract the HTTP method, endpoint, and parameters from the request.
+    Find the first occurrence of a byte in buffer[start:end].
 
     Args:
-        request (str): The raw HTTP request string.
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+        byte (int): The byte value to look for.
 
     Returns:
-        tuple: (method, endpoint, parameters) extracted from the request.
+        int: The position of the byte, or -1 if it is not found.
     """
-    request = request.split()
-    method = request[0][2:] # Extract the HTTP method (e.g., GET, POST)
-    request = request[1].split("/")
-    request = request[1].split("?")
-    endpoint = request[0] # Extract the endpoint
-    
-    # Extract parameters (if any)
-    if len(request) == 1:
+    data = ptr8(buffer)
+    position = start
+    while position < end:
+        if data[position] == byte:
+            return position
+        position += 1
+    return -1
+
+
+@micropython.viper
+def find_head_end(buffer, start: int, end: int) -> int:
+    """
+    Find the blank line that ends the head of a request in buffer[start:end].
+
+    Args:
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+
+    Returns:
+        int: The position of the blank line, or -1 if it is not found.
+    """
+    data = ptr8(buffer)
+    position = start
+    while position + 3 < end:
+        if data[position] == 13 and data[position + 1] == 10 \
+            and data[position + 2] == 13 and data[position + 3] == 10:
+            return position
+        position += 1
+    return -1
+
+
+@micropython.viper
+def header_matches(buffer, start: int, end: int, name) -> bool:
+    """
+    Compare buffer[start:end] with a lowercase name, ignoring the case of the buffer.
+
+    Args:
+        buffer (bytearray): The buffer holding the header.
+        start (int): Position where the header name or value starts.
+        end (int): Position where the header name or value ends.
+        name (bytes): The lowercase name to compare with (e.g., b"connection").
+
+    Returns:
+        bool: True if both are equal, False otherwise.
+    """
+    length = int(len(name))
+    if end - start != length:
+        return False
+    data = ptr8(buffer)
+    expected = ptr8(name)
+    index = 0
+    while index < length:
+        if (data[start + index] | 0x20) != expected[index]:
+            return False
+        index += 1
+    return True
+
+
+def parse_request(buffer, start, end):
+    """
+    Parse the request stored in buffer[start:end] without copying the buffer.
+
+    Args:
+        buffer (bytearray): The receive buffer of the connection.
+        start (int): Position where the request starts.
+        end (int): Position where the received data ends.
+
+    Returns:
+        tuple: (method, endpoint, parameters, body, size, keep_alive, if_none_match) where
+               body is a memoryview over the buffer, size is the length of the whole request
+               and if_none_match the value of the If-None-Match header (None if missing),
+               or None if the request has not been completely received yet.
+
+    Raises:
+        ValueError: If the request is malformed or does not fit in the buffer.
+    """
+    head_end = find_head_end(buffer, start, end)
+    if head_end < 0:
+        if end - start >= MAX_REQUEST_SIZE:
+            raise ValueError("Request too large")
+        return None # Wait for the rest of the head
+    view = memoryview(buffer)
+
+    # Request line (e.g., "POST /endpoint?key=value HTTP/1.1")
+    line_end = find_byte(buffer, start, head_end + 2, 13)
+    method_end = find_byte(buffer, start, line_end, 32)
+    if method_end < 0:
+        raise ValueError("Malformed request line")
+    target_end = find_byte(buffer, method_end + 1, line_end, 32)
+    if target_end < 0 or buffer[method_end + 1] != 47:
+        raise ValueError("Malformed request line")
+    method = str(view[start:method_end], "utf-8") # Extract HTTP method (GET, POST, etc.)
+    query = find_byte(buffer, method_end + 2, target_end, 63)
+    if query < 0:
+        endpoint = str(view[method_end + 2:target_end], "utf-8") # Extract endpoint
         parameters = None
     else:
-        parameters = request[1]
-    
-    return method, endpoint, parameters
+        endpoint = str(view[method_end + 2:query], "utf-8") # Extract endpoint
+        parameters = str(view[query + 1:target_end], "utf-8") # Extract parameters
+
+    # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones must ask for it
+    keep_alive = buffer[line_end - 1] == 49
+    length = 0
+    if_none_match = None
+
+    # Headers, only the ones needed by the server are looked at
+    position = line_end + 2
+    while position < head_end:
+        line_end = find_byte(buffer, position, head_end + 2, 13)
+        colon = find_byte(buffer, position, line_end, 58)
+        if colon > 0:
+            value = colon + 1
+            while value < line_end and buffer[value] == 32:
+                value += 1
+            if header_matches(buffer, position, colon, b"content-length"):
+                length = int(str(view[value:line_end], "utf-8"))
+            elif header_matches(buffer, position, colon, b"connection"):
+                keep_alive = header_matches(buffer, value, line_end, b"keep-alive")
+            elif header_matches(buffer, position, colon, b"if-none-match"):
+                if_none_match = bytes(view[value:line_end])
+        position = line_end + 2
+
+    body = head_end + 4
+    size = body + length - start
+    if size > MAX_REQUEST_SIZE:
+        raise ValueError("Request too large")
+    if start + size > end:
+        return None # Wait for the rest of the body
+
+    return method, endpoint, parameters, view[body:body + length], size, keep_alive, if_none_match
+
+
+def not_modified(if_none_match):
+    """
+    Check whether the client already has the current state, from the tags it sent.
+
+    Args:
+        if_none_match (bytes): The value of the If-None-Match header, or None.
+
+    Returns:
+        bool: True if one of the tags sent is the tag of the current state.
+    """
+    if if_none_match is None:
+        return False
+    return if_none_match == b"*" or state.etag() in if_none_match
 
 
 def change_status_fan(method, parameters):
@@ -134,10 +606,12 @@ def change_status_fan(method, parameters):
                 status = None
                 status_code = 400 # Bad request if status not found
             if status == 'on':
-                fan.on() # Turn the fan ON
+                state.set_auto(0, state.setpoint) # Manual commands stop the closed loop mode
+                state.set_status(1) # Turn the fan ON
                 status_code = 200 # OK status
             elif status == 'off':
-                fan.off() # Turn the fan OFF
+                state.set_auto(0, state.setpoint)
+                state.set_status(0) # Turn the fan OFF
                 status_code = 200 # OK status
             else:
                 status_code = 400 # Bad request for invalid status
@@ -160,7 +634,8 @@ def toggle_fan(method):
         int: The corresponding HTTP status code.
     """
     if method == 'POST':
-        fan.toggle() # Toggle fan status
+        state.set_auto(0, state.setpoint) # Manual commands stop the closed loop mode
+        state.set_status(1 - state.status) # Toggle fan status
         status_code = 200 # OK status
     else:
         status_code = 405 # Method not allowed (only POST allowed)
@@ -168,22 +643,263 @@ def toggle_fan(method):
     return status_code
 
 
-def check_status_fan(method):
+def set_speed_fan(method, parameters):
+    """
+    Set the speed of the fan, which ramps smoothly to it.
+
+    Args:
+        method (str): The HTTP method used (should be 'POST').
+        parameters (str): The parameters provided in the request (speed from 0 to 100).
+
+    Returns:
+        int: The corresponding HTTP status code.
+    """
+    if method == 'POST':
+        try:
+            parameters = parameters.split("&") # Split parameters by "&"
+            speed = None
+            for parameter in parameters:
+                key, value = parameter.split("=")
+                if key == "speed":
+                    speed = int(value) # Extract the speed
+            if speed != None and speed >= 0 and speed <= 100:
+                state.set_auto(0, state.setpoint) # Manual commands stop the closed loop mode
+                state.set_speed(speed)
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad request for a missing or invalid speed
+        except:
+            status_code = 400 # Bad request if an error occurs
+    else:
+        status_code = 405 # Method not allowed (only POST allowed)
+
+    return status_code
+
+
+def auto_fan(method, parameters):
+    """
+    Start or stop the closed loop mode, where the temperature read from TEMPERATURE_URL
+    controls the fan.
+
+    Args:
+        method (str): The HTTP method used (should be 'POST').
+        parameters (str): The parameters provided in the request (status on/off and optional setpoint).
+
+    Returns:
+        int: The corresponding HTTP status code.
+    """
+    if method == 'POST':
+        try:
+            parameters = parameters.split("&") # Split parameters by "&"
+            status = None
+            setpoint = state.setpoint
+            for parameter in parameters:
+                key, value = parameter.split("=")
+                if key == "status":
+                    status = value # Extract the status (on/off)
+                elif key == "setpoint":
+                    setpoint = float(value) # Extract the temperature to keep
+            if status == 'on':
+                if state.auto == 0:
+                    controller.reset()
+                state.set_auto(1, setpoint)
+                status_code = 200 # OK status
+            elif status == 'off':
+                state.set_auto(0, setpoint)
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad request for invalid status
+        except:
+            status_code = 400 # Bad request if an error occurs
+    else:
+        status_code = 405 # Method not allowed (only POST allowed)
+
+    return status_code
+
+
+async def ramp_fan():
+    """
+    Task that moves the PWM duty cycle of the fan towards its speed in small steps,
+    so the fan speeds up and slows down smoothly.
+    """
+    current = 0 # Speed applied to the PWM
+    while True:
+        if state.status == 1:
+            target = state.speed
+        else:
+            target = 0
+        if current != target:
+            if current < target:
+                current = min(current + RAMP_STEP, target)
+            else:
+                current = max(current - RAMP_STEP, target)
+            fan_speed.duty_u16(current * 65535 // 100)
+        await asyncio.sleep_ms(RAMP_INTERVAL_MS)
+
+
+async def measure_fan():
+    """
+    Task that measures the speed of the fan from the tachometer and detects when the fan
+    is on but does not spin.
+    """
+    stopped_since = None # When the fan was last seen stopped while on
+    while True:
+        await asyncio.sleep_ms(TACH_INTERVAL_MS)
+        tachometer.sample()
+        rpm = tachometer.rpm()
+        spLock.acquire()
+        try:
+            # Small changes are not reported, so the clients are not flooded with events
+            if abs(rpm - state.rpm) >= RPM_HYSTERESIS or (rpm == 0) != (state.rpm == 0):
+                state.set_rpm(rpm)
+
+            if state.status == 1 and state.speed > 0 and rpm < STALL_RPM:
+                if stopped_since is None:
+                    stopped_since = ticks_ms()
+                elif ticks_diff(ticks_ms(), stopped_since) >= STALL_MS:
+                    state.set_stalled(1)
+            else:
+                stopped_since = None
+                state.set_stalled(0)
+            notify_change()
+        finally:
+            spLock.release()
+
+
+def split_url(url):
+    """
+    Split an HTTP URL into the parts needed to request it.
+
+    Args:
+        url (str): The URL (e.g., "http://192.168.1.250/check_dht").
+
+    Returns:
+        tuple: (host, port, path) of the URL.
+    """
+    address, path = (url.split("://", 1)[1] + "/").split("/", 1)
+    if ":" in address:
+        host, port = address.split(":")
+        port = int(port)
+    else:
+        host = address
+        port = 80
+    return host, port, "/" + path.rstrip("/")
+
+
+async def read_temperature():
+    """
+    Fetch the temperature from TEMPERATURE_URL, which replies with the JSON of '/check_dht'.
+
+    Returns:
+        float: The temperature read, or None if it could not be read.
+    """
+    host, port, path = temperature_source
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), FETCH_TIMEOUT)
+        writer.write(("GET " + path + " HTTP/1.0\r\nHost: " + host + "\r\n\r\n").encode())
+        await writer.drain()
+
+        # HTTP/1.0 replies end when the connection closes
+        response = b""
+        while len(response) < 1024:
+            chunk = await asyncio.wait_for(reader.read(256), FETCH_TIMEOUT)
+            if not chunk:
+                break
+            response += chunk
+
+        head, body = response.split(b"\r\n\r\n", 1)
+        if head.split(b" ")[1] != b"200":
+            return None
+        return float(json.loads(body)["temperature"])
+    except Exception as e:
+        print(e) # Temperature device unreachable or invalid reply
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+            await writer.wait_closed()
+
+
+async def control_fan():
+    """
+    Task that reads the temperature periodically while the closed loop mode is on,
+    and sets the status and speed of the fan from it.
+    """
+    failures = 0
+    while True:
+        if state.auto == 1:
+            temperature = await read_temperature()
+            spLock.acquire()
+            try:
+                if state.auto == 1:
+                    if temperature is not None:
+                        failures = 0
+                        status, speed = controller.update(temperature, state.setpoint, state.status)
+                        state.set_status(status)
+                        state.set_speed(speed)
+                    else:
+                        failures += 1
+                        if failures >= CONTROL_FAILURES:
+                            state.set_status(1) # Without readings, cool at full speed to be safe
+                            state.set_speed(100)
+                    notify_change()
+            finally:
+                spLock.release()
+        else:
+            failures = 0
+        await asyncio.sleep(CONTROL_INTERVAL)
+
+
+# Host, port and path the temperature is read from
+temperature_source = split_url(TEMPERATURE_URL)
+
+
+def check_metrics(method):
+    """
+    Handles the 'metrics' endpoint, which returns the counters of the web server.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+
+    Returns:
+        status_code (int): The HTTP status code (200 or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The metrics in the Prometheus text format.
+    """
+    if method == 'GET':
+        data_send = True
+        data = metrics.text()
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only GET is allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
+
+
+def check_status_fan(method, if_none_match):
     """
     Check the current status of the fan and return it.
 
     Args:
         method (str): The HTTP method used (should be 'GET').
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
 
     Returns:
         tuple: (status_code, data_send, data) where status_code is HTTP status, 
-               data_send is a flag if data should be sent, and data is the fan status.
+               data_send is a flag if data should be sent, and data is the fan status as JSON bytes.
     """
     if method == 'GET':
-        status = fan.value() # Get fan status (on/off)
-        data_send = True
-        data = str(status) # Convert fan status to string
-        status_code = 200 # OK status
+        if not_modified(if_none_match):
+            data_send = False
+            data = None
+            status_code = 304 # Not Modified, the client already has the current state
+        else:
+            data_send = True
+            data = state.json() # Fan status as cached JSON
+            status_code = 200 # OK status
     else:
         status_code = 405 # Method not allowed (only GET allowed)
         data_send = False
@@ -192,79 +908,725 @@ def check_status_fan(method):
     return status_code, data_send, data
         
 
-def serve(connection):
+
+class Subscriber:
+    """
+    Bounded queue of the state change events waiting to be sent to a client.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size (int): Maximum number of pending events, the oldest ones are dropped.
+        """
+        self.size = size
+        self.queue = []
+        self.event = asyncio.Event()
+
+    def put(self, event):
+        """
+        Queue an event, dropping the oldest one if the client is too slow.
+
+        Args:
+            event (bytes): The encoded event.
+        """
+        if len(self.queue) >= self.size:
+            self.queue.pop(0)
+        self.queue.append(event)
+        self.event.set()
+
+    async def get(self, timeout):
+        """
+        Wait for the next event.
+
+        Args:
+            timeout (int): Maximum seconds to wait.
+
+        Returns:
+            bytes: The encoded event, or None if none arrived in time.
+        """
+        if not self.queue:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.pop(0)
+
+
+def notify_change():
+    """
+    Send the state to the subscribers as an event if it changed since the last one.
+    """
+    global last_version
+    if state.version != last_version:
+        last_version = state.version
+        event = b"data: " + state.json() + b"\n\n" # Encoded once for every subscriber
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+async def wait_for_change(parameters):
+    """
+    Hold a long-poll request until the state changes or its 'wait' time passes.
+
+    Args:
+        parameters (str): The request parameters, the seconds to wait are in 'wait'.
+    """
+    wait = 0
+    try:
+        for parameter in parameters.split("&"):
+            key, value = parameter.split("=")
+            if key == "wait":
+                wait = min(int(value), LONG_POLL_MAX)
+    except:
+        return # Invalid parameters are left to the handler
+    if wait <= 0 or len(subscribers) >= MAX_SUBSCRIBERS:
+        return
+
+    subscriber = Subscriber(1)
+    subscribers.append(subscriber)
+    try:
+        await subscriber.get(wait)
+    finally:
+        subscribers.remove(subscriber)
+
+
+async def stream_events(writer):
+    """
+    Stream the state changes to the client as Server-Sent Events until it disconnects.
+
+    Args:
+        writer (StreamWriter): The stream to send the events to.
+    """
+    subscriber = Subscriber(EVENT_QUEUE_SIZE)
+    subscribers.append(subscriber)
+    try:
+        writer.write(EVENTS_HEAD)
+        writer.write(b"data: " + state.json() + b"\n\n") # Start with the current state
+        await writer.drain()
+        while True:
+            event = await subscriber.get(EVENTS_PING)
+            if event is None:
+                writer.write(b": ping\n\n")
+            else:
+                writer.write(event)
+            await writer.drain()
+    finally:
+        subscribers.remove(subscriber)
+
+
+# Clients waiting for state changes and the version of the last state sent to them
+subscribers = []
+last_version = -1
+
+
+def dispatch(method, endpoint, parameters, if_none_match):
     """
-    Start a web server to handle client requests for controlling the fan.
+    Run the handler of an endpoint. The caller holds spLock.
 
     Args:
-        connection (socket): The socket connection to handle.
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply.
     """
     data_send = False
+    data = None
+    content_type = CONTENT_TEXT
+    etag = None
+
+    if endpoint == 'change_status_fan':
+        status_code = change_status_fan(method, parameters)
+
+    elif endpoint == 'toggle_fan':
+        status_code = toggle_fan(method)
+
+    elif endpoint == 'set_speed_fan':
+        status_code = set_speed_fan(method, parameters)
+
+    elif endpoint == 'auto_fan':
+        status_code = auto_fan(method, parameters)
+
+    elif endpoint == 'check_status_fan':
+        status_code, data_send, data = check_status_fan(method, if_none_match)
+        content_type = CONTENT_JSON
+        if status_code == 200 or status_code == 304:
+            etag = state.etag()
+
+    elif endpoint == 'metrics':
+        status_code, data_send, data = check_metrics(method)
+
+    else:
+        status_code = 400 # Bad request for invalid endpoints
+
+    if data_send == False:
+        data = b""
+
+    return status_code, content_type, data, etag
+
+
+def run_batch(method, body):
+    """
+    Runs a list of operations one after the other and gathers their replies, so a client can
+    change several values and read the state in one request. The caller holds spLock.
+
+    Args:
+        method (str): The HTTP method (only accepts 'POST').
+        body (memoryview): JSON list of the operations, each one an object with the endpoint
+                           ('op'), and optionally its parameters ('params', a query string or
+                           an object) and its HTTP method ('method', 'POST' by default).
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+        data (bytes): JSON list with the status code of every operation and its reply if any.
+    """
+    if method != 'POST':
+        return 405, b"" # Method Not Allowed (only POST is allowed)
+
+    # Check the whole list before running anything, so a malformed batch changes nothing
+    try:
+        operations = []
+        for operation in json.loads(bytes(body)):
+            parameters = operation.get("params", "")
+            if isinstance(parameters, dict):
+                parameters = "&".join([key + "=" + str(value) for key, value in parameters.items()])
+            operations.append((operation.get("method", "POST"), operation["op"], parameters))
+    except:
+        return 400, b"" # Bad Request
+    if len(operations) == 0 or len(operations) > MAX_BATCH:
+        return 400, b"" # Bad Request
+
+    results = []
+    for method, endpoint, parameters in operations:
+        if endpoint == 'batch':
+            status_code = 400 # Bad Request, batches can not be nested
+            content_type = CONTENT_TEXT
+            data = b""
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None)
+        result = b'{"op": ' + json.dumps(endpoint).encode() + b', "status": ' + str(status_code).encode()
+        if content_type == CONTENT_JSON and len(data) > 0:
+            result += b', "data": ' + data
+        results.append(result + b"}")
+
+    return 200, b"[" + b", ".join(results) + b"]"
+
+
+def route_request(method, endpoint, parameters, body, if_none_match):
+    """
+    Route the request to the appropriate handler based on the endpoint.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        body (memoryview): The body of the request.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply.
+    """
+    started = ticks_us()
+
+    spLock.acquire() # Lock to avoid race conditions
+    locked = ticks_us()
+    metrics.observe(PHASE_LOCK, ticks_diff(locked, started))
+    try:
+        if endpoint == 'batch':
+            status_code, data = run_batch(method, body) # Every operation runs under this single lock
+            content_type = CONTENT_JSON
+            etag = None
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, if_none_match)
+
+        notify_change() # Send the new state to the subscribers if it changed, once for a whole batch
+    finally:
+        spLock.release() # Release the lock
+    metrics.observe(PHASE_HANDLER, ticks_diff(ticks_us(), locked))
+
+    return status_code, content_type, data, etag
+
+
+class Metrics:
+    """
+    Lightweight counters of the web server, served in the Prometheus text format by '/metrics'.
+    The time of every phase of the requests is counted in a histogram of fixed buckets, so
+    recording it only increases two numbers.
+    """
+    __slots__ = ("counts", "sums", "requests", "connections")
+
+    def __init__(self):
+        # Times counted in every bucket of every phase, the last bucket is above all the bounds
+        self.counts = [[0] * (len(METRICS_BUCKETS_US) + 1) for _ in PHASES]
+        self.sums = [0] * len(PHASES) # Total time in us of every phase
+        self.requests = {} # Requests answered for every pair of endpoint and status code
+        self.connections = 0 # Connections accepted
+
+    def observe(self, phase, us):
+        """
+        Count the time taken by a phase of a request.
+
+        Args:
+            phase (int): The index of the phase in PHASES.
+            us (int): The time taken in us.
+        """
+        index = 0
+        for bound in METRICS_BUCKETS_US:
+            if us <= bound:
+                break
+            index += 1
+        self.counts[phase][index] += 1
+        self.sums[phase] += us
+
+    def count(self, endpoint, status_code):
+        """
+        Count a request answered.
+
+        Args:
+            endpoint (str): The requested endpoint, None if the request was malformed.
+            status_code (int): The HTTP status code of the reply.
+        """
+        key = (endpoint or "", status_code)
+        if key not in self.requests and len(self.requests) >= METRICS_MAX_SERIES:
+            key = ("other", status_code) # Endpoints sent by the clients could fill the memory
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def text(self):
+        """
+        Format the metrics in the Prometheus text format.
+
+        Returns:
+            bytes: One line for every value, with the histograms in us.
+        """
+        lines = ["# HELP request_phase_us Time spent in every phase of the requests in us",
+                 "# TYPE request_phase_us histogram"]
+        for phase in range(len(PHASES)):
+            label = 'request_phase_us_bucket{phase="' + PHASES[phase] + '",le="'
+            counts = self.counts[phase]
+            total = 0
+            for index in range(len(METRICS_BUCKETS_US)):
+                total += counts[index]
+                lines.append(label + str(METRICS_BUCKETS_US[index]) + '"} ' + str(total))
+            total += counts[-1]
+            lines.append(label + '+Inf"} ' + str(total))
+            lines.append('request_phase_us_sum{phase="' + PHASES[phase] + '"} ' + str(self.sums[phase]))
+            lines.append('request_phase_us_count{phase="' + PHASES[phase] + '"} ' + str(total))
+
+        lines.append("# HELP requests_total Requests answered by endpoint and status code")
+        lines.append("# TYPE requests_total counter")
+        for key, value in self.requests.items():
+            endpoint = key[0].replace("\\", "\\\\").replace('"', '\\"') # Escaped for the label
+            lines.append('requests_total{endpoint="' + endpoint + '",status="' + str(key[1]) + '"} ' + str(value))
+
+        lines.append("# HELP connections_total Connections accepted")
+        lines.append("# TYPE connections_total counter")
+        lines.append("connections_total " + str(self.connections))
+        lines.append("# HELP memory_free_bytes Free memory of the heap")
+        lines.append("# TYPE memory_free_bytes gauge")
+        lines.append("memory_free_bytes " + str(gc.mem_free()))
+        lines.append("# HELP memory_allocated_bytes Allocated memory of the heap")
+        lines.append("# TYPE memory_allocated_bytes gauge")
+        lines.append("memory_allocated_bytes " + str(gc.mem_alloc()))
+        lines.append("# HELP uptime_seconds Time since the boot")
+        lines.append("# TYPE uptime_seconds gauge")
+        lines.append("uptime_seconds " + str(time() - BOOT_TIME))
+        return ("\n".join(lines) + "\n").encode()
+
+
+metrics = Metrics() # Counters of the web server
+
+
+async def receive_into(reader, view):
+    """
+    Receive data from the client directly into a preallocated buffer.
+
+    Args:
+        reader (StreamReader): The stream to receive the data from.
+        view (memoryview): The free part of the receive buffer.
+
+    Returns:
+        int: The number of bytes received, 0 if the connection was closed.
+    """
+    if hasattr(reader, "readinto"):
+        return await reader.readinto(view)
+    chunk = await reader.read(len(view)) # CPython streams have no readinto()
+    view[:len(chunk)] = chunk
+    return len(chunk)
+
+
+async def handle_client(reader, writer):
+    """
+    Handle a persistent client connection, answering pipelined requests in order.
+
+    Args:
+        reader (StreamReader): The stream to receive the requests from.
+        writer (StreamWriter): The stream to send the replies to.
+    """
+    # Requests are received into a preallocated buffer and parsed in place
+    buffer = buffer_pool.pop() if buffer_pool else bytearray(MAX_REQUEST_SIZE)
+    view = memoryview(buffer)
+    start = 0 # Position of the next request in the buffer
+    end = 0 # Position where the received data ends
+    served = 0
+    keep_alive = True
+    metrics.connections += 1
+    try:
+        while keep_alive:
+            parsing = ticks_us()
+            try:
+                request = parse_request(buffer, start, end)
+            except ValueError as e:
+                print(e) # Malformed request, reply and close the connection
+                request = (None, None, None, None, end - start, False, None)
+
+            if request is None:
+                # Move the partial request to the front of the buffer and receive the rest
+                if start > 0:
+                    view[:end - start] = view[start:end]
+                    end -= start
+                    start = 0
+                timeout = READ_TIMEOUT if end else KEEPALIVE_TIMEOUT
+                waiting = ticks_us()
+                received = await asyncio.wait_for(receive_into(reader, view[end:]), timeout)
+                if not received:
+                    return # Connection closed by the client
+                if end:
+                    metrics.observe(PHASE_RECEIVE, ticks_diff(ticks_us(), waiting)) # Not the idle time between requests
+                end += received
+                continue
+
+            metrics.observe(PHASE_PARSE, ticks_diff(ticks_us(), parsing))
+
+            method, endpoint, parameters, body, size, keep_alive, if_none_match = request
+            start += size
+            if start == end:
+                start = end = 0
+            served += 1
+            if served >= MAX_REQUESTS:
+                keep_alive = False
+            print(method, endpoint, parameters)
+
+            if endpoint == 'events':
+                # Server-Sent Events keep the connection until the client leaves
+                if method != 'GET':
+                    status_code, content_type, data, etag = 405, CONTENT_TEXT, b"", None
+                elif len(subscribers) >= MAX_SUBSCRIBERS:
+                    status_code, content_type, data, etag = 503, CONTENT_TEXT, b"", None
+                else:
+                    metrics.count(endpoint, 200)
+                    await stream_events(writer)
+                    break
+            else:
+                # Long-poll requests ('wait' parameter) are answered on the next change
+                if endpoint == 'check_status_fan' and parameters != None:
+                    await wait_for_change(parameters)
+                status_code, content_type, data, etag = route_request(method, endpoint, parameters, body, if_none_match)
+
+            metrics.count(endpoint, status_code)
+
+            # Send HTTP status code and data in a single write
+            sending = ticks_us()
+            writer.write(build_response(status_code, content_type, data, keep_alive, etag))
+
+            # Replies to pipelined requests are flushed together
+            if not keep_alive or find_head_end(buffer, start, end) < 0:
+                await writer.drain()
+            metrics.observe(PHASE_SEND, ticks_diff(ticks_us(), sending))
+    except Exception as e:
+        print(e) # Timed out or connection lost
+    finally:
+        if len(buffer_pool) < BACKLOG:
+            buffer_pool.append(buffer) # Keep the buffer for the next connection
+        writer.close() # Close the client connection
+        await writer.wait_closed()
+
+
+def run_opcode(opcode, payload):
+    """
+    Run the handler of a binary control message, as an HTTP request to the same endpoint would.
+
+    Args:
+        opcode (int): The operation, a key of UDP_OPCODES.
+        payload (memoryview): The values of the operation, packed as its layout tells.
+
+    Returns:
+        status_code (int): The HTTP status code of the handler (400 for unknown or malformed messages).
+        data (bytes): The JSON reply of the handler, empty if it has none.
+    """
+    if opcode not in UDP_OPCODES:
+        return 400, b"" # Bad Request for unknown opcodes
+    method, endpoint, layout, template = UDP_OPCODES[opcode]
+    try:
+        parameters = template % struct.unpack(layout, payload)
+    except:
+        return 400, b"" # Bad Request, the payload does not fit the layout
+
+    spLock.acquire() # Lock to avoid race conditions
+    try:
+        status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None)
+        notify_change() # Send the new state to the subscribers if it changed
+    finally:
+        spLock.release() # Release the lock
+
+    return status_code, data
+
+
+async def serve_udp(ip):
+    """
+    Serve the binary control messages received on the UDP port, polling the socket between the
+    other tasks. A message holds the opcode (1 byte), a sequence number (2 bytes, big-endian, one
+    more for every message of the client) and the payload. Messages older than the last one of the
+    same client are dropped, and the rest are answered with the opcode, the sequence number, the
+    HTTP status code (2 bytes, big-endian) and the JSON reply if any.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(socket.getaddrinfo(ip, UDP_PORT)[0][-1])
+    sock.setblocking(False)
+    sequences = {} # Last sequence number received from every client
+
     while True:
-        client = connection.accept()[0] # Accept a client connection
-        request = client.recv(1024) # Receive the request
-        request = str(request)
-        print(request)
         try:
-            method, endpoint, parameters = request_data_extractor(request) # Extract request details
-        except:
-            endpoint = None 
-        
-        spLock.acquire() # Lock to avoid race conditions
+            packet, address = sock.recvfrom(UDP_MAX_SIZE)
+        except OSError:
+            await asyncio.sleep_ms(UDP_POLL_MS) # Nothing received
+            continue
+        if len(packet) < 3:
+            continue # Too short to be a message
 
-        # Route the request to the appropriate handler based on the endpoint
-        if endpoint == 'change_status_fan':
-            status_code = change_status_fan(method, parameters)
+        # Drop the messages overtaken by a newer one, a client starts again from 0 after a restart
+        opcode = packet[0]
+        sequence = packet[1] << 8 | packet[2]
+        last = sequences.get(address)
+        if last is not None and sequence != 0 and not 0 < (sequence - last) & 0xFFFF < 0x8000:
+            continue
+        if last is None and len(sequences) >= UDP_MAX_CLIENTS:
+            sequences.clear() # Forget the clients gone quiet
+        sequences[address] = sequence
 
-        elif endpoint == 'toggle_fan':
-            status_code = toggle_fan(method)
-        
-        elif endpoint == 'check_status_fan':
-            status_code, data_send, data = check_status_fan(method)
+        status_code, data = run_opcode(opcode, memoryview(packet)[3:])
+        try:
+            sock.sendto(struct.pack(">BHH", opcode, sequence, status_code) + data, address)
+        except OSError:
+            pass # The reply is lost like any datagram, the next message carries the new state anyway
+        await asyncio.sleep_ms(0) # Let the other tasks run between two messages
 
-        else:
-            status_code = 400 # Bad request for invalid endpoints
 
+def mqtt_command(topic, message):
+    """
+    Run a command received from the broker, as a POST request to the endpoint named by the last
+    level of its topic would.
+
+    Args:
+        topic (bytes): The topic of the command, '<MQTT_TOPIC>/cmd/<endpoint>'.
+        message (bytes): The parameters of the command, such as 'status=on'.
+    """
+    endpoint = topic[len(MQTT_TOPIC) + 5:].decode()
+    try:
+        parameters = message.decode()
+    except:
+        return # Not text, ignored like a malformed request
+
+    spLock.acquire() # Lock to avoid race conditions
+    try:
+        status_code, content_type, data, etag = dispatch("POST", endpoint, parameters, None)
+        notify_change() # Send the new state to the subscribers if it changed
+    finally:
         spLock.release() # Release the lock
 
-        # Send HTTP response status
-        client.send(status_code_set(status_code))
-        
-        # Send data if needed
-        if data_send == True:
-            client.send(data)
-            data_send = False
-        
-        client.close() # Close the client connection
-        
+    if status_code != 200:
+        print("MQTT command", endpoint, "failed with", status_code)
+
 
-def button_task():
+async def run_mqtt():
     """
-    Task to toggle fan status using a physical button press.
+    Keep a session with the MQTT broker: publish the state retained on '<MQTT_TOPIC>/state' every
+    time it changes and run the commands received on '<MQTT_TOPIC>/cmd/<endpoint>', reconnecting
+    with an increasing backoff when the broker is lost. The retained '<MQTT_TOPIC>/online' topic
+    tells whether the device is connected.
     """
+    backoff = MQTT_BACKOFF_MIN
+    while True:
+        client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        try:
+            client.set_callback(mqtt_command)
+            client.set_last_will(MQTT_TOPIC + b"/online", b"0", True)
+            client.connect()
+            client.publish(MQTT_TOPIC + b"/online", b"1", True)
+            client.subscribe(MQTT_TOPIC + b"/cmd/+", MQTT_QOS)
+            backoff = MQTT_BACKOFF_MIN
+            published = -1 # Version of the state last published
+            last_sent = ticks_ms()
+
+            while True:
+                client.check_msg() # Run the commands received, if any
+                if state.version != published:
+                    spLock.acquire() # Lock to avoid race conditions
+                    try:
+                        published = state.version
+                        message = state.json()
+                    finally:
+                        spLock.release() # Release the lock
+                    client.publish(MQTT_TOPIC + b"/state", message, True, MQTT_QOS)
+                    last_sent = ticks_ms()
+                elif ticks_diff(ticks_ms(), last_sent) >= MQTT_KEEPALIVE * 500:
+                    client.ping() # Keep the session alive while the state does not change
+                    last_sent = ticks_ms()
+                await asyncio.sleep_ms(MQTT_POLL_MS)
+        except OSError as error:
+            print("MQTT broker lost:", error)
+
+        try:
+            client.sock.close()
+        except:
+            pass # The connection never opened
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MQTT_BACKOFF_MAX)
+
 
-    global fan
-    old_value_button = 0
-    button = Pin(12, Pin.IN) # Initialize push button on Pin 12 as input
+async def serve(ip):
+    """
+    Start the button task and a web server that handles client requests for controlling the fan concurrently.
 
+    Args:
+        ip (str): The IP address of the device.
+    """
+    asyncio.create_task(button.run()) # Handle the physical button presses
+    asyncio.create_task(ramp_fan()) # Ramp the fan to its speed
+    asyncio.create_task(control_fan()) # Control the fan from the temperature in the closed loop mode
+    asyncio.create_task(measure_fan()) # Measure the speed of the fan
+    if UDP_ENABLED:
+        asyncio.create_task(serve_udp(ip)) # Serve the binary control messages
+    if MQTT_ENABLED and MQTTClient is not None:
+        asyncio.create_task(run_mqtt()) # Publish the state and receive the commands through the broker
+    await asyncio.start_server(handle_client, ip, PORT, backlog=BACKLOG)
     while True:
-        new_value_button = button.value() # Read button state
-        
-        # Detect button press (from 0 to 1)
-        if old_value_button == 0 and new_value_button == 1:
-            spLock.acquire()
-            fan.toggle() # Toggle fan status
-            spLock.release()
-            print("BUTTON Status: ", fan.value())
-            
-        old_value_button = new_value_button
+        await asyncio.sleep(3600) # Keep serving forever
+
+
+class Button:
+    """
+    Push button read through pin interrupts, debounced and classified into
+    press, long press and double press without polling.
+    """
+
+    def __init__(self, pin, on_press, on_long_press=None, on_double_press=None,
+                 debounce_ms=DEBOUNCE_MS, long_press_ms=LONG_PRESS_MS, double_press_ms=DOUBLE_PRESS_MS):
+        """
+        Args:
+            pin (Pin): The input pin of the button (1 when pressed).
+            on_press (function): Called on a short press.
+            on_long_press (function): Called when the button is released after being held,
+                                      a short press is reported instead if it is None.
+            on_double_press (function): Called on two short presses in a row, if it is None
+                                        short presses are reported without waiting.
+            debounce_ms (int): Time in ms the contacts need to settle after an edge.
+            long_press_ms (int): Minimum time in ms the button is held for a long press.
+            double_press_ms (int): Maximum time in ms between the presses of a double press.
+        """
+        self.pin = pin
+        self.on_press = on_press
+        self.on_long_press = on_long_press
+        self.on_double_press = on_double_press
+        self.debounce_ms = debounce_ms
+        self.long_press_ms = long_press_ms
+        self.double_press_ms = double_press_ms
+        self.flag = asyncio.ThreadSafeFlag()
+        self.pin.irq(handler=self.edge, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, hard=True)
+
+    def edge(self, pin):
+        """
+        Interrupt handler of the pin, it only wakes up the button task.
+
+        Args:
+            pin (Pin): The pin that triggered the interrupt.
+        """
+        self.flag.set()
+
+    async def run(self):
+        """
+        Task that classifies the debounced presses and runs their actions.
+        """
+        pressed = False
+        pressed_at = 0
+        released_at = 0
+        waiting_double = False # A short press may still become a double press
+
+        while True:
+            # Sleep until an edge arrives, or until the double press window ends
+            if waiting_double:
+                remaining = self.double_press_ms - ticks_diff(ticks_ms(), released_at)
+                try:
+                    await asyncio.wait_for_ms(self.flag.wait(), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    waiting_double = False
+                    self.on_press()
+                    continue
+            else:
+                await self.flag.wait()
+
+            # Ignore the bounces, only the settled level counts
+            edge_at = ticks_ms()
+            await asyncio.sleep_ms(self.debounce_ms)
+            value = self.pin.value()
+
+            if value == 1 and not pressed:
+                pressed = True
+                pressed_at = edge_at
+            elif value == 0 and pressed:
+                pressed = False
+                if self.on_long_press is not None and ticks_diff(edge_at, pressed_at) >= self.long_press_ms:
+                    waiting_double = False
+                    self.on_long_press()
+                elif self.on_double_press is None:
+                    self.on_press()
+                elif waiting_double:
+                    waiting_double = False
+                    self.on_double_press()
+                else:
+                    waiting_double = True
+                    released_at = edge_at
+
+
+def button_pressed():
+    """
+    Toggle the fan status when the physical button is pressed.
+    """
+    spLock.acquire()
+    state.set_auto(0, state.setpoint) # Manual commands stop the closed loop mode
+    state.set_status(1 - state.status) # Toggle fan status
+    notify_change()
+    spLock.release()
+    print("BUTTON Status: ", state.status)
+
+
+def button_long_pressed():
+    """
+    Turn the fan off when the physical button is held.
+    """
+    spLock.acquire()
+    state.set_auto(0, state.setpoint)
+    state.set_status(0)
+    notify_change()
+    spLock.release()
+    print("BUTTON Status: ", state.status)
 
 
 # Main code execution
 try:
-    _thread.start_new_thread(button_task, ()) # Start button task in a new thread
+    button = Button(Pin(12, Pin.IN), button_pressed, button_long_pressed) # Push button on Pin 12
     ip = connect() # Connect to the WLAN and get IP address
-    connection = open_socket(ip) # Open socket for communication
-    serve(connection) # Start serving requests
+    asyncio.run(serve(ip)) # Start serving requests
 except KeyboardInterrupt:
     machine.reset() # Reset the device if interrupted
\ No newline at end of file
@@ -1,12 +1,103 @@
-from machine import Pin, ADC, PWM, reset
+from machine import Pin, ADC, PWM, reset, unique_id
 import network
-import socket
+import micropython
 import _thread
 from wlan import SSID, PASSWORD
-from time import sleep
+try:
+    import uasyncio as asyncio # Asynchronous I/O on the device
+except ImportError:
+    import asyncio
+try:
+    from umqtt.simple import MQTTClient # MQTT client of micropython-lib, only needed for the MQTT mode
+except ImportError:
+    MQTTClient = None
+from binascii import hexlify
+from time import sleep, sleep_ms, sleep_us, ticks_ms, ticks_us, ticks_diff, ticks_add, time
+import gc
+from random import getrandbits
+from array import array
+import struct
+import socket
+import json
 from neopixel import Neopixel # Import the Neopixel module in order to interact with the RGB Matrix
 
 
+class MatrixState:
+    """
+    Authoritative state of the LED matrix. Every change goes through it and increases the version,
+    so the JSON reply is only formatted again after a change.
+    """
+    __slots__ = ("red", "green", "blue", "brightness", "last_values", "version", "cached", "cached_etag", "cached_version")
+
+    def __init__(self, brightness, last_values):
+        """
+        Args:
+            brightness (int): Brightness value the matrix starts with (0-255).
+            last_values (tuple): Color and brightness restored when the matrix is turned on.
+        """
+        self.red = 0
+        self.green = 0
+        self.blue = 0
+        self.brightness = brightness
+        self.last_values = last_values # Values before the matrix was turned off
+        self.version = 0 # Increased on every change
+        self.cached = b"" # JSON reply of the state
+        self.cached_etag = b"" # ETag of the state
+        self.cached_version = -1 # Version the JSON reply was formatted for
+
+    def update(self, red, green, blue, brightness):
+        """
+        Record a new color and brightness of the matrix.
+
+        Args:
+            red (int): Red color intensity (0-255).
+            green (int): Green color intensity (0-255).
+            blue (int): Blue color intensity (0-255).
+            brightness (int): Brightness value (0-255).
+        """
+        # If all colors are zero, store the previous values before turning off
+        if red == 0 and green == 0 and blue == 0 and self.is_on():
+            self.last_values = (self.red, self.green, self.blue, self.brightness)
+
+        if red != self.red or green != self.green or blue != self.blue or brightness != self.brightness:
+            self.red = red
+            self.green = green
+            self.blue = blue
+            self.brightness = brightness
+            self.version += 1
+
+    def is_on(self):
+        """
+        Returns:
+            bool: Whether the matrix shows a color (not all of them zero).
+        """
+        return self.red != 0 or self.green != 0 or self.blue != 0
+
+    def json(self):
+        """
+        Get the JSON reply with the color and brightness, formatted again only after a change.
+
+        Returns:
+            bytes: The JSON-formatted RGB values and brightness.
+        """
+        if self.cached_version != self.version:
+            self.cached = ('{"red": ' + str(self.red) + ', "green": ' + str(self.green) + ', "blue": ' + str(self.blue) \
+                + ', "brightness": ' + str(self.brightness) + '}').encode()
+            self.cached_etag = ('"' + BOOT_ID + '-' + str(self.version) + '"').encode()
+            self.cached_version = self.version
+        return self.cached
+
+    def etag(self):
+        """
+        Get the entity tag of the state, sent in the ETag header of the status replies.
+
+        Returns:
+            bytes: The quoted tag, made of the boot identifier and the version.
+        """
+        self.json() # The tag is formatted along with the JSON after a change
+        return self.cached_etag
+
+
 def set_matrix(red, green, blue, brightness):
     """
     Sets the color and brightness of the LED matrix.
@@ -17,19 +108,235 @@ def set_matrix(red, green, blue, brightness):
         blue (int): Blue color intensity (0-255).
         brightness (int): Brightness value (0-255).
     """
-    global last_values
-
-    # If all colors are zero, store the previous values before turning off
-    if red == 0 and green == 0 and blue == 0:
-        values = matrix.get_pixel(1)
-        last_values = [values[0], values[1], values[2], matrix.brightnessvalue]
+    global animation
+    animation = None # A static color stops the running effect
 
     # Set the LED matrix with new color and brightness
-    matrix.fill((red, green, blue))
+    set_brightness(brightness)
+    state.update(red, green, blue, matrix.brightnessvalue)
+    value = pack_color(red, green, blue)
+    pixels = matrix.pixels
+    for index in range(num_leds):
+        pixels[index] = value
+    matrix.show()
+
+
+def set_brightness(brightness):
+    """
+    Sets the brightness of the LED matrix, rebuilding the output table when it changes.
+    The table maps every color intensity to the value sent to the LEDs, applying the
+    gamma correction and the brightness at once.
+
+    Args:
+        brightness (int): Brightness value (0-255).
+    """
     matrix.brightness(brightness)
+    brightness = matrix.brightnessvalue
+    if output_brightness[0] != brightness:
+        for level in range(256):
+            output_table[level] = (gamma_table[level] * brightness + 127) // 255
+        output_brightness[0] = brightness
+
+
+def push_frame(frame, bytes_per_pixel):
+    """
+    Writes a whole frame of raw pixel values to the LED matrix in a single pass.
+
+    Args:
+        frame (memoryview): The values of every LED, 3 bytes (RGB) or 4 bytes (RGBW) each.
+        bytes_per_pixel (int): Number of bytes of every LED in the frame (3 or 4).
+    """
+    global animation
+    animation = None # A static frame stops the running effect
+
+    pixels = matrix.pixels
+    shift_red = matrix.shift['R']
+    shift_green = matrix.shift['G']
+    shift_blue = matrix.shift['B']
+    shift_white = matrix.shift['W']
+    table = output_table
+    white_used = bytes_per_pixel == 4 and matrix.W_in_mode # White is only sent to RGBW LEDs
+
+    # Pack the values straight into the output buffer of the matrix
+    position = 0
+    for index in range(num_leds):
+        red = table[frame[position]]
+        green = table[frame[position + 1]]
+        blue = table[frame[position + 2]]
+        if white_used:
+            white = table[frame[position + 3]]
+        else:
+            white = 0
+        pixels[index] = white << shift_white | blue << shift_blue | red << shift_red | green << shift_green
+        position += bytes_per_pixel
     matrix.show()
 
 
+class Effect:
+    """
+    Parameters of an effect of the animation engine. The web server replaces the
+    whole object to change the effect, so the engine never sees half an update.
+    """
+
+    def __init__(self, name, period, first, second, keyframes):
+        """
+        Args:
+            name (str): The effect (fade, rainbow, breathe, chase or keyframes).
+            period (int): Duration in ms of a cycle of the effect.
+            first (tuple): Main color of the effect (red, green, blue).
+            second (tuple): Color the fade effect goes to (red, green, blue).
+            keyframes (tuple): (times, colors) of the keyframes effect, where times holds the
+                               time in ms of every keyframe and colors 3 bytes for each one.
+        """
+        self.name = name
+        self.period = period
+        self.first = first
+        self.second = second
+        self.keyframes = keyframes
+        self.start = ticks_ms()
+
+
+def pack_color(red, green, blue):
+    """
+    Packs a color into the word sent to a LED, applying the gamma correction and the brightness.
+
+    Args:
+        red (int): Red color intensity (0-255).
+        green (int): Green color intensity (0-255).
+        blue (int): Blue color intensity (0-255).
+
+    Returns:
+        int: The value of the LED in the output buffer of the matrix.
+    """
+    table = output_table
+    return table[blue] << shift_blue | table[red] << shift_red | table[green] << shift_green
+
+
+def color_wheel(position):
+    """
+    Gives the color of a position of the color wheel (red, green, blue and back to red).
+
+    Args:
+        position (int): Position in the wheel (0-255).
+
+    Returns:
+        tuple: The color (red, green, blue).
+    """
+    if position < 85:
+        return (255 - position * 3, position * 3, 0)
+    elif position < 170:
+        position -= 85
+        return (0, 255 - position * 3, position * 3)
+    else:
+        position -= 170
+        return (position * 3, 0, 255 - position * 3)
+
+
+def render_effect(effect, buffer, elapsed):
+    """
+    Renders a frame of an effect into an output buffer.
+
+    Args:
+        effect (Effect): The effect to render.
+        buffer (array): The buffer receiving the value of every LED.
+        elapsed (int): Time in ms since the effect started.
+    """
+    phase = elapsed % effect.period
+    first = effect.first
+
+    if effect.name == "rainbow":
+        offset = phase * 256 // effect.period
+        for index in range(num_leds):
+            red, green, blue = color_wheel((index * 256 // num_leds + offset) & 255)
+            buffer[index] = pack_color(red, green, blue)
+        return
+
+    if effect.name == "chase":
+        head = phase * num_leds // effect.period
+        for index in range(num_leds):
+            buffer[index] = 0
+        buffer[head] = pack_color(first[0], first[1], first[2])
+        buffer[head - 1] = pack_color(first[0] >> 1, first[1] >> 1, first[2] >> 1) # Dimmer tail
+        return
+
+    if effect.name == "keyframes":
+        times, colors = effect.keyframes
+        segment = 0
+        while segment < len(times) - 2 and times[segment + 1] <= phase:
+            segment += 1
+        # Interpolate between the keyframes around the current time
+        length = times[segment + 1] - times[segment]
+        level = (phase - times[segment]) * 256 // length if length > 0 else 256
+        position = segment * 3
+        red = colors[position] + (colors[position + 3] - colors[position]) * level // 256
+        green = colors[position + 1] + (colors[position + 4] - colors[position + 1]) * level // 256
+        blue = colors[position + 2] + (colors[position + 5] - colors[position + 2]) * level // 256
+    else:
+        # Fade and breathe go back and forth along the cycle
+        level = phase * 512 // effect.period
+        if level > 256:
+            level = 512 - level
+        if effect.name == "breathe":
+            level = level * level // 256 # Slower near off, so the breathing looks even
+            second = (0, 0, 0)
+        else:
+            second = effect.second
+        red = first[0] + (second[0] - first[0]) * level // 256
+        green = first[1] + (second[1] - first[1]) * level // 256
+        blue = first[2] + (second[2] - first[2]) * level // 256
+
+    value = pack_color(red, green, blue)
+    for index in range(num_leds):
+        buffer[index] = value
+
+
+def animation_task():
+    """
+    Task running on the second core that renders the current effect at a fixed frame rate.
+    Frames are rendered into a back buffer and swapped with the one shown, so the web
+    server only ever reads complete frames.
+    """
+    buffers = [matrix.pixels, array("I", [0] * num_leds)]
+    back = 1
+    frame_us = 1000000 // ANIMATION_FPS
+    next_frame = ticks_us()
+
+    while True:
+        effect = animation
+        if effect is None:
+            sleep_ms(20) # Nothing to animate
+            next_frame = ticks_us()
+            continue
+
+        # Render the next frame without holding the lock
+        started = ticks_us()
+        render_effect(effect, buffers[back], ticks_diff(ticks_ms(), effect.start))
+
+        # Show it, unless the effect was changed or stopped meanwhile
+        spLock.acquire()
+        if animation is effect:
+            matrix.pixels = buffers[back]
+            matrix.show()
+            back ^= 1
+        spLock.release()
+
+        # Measure the frame and wait for the next one
+        elapsed = ticks_diff(ticks_us(), started)
+        animation_stats[FRAMES] += 1
+        animation_stats[FRAME_US] = elapsed
+        if elapsed > animation_stats[FRAME_US_MAX]:
+            animation_stats[FRAME_US_MAX] = elapsed
+        next_frame = ticks_add(next_frame, frame_us)
+        delay = ticks_diff(next_frame, ticks_us())
+        if delay > 0:
+            sleep_us(delay)
+        else:
+            # Skip the frames that are already late instead of rushing to catch up
+            missed = -delay // frame_us + 1
+            animation_stats[DROPPED] += missed
+            next_frame = ticks_add(next_frame, missed * frame_us)
+
+
 def check_values(red, green, blue, brightness):
     """
     Validates whether the red, green, blue, and brightness values are within the valid range (0-255).
@@ -59,11 +366,114 @@ pin_matrix = 0
 matrix = Neopixel(num_leds, 0, pin_matrix, "GRB")
 
 # Set a default tuple of values for the init
-last_values = [255,0,0,10]
+DEFAULT_VALUES = (255, 0, 0, 10)
+
+# Positions of the colors in the words of the output buffer of the matrix
+shift_red = matrix.shift['R']
+shift_green = matrix.shift['G']
+shift_blue = matrix.shift['B']
+
+# Output tables of the LEDs
+GAMMA = 2.2 # Gamma of the correction applied so the intensities look linear
+gamma_table = bytearray(round(255 * (level / 255) ** GAMMA) for level in range(256))
+output_table = bytearray(256) # Gamma corrected intensities scaled by the brightness
+output_brightness = [-1] # Brightness the output table was built for
+set_brightness(matrix.brightnessvalue)
+
+# State of the matrix served to the clients
+state = MatrixState(matrix.brightnessvalue, DEFAULT_VALUES)
+
+# Animation configuration
+ANIMATION_FPS = 30 # Frames per second rendered by the animation engine
+EFFECTS = ("none", "fade", "rainbow", "breathe", "chase", "keyframes")
+MAX_KEYFRAMES = 32 # Maximum number of keyframes of a custom sequence
+
+# Effect rendered by the animation engine (None when the matrix is static)
+animation = None
+keyframes = None # Last custom sequence uploaded
+
+# Instrumentation of the animation engine
+FRAMES = 0 # Index of the number of frames rendered
+DROPPED = 1 # Index of the number of frames dropped for being late
+FRAME_US = 2 # Index of the time in us taken by the last frame
+FRAME_US_MAX = 3 # Index of the maximum time in us taken by a frame
+animation_stats = array("L", [0, 0, 0, 0])
 
 # Thread synchronization lock
 spLock = _thread.allocate_lock()
 
+# HTTP server configuration
+PORT = 80 # Port the web server listens on
+BACKLOG = 5 # Maximum number of pending client connections
+READ_TIMEOUT = 5 # Seconds to wait for a client to send its request
+KEEPALIVE_TIMEOUT = 10 # Seconds an idle persistent connection is kept open
+MAX_REQUESTS = 100 # Requests served on a persistent connection before closing it
+MAX_REQUEST_SIZE = 1024 # Maximum size in bytes of a request (head and body)
+MAX_BATCH = 16 # Maximum number of operations in a batch request
+UPDATE_INTERVAL_MS = 33 # Minimum time in ms between two colors applied (one frame at 30 fps), newer ones replace the pending one
+
+# Binary control protocol over UDP, for the updates sent continuously (such as a slider being dragged)
+UDP_ENABLED = True # Whether the UDP port is served alongside the HTTP API
+UDP_PORT = 5005 # Port the binary control messages are received on
+UDP_MAX_SIZE = 260 # Maximum size in bytes of a message
+UDP_POLL_MS = 5 # Time in ms between two polls of the UDP socket while it is idle
+UDP_MAX_CLIENTS = 8 # Clients whose last sequence number is kept
+# Handler run for every opcode: (method, endpoint, struct layout of the payload, parameters filled
+# with the payload), the payload is passed as the body when the layout is None
+UDP_OPCODES = {
+    1: ("POST", "change_color", ">BBBB", "red=%d&green=%d&blue=%d&brightness=%d"),
+    2: ("POST", "frame", None, ""),
+    3: ("POST", "pixels", None, ""),
+    4: ("POST", "effect", "", "name=none"),
+    16: ("GET", "check_status", "", ""),
+}
+
+# MQTT configuration, the state is published retained and the commands are received through a broker
+MQTT_ENABLED = False # Whether to connect to the broker (needs the umqtt.simple library)
+MQTT_BROKER = "192.168.1.200" # Address of the MQTT broker
+MQTT_PORT = 1883 # Port of the MQTT broker
+MQTT_TOPIC = b"home/rgb_matrix" # Prefix of the topics of this device
+MQTT_CLIENT_ID = b"rgb_matrix-" + hexlify(unique_id()) # Unique client identifier
+MQTT_QOS = 1 # Quality of service of the state and the commands (0 or 1)
+MQTT_KEEPALIVE = 60 # Seconds the broker waits for a message before dropping the session
+MQTT_POLL_MS = 50 # Time in ms between two checks of the session
+MQTT_BACKOFF_MIN = 1 # Seconds to wait before reconnecting after the first failure
+MQTT_BACKOFF_MAX = 60 # Maximum seconds to wait before reconnecting, doubled after every failure
+
+# Metrics configuration
+PHASES = ("receive", "parse", "lock", "handler", "send") # Phases of a request timed by the metrics
+PHASE_RECEIVE = 0 # Index of the time waiting for the rest of a request
+PHASE_PARSE = 1 # Index of the time parsing a request
+PHASE_LOCK = 2 # Index of the time waiting for spLock
+PHASE_HANDLER = 3 # Index of the time running the handler
+PHASE_SEND = 4 # Index of the time sending the reply
+METRICS_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000) # Upper bounds of the histograms
+METRICS_MAX_SERIES = 32 # Pairs of endpoint and status code counted apart, the rest are counted as 'other'
+BOOT_TIME = time() # Time of the boot in seconds, for the uptime
+
+# Content types of the replies
+CONTENT_TYPES = ("text/plain", "application/json", "text/event-stream")
+CONTENT_TEXT = 0 # Index of the plain text content type
+CONTENT_JSON = 1 # Index of the JSON content type
+CONTENT_EVENTS = 2 # Index of the Server-Sent Events content type
+
+# Identifier of this boot in the ETag of the state, so tags from before a restart never match
+BOOT_ID = str(getrandbits(24))
+
+# Receive buffers reused across connections
+buffer_pool = [bytearray(MAX_REQUEST_SIZE) for _ in range(BACKLOG)]
+
+# Events configuration
+EVENT_QUEUE_SIZE = 8 # Pending events kept for a slow subscriber, the oldest ones are dropped
+MAX_SUBSCRIBERS = 4 # Maximum number of clients streaming events or long-polling at once
+LONG_POLL_MAX = 60 # Maximum seconds a long-poll request waits for a change
+EVENTS_PING = 15 # Seconds between the comments that keep an idle event stream open
+
+# Button configuration
+DEBOUNCE_MS = 30 # Time in ms the button contacts need to settle
+LONG_PRESS_MS = 1000 # Minimum time in ms the button is held for a long press
+DOUBLE_PRESS_MS = 300 # Maximum time in ms between the two presses of a double press
+
 def connect():
     """
     Connect the device to a WLAN using the provided SSID and password.
@@ -90,74 +500,246 @@ def connect():
     return ip
 
 
-def open_socket(ip):
+def build_header_table(statuses):
     """
-    Open a socket for communication.
+    Pre-encode the headers of the replies for every status code and content type.
 
     Args:
-        ip (str): The IP address of the device.
+        statuses (tuple): Pairs of (status_code, reason) for the status codes used.
+
+    Returns:
+        dict: For each status code, a list indexed by content type with the encoded
+              headers up to the value of the Content-Length header.
+    """
+    table = {}
+    for status_code, reason in statuses:
+        table[status_code] = [("HTTP/1.1 " + str(status_code) + " " + reason + "\r\n"
+                               + "Content-Type: " + content_type + "\r\n"
+                               + "Access-Control-Allow-Origin: *\r\n"
+                               + "Content-Length: ").encode() for content_type in CONTENT_TYPES]
+    return table
+
+
+# Pre-encoded headers of the replies
+response_headers = build_header_table(((200, "OK"), (400, "Bad Request"), (405, "Method Not Allowed"), (503, "Service Unavailable")))
+KEEP_ALIVE_END = ("\r\nConnection: keep-alive\r\nKeep-Alive: timeout=" + str(KEEPALIVE_TIMEOUT) \
+    + ", max=" + str(MAX_REQUESTS) + "\r\n\r\n").encode()
+CLOSE_END = b"\r\nConnection: close\r\n\r\n"
+ETAG_HEADER = b"\r\nETag: "
+NOT_MODIFIED_HEAD = b"HTTP/1.1 304 Not Modified\r\nAccess-Control-Allow-Origin: *\r\nETag: " # 304 replies have no body nor length
+
+# Pre-encoded headers of the Server-Sent Events stream, which lasts until the connection closes
+EVENTS_HEAD = response_headers[200][CONTENT_EVENTS].replace(b"Content-Length: ", b"Cache-Control: no-cache") + CLOSE_END
+
+
+def build_response(status_code, content_type, data, keep_alive, etag=None):
+    """
+    Build a complete HTTP reply from the pre-encoded headers.
+
+    Args:
+        status_code (int): The HTTP status code (200, 304, 400, 405, 503).
+        content_type (int): The content type of the data (CONTENT_TEXT or CONTENT_JSON).
+        data (bytes): The data sent after the headers.
+        keep_alive (bool): Whether the connection is kept open after the reply.
+        etag (bytes): The tag of the state sent in the ETag header, or None.
+
+    Returns:
+        bytes: The headers followed by the data, to be sent with a single write.
+    """
+    if keep_alive:
+        headers_end = KEEP_ALIVE_END
+    else:
+        headers_end = CLOSE_END
+
+    if etag is None:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), headers_end, data))
+    elif status_code == 304:
+        return b"".join((NOT_MODIFIED_HEAD, etag, headers_end))
+    else:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), ETAG_HEADER, etag, headers_end, data))
+
+
+@micropython.viper
+def find_byte(buffer, start: int, end: int, byte: int) -> int:
+    """
+    Find the first occurrence of a byte in buffer[start:end].
+
+    Args:
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+        byte (int): The byte value to look for.
 
     Returns:
-        socket: The opened socket for communication.
+        int: The position of the byte, or -1 if it is not found.
+    """
+    data = ptr8(buffer)
+    position = start
+    while position < end:
+        if data[position] == byte:
+            return position
+        position += 1
+    return -1
+
+
+@micropython.viper
+def find_head_end(buffer, start: int, end: int) -> int:
     """
-    address = (ip, 80) # IP address and port for the socket
-    connection = socket.socket() # Create a new socket
-    connection.bind(address) # Bind the socket to the address
-    connection.listen(1) # Listen for incoming connections
+    Find the blank line that ends the head of a request in buffer[start:end].
 
-    return connection
+    Args:
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+
+    Returns:
+        int: The position of the blank line, or -1 if it is not found.
+    """
+    data = ptr8(buffer)
+    position = start
+    while position + 3 < end:
+        if data[position] == 13 and data[position + 1] == 10 \
+            and data[position + 2] == 13 and data[position + 3] == 10:
+            return position
+        position += 1
+    return -1
 
 
-def status_code_set(status_code):
+@micropython.viper
+def header_matches(buffer, start: int, end: int, name) -> bool:
     """
-    Generate HTTP status response based on the given status code.
+    Compare buffer[start:end] with a lowercase name, ignoring the case of the buffer.
 
     Args:
-        status_code (int): The HTTP status code (200, 400, 405, 500).
+        buffer (bytearray): The buffer holding the header.
+        start (int): Position where the header name or value starts.
+        end (int): Position where the header name or value ends.
+        name (bytes): The lowercase name to compare with (e.g., b"connection").
 
     Returns:
-        str: The corresponding HTTP status response.
+        bool: True if both are equal, False otherwise.
     """
-    if status_code == 200:
-        status_send = "HTTP/1.0 200 OK\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 400:
-        status_send = "HTTP/1.0 400 Bad Request\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 405:
-        status_send = "HTTP/1.0 405 Method Not Allowed\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
+    length = int(len(name))
+    if end - start != length:
+        return False
+    data = ptr8(buffer)
+    expected = ptr8(name)
+    index = 0
+    while index < length:
+        if (data[start + index] | 0x20) != expected[index]:
+            return False
+        index += 1
+    return True
 
-    return status_send
 
-def request_data_extractor(request):
+def parse_request(buffer, start, end):
     """
-    Extract the HTTP method, endpoint, and parameters from the request.
+    Parse the request stored in buffer[start:end] without copying the buffer.
 
     Args:
-        request (str): The raw HTTP request string.
+        buffer (bytearray): The receive buffer of the connection.
+        start (int): Position where the request starts.
+        end (int): Position where the received data ends.
 
     Returns:
-        tuple: (method, endpoint, parameters) extracted from the request.
+        tuple: (method, endpoint, parameters, body, size, keep_alive, if_none_match) where
+               body is a memoryview over the buffer, size is the length of the whole request
+               and if_none_match the value of the If-None-Match header (None if missing),
+               or None if the request has not been completely received yet.
+
+    Raises:
+        ValueError: If the request is malformed or does not fit in the buffer.
     """
-    request = request.split()
-    method = request[0][2:]  # Extract the HTTP method (e.g., GET, POST) 
-    request = request[1].split("/")
-    request = request[1].split("?")
-    endpoint = request[0] # Extract the endpoint
+    head_end = find_head_end(buffer, start, end)
+    if head_end < 0:
+        if end - start >= MAX_REQUEST_SIZE:
+            raise ValueError("Request too large")
+        return None # Wait for the rest of the head
+    view = memoryview(buffer)
 
-    # Extract parameters (if any)
-    if len(request) == 1:
+    # Request line (e.g., "POST /endpoint?key=value HTTP/1.1")
+    line_end = find_byte(buffer, start, head_end + 2, 13)
+    method_end = find_byte(buffer, start, line_end, 32)
+    if method_end < 0:
+        raise ValueError("Malformed request line")
+    target_end = find_byte(buffer, method_end + 1, line_end, 32)
+    if target_end < 0 or buffer[method_end + 1] != 47:
+        raise ValueError("Malformed request line")
+    method = str(view[start:method_end], "utf-8") # Extract HTTP method (GET, POST, etc.)
+    query = find_byte(buffer, method_end + 2, target_end, 63)
+    if query < 0:
+        endpoint = str(view[method_end + 2:target_end], "utf-8") # Extract endpoint
         parameters = None
     else:
-        parameters = request[1]
-    
-    return method, endpoint, parameters
+        endpoint = str(view[method_end + 2:query], "utf-8") # Extract endpoint
+        parameters = str(view[query + 1:target_end], "utf-8") # Extract parameters
+
+    # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones must ask for it
+    keep_alive = buffer[line_end - 1] == 49
+    length = 0
+    if_none_match = None
+
+    # Headers, only the ones needed by the server are looked at
+    position = line_end + 2
+    while position < head_end:
+        line_end = find_byte(buffer, position, head_end + 2, 13)
+        colon = find_byte(buffer, position, line_end, 58)
+        if colon > 0:
+            value = colon + 1
+            while value < line_end and buffer[value] == 32:
+                value += 1
+            if header_matches(buffer, position, colon, b"content-length"):
+                length = int(str(view[value:line_end], "utf-8"))
+            elif header_matches(buffer, position, colon, b"connection"):
+                keep_alive = header_matches(buffer, value, line_end, b"keep-alive")
+            elif header_matches(buffer, position, colon, b"if-none-match"):
+                if_none_match = bytes(view[value:line_end])
+        position = line_end + 2
+
+    body = head_end + 4
+    size = body + length - start
+    if size > MAX_REQUEST_SIZE:
+        raise ValueError("Request too large")
+    if start + size > end:
+        return None # Wait for the rest of the body
+
+    return method, endpoint, parameters, view[body:body + length], size, keep_alive, if_none_match
+
+
+def not_modified(if_none_match):
+    """
+    Check whether the client already has the current state, from the tags it sent.
+
+    Args:
+        if_none_match (bytes): The value of the If-None-Match header, or None.
+
+    Returns:
+        bool: True if one of the tags sent is the tag of the current state.
+    """
+    if if_none_match is None:
+        return False
+    return if_none_match == b"*" or state.etag() in if_none_match
+
+
+def apply_color(color):
+    """
+    Set the color and brightness sent by a client.
+
+    Args:
+        color (tuple): The red, green, blue and brightness values (0-255).
+    """
+    set_matrix(color[0], color[1], color[2], color[3])
 
-def change_color(method, parameters):
+
+def change_color(method, parameters, updates=None):
     """
     Handles the 'change_color' endpoint to update the LED matrix color and brightness.
 
     Args:
         method (str): The HTTP method (only accepts 'POST').
         parameters (str): The query parameters containing red, green, blue, and brightness values.
+        updates (Coalescer): Where to hand the color over instead of setting it at once,
+                             or None to set it now.
 
     Returns:
         status_code (int): The HTTP status code (200, 400, or 405).
@@ -178,7 +760,10 @@ def change_color(method, parameters):
             # Check if the values are valid
             if check_values(red, green, blue, brightness) == True:
                 status_code = 200 # OK status
-                set_matrix(red, green, blue, brightness)
+                if updates is None:
+                    set_matrix(red, green, blue, brightness)
+                else:
+                    updates.submit((red, green, blue, brightness)) # Replaces the color still pending, if any
             else:
                 status_code = 400 # Bad request for invalid status
 
@@ -190,9 +775,152 @@ def change_color(method, parameters):
     return status_code
 
 
-def check_status(method):
+def change_frame(method, body):
     """
-    Handles the 'check_status' endpoint to return the current color and brightness of the LED matrix.
+    Handles the 'frame' endpoint to set every LED of the matrix from a raw binary frame.
+
+    Args:
+        method (str): The HTTP method (only accepts 'POST').
+        body (memoryview): The frame, 3 bytes (red, green, blue) or 4 bytes (red, green, blue, white)
+                           for every LED in order.
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+    """
+    if method == "POST":
+        if body != None and (len(body) == num_leds * 3 or len(body) == num_leds * 4):
+            push_frame(body, len(body) // num_leds)
+            status_code = 200 # OK status
+        else:
+            status_code = 400 # Bad request for frames of the wrong size
+    else:
+        status_code = 405 # Method not allowed (only POST allowed)
+
+    return status_code
+
+
+def change_pixels(method, body):
+    """
+    Handles the 'pixels' endpoint to set some LEDs of the matrix, leaving the rest as they are.
+
+    Args:
+        method (str): The HTTP method (only accepts 'POST').
+        body (memoryview): The LEDs to set, 4 bytes (index, red, green, blue) for every LED.
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+    """
+    if method == "POST":
+        if body != None and len(body) > 0 and len(body) % 4 == 0:
+            # Check every index before changing anything
+            valid = True
+            for position in range(0, len(body), 4):
+                if body[position] >= num_leds:
+                    valid = False
+            if valid == True:
+                global animation
+                animation = None # Static pixels stop the running effect
+                pixels = matrix.pixels
+                for position in range(0, len(body), 4):
+                    pixels[body[position]] = pack_color(body[position + 1], body[position + 2], body[position + 3])
+                matrix.show()
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad request for invalid indexes
+        else:
+            status_code = 400 # Bad request for lists of the wrong size
+    else:
+        status_code = 405 # Method not allowed (only POST allowed)
+
+    return status_code
+
+
+def change_effect(method, parameters, body):
+    """
+    Handles the 'effect' endpoint to start or stop an effect of the animation engine,
+    or to return the effect running and the frame statistics.
+
+    Args:
+        method (str): The HTTP method ('POST' to change the effect, 'GET' to check it).
+        parameters (str): The query parameters with the effect 'name' and the optional 'period' (ms),
+                          'red', 'green', 'blue', 'red2', 'green2', 'blue2' and 'brightness' values.
+        body (memoryview): For the keyframes effect, an optional new sequence of keyframes with
+                           5 bytes (time in ms as a big-endian 16-bit number, red, green, blue) each.
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The JSON-formatted effect and frame statistics.
+    """
+    global animation, keyframes
+    data_send = False
+    data = None
+
+    if method == "POST":
+        try:
+            parameters = parameters.split("&") # Split parameters by "&"
+            values = {}
+            for parameter in parameters:
+                key, value = parameter.split("=")
+                values[key] = value
+
+            name = values['name']
+            period = int(values.get('period', 2000))
+            first = (int(values.get('red', 255)), int(values.get('green', 255)), int(values.get('blue', 255)))
+            second = (int(values.get('red2', 0)), int(values.get('green2', 0)), int(values.get('blue2', 0)))
+            brightness = int(values.get('brightness', state.brightness))
+
+            # A new sequence of keyframes replaces the stored one
+            if name == "keyframes" and body != None and len(body) > 0:
+                if len(body) % 5 != 0 or not 2 <= len(body) // 5 <= MAX_KEYFRAMES:
+                    raise ValueError("Invalid keyframes")
+                times = array("H", [0] * (len(body) // 5))
+                colors = bytearray(len(times) * 3)
+                for index in range(len(times)):
+                    times[index] = body[index * 5] << 8 | body[index * 5 + 1]
+                    colors[index * 3:index * 3 + 3] = body[index * 5 + 2:index * 5 + 5]
+                    if index > 0 and times[index] <= times[index - 1]:
+                        raise ValueError("Keyframes out of order")
+                keyframes = (times, colors)
+
+            if name not in EFFECTS or period <= 0 or (name == "keyframes" and keyframes == None) \
+                or check_values(first[0], first[1], first[2], brightness) == False \
+                or check_values(second[0], second[1], second[2], brightness) == False:
+                status_code = 400 # Bad request for invalid values
+            else:
+                set_brightness(brightness)
+                state.update(state.red, state.green, state.blue, matrix.brightnessvalue)
+                if name == "none":
+                    animation = None
+                elif name == "keyframes":
+                    times = keyframes[0]
+                    animation = Effect(name, times[len(times) - 1], first, second, keyframes)
+                else:
+                    animation = Effect(name, period, first, second, None)
+                status_code = 200 # OK status
+        except:
+            status_code = 400 # Bad request if an error occurs
+
+    elif method == "GET":
+        data_send = True
+        if animation == None:
+            name = "none"
+        else:
+            name = animation.name
+        data = ('{"effect": "' + name + '", "fps": ' + str(ANIMATION_FPS) + ', "frames": ' + str(animation_stats[FRAMES]) \
+            + ', "dropped": ' + str(animation_stats[DROPPED]) + ', "frame_us": ' + str(animation_stats[FRAME_US]) \
+            + ', "frame_us_max": ' + str(animation_stats[FRAME_US_MAX]) + '}').encode()
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method not allowed (only POST and GET allowed)
+
+    return status_code, data_send, data
+
+
+def check_coalescing(method):
+    """
+    Handles the 'coalescing' endpoint, which returns how many colors were received, applied and
+    dropped for a newer one.
 
     Args:
         method (str): The HTTP method (only accepts 'GET').
@@ -200,15 +928,66 @@ def check_status(method):
     Returns:
         status_code (int): The HTTP status code (200 or 405).
         data_send (bool): Whether data should be sent in the response.
-        data (str): The JSON-formatted string containing the current RGB values and brightness.
+        data (bytes): The JSON-formatted counters.
     """
-    if method == "GET":
+    if method == 'GET':
         data_send = True
-        values = matrix.get_pixel(1)
+        data = color_updates.json()
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only GET is allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
 
-        # Format the color and brightness into a JSON string
-        data = '{"red": ' + str(values[0]) + ', "green": ' + str(values[1]) + ', "blue": ' + str(values[2]) + ', "brightness": ' + str(matrix.brightnessvalue) + '}'
+
+def check_metrics(method):
+    """
+    Handles the 'metrics' endpoint, which returns the counters of the web server.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+
+    Returns:
+        status_code (int): The HTTP status code (200 or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The metrics in the Prometheus text format.
+    """
+    if method == 'GET':
+        data_send = True
+        data = metrics.text()
         status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only GET is allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
+
+
+def check_status(method, if_none_match):
+    """
+    Handles the 'check_status' endpoint to return the current color and brightness of the LED matrix.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        status_code (int): The HTTP status code (200, 304 or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The JSON-formatted current RGB values and brightness.
+    """
+    if method == "GET":
+        if not_modified(if_none_match):
+            data_send = False
+            data = None
+            status_code = 304 # Not Modified, the client already has the current state
+        else:
+            data_send = True
+            data = state.json() # Color and brightness as cached JSON
+            status_code = 200 # OK status
     else:
         status_code = 405 # Method not allowed (only POST allowed)
         data_send = False
@@ -217,79 +996,849 @@ def check_status(method):
     return status_code, data_send, data
 
  
-def serve(connection):
+class Subscriber:
+    """
+    Bounded queue of the state change events waiting to be sent to a client.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size (int): Maximum number of pending events, the oldest ones are dropped.
+        """
+        self.size = size
+        self.queue = []
+        self.event = asyncio.Event()
+
+    def put(self, event):
+        """
+        Queue an event, dropping the oldest one if the client is too slow.
+
+        Args:
+            event (bytes): The encoded event.
+        """
+        if len(self.queue) >= self.size:
+            self.queue.pop(0)
+        self.queue.append(event)
+        self.event.set()
+
+    async def get(self, timeout):
+        """
+        Wait for the next event.
+
+        Args:
+            timeout (int): Maximum seconds to wait.
+
+        Returns:
+            bytes: The encoded event, or None if none arrived in time.
+        """
+        if not self.queue:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.pop(0)
+
+
+def notify_change():
+    """
+    Send the state to the subscribers as an event if it changed since the last one.
+    """
+    global last_version
+    if state.version != last_version:
+        last_version = state.version
+        event = b"data: " + state.json() + b"\n\n" # Encoded once for every subscriber
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+async def wait_for_change(parameters):
+    """
+    Hold a long-poll request until the state changes or its 'wait' time passes.
+
+    Args:
+        parameters (str): The request parameters, the seconds to wait are in 'wait'.
+    """
+    wait = 0
+    try:
+        for parameter in parameters.split("&"):
+            key, value = parameter.split("=")
+            if key == "wait":
+                wait = min(int(value), LONG_POLL_MAX)
+    except:
+        return # Invalid parameters are left to the handler
+    if wait <= 0 or len(subscribers) >= MAX_SUBSCRIBERS:
+        return
+
+    subscriber = Subscriber(1)
+    subscribers.append(subscriber)
+    try:
+        await subscriber.get(wait)
+    finally:
+        subscribers.remove(subscriber)
+
+
+async def stream_events(writer):
+    """
+    Stream the state changes to the client as Server-Sent Events until it disconnects.
+
+    Args:
+        writer (StreamWriter): The stream to send the events to.
+    """
+    subscriber = Subscriber(EVENT_QUEUE_SIZE)
+    subscribers.append(subscriber)
+    try:
+        writer.write(EVENTS_HEAD)
+        writer.write(b"data: " + state.json() + b"\n\n") # Start with the current state
+        await writer.drain()
+        while True:
+            event = await subscriber.get(EVENTS_PING)
+            if event is None:
+                writer.write(b": ping\n\n")
+            else:
+                writer.write(event)
+            await writer.drain()
+    finally:
+        subscribers.remove(subscriber)
+
+
+# Clients waiting for state changes and the version of the last state sent to them
+subscribers = []
+last_version = -1
+
+
+class Coalescer:
+    """
+    Keeps only the latest pending value of an actuator and applies it at a bounded rate, so a flood
+    of updates (such as a slider being dragged) never queues up and the actuator goes straight to the
+    last one. The updates are answered as soon as they are accepted.
+    """
+    __slots__ = ("apply", "interval_ms", "pending", "event", "received", "applied", "coalesced")
+
+    def __init__(self, apply, interval_ms):
+        """
+        Args:
+            apply (function): Called with the value to apply, holding spLock.
+            interval_ms (int): Minimum time in ms between two values applied.
+        """
+        self.apply = apply
+        self.interval_ms = interval_ms
+        self.pending = None # Value waiting to be applied
+        self.event = asyncio.Event() # Set when a value is pending
+        self.received = 0 # Values submitted
+        self.applied = 0 # Values applied
+        self.coalesced = 0 # Values dropped for a newer one before being applied
+
+    def submit(self, value):
+        """
+        Set the value to apply next, replacing the pending one.
+
+        Args:
+            value: The value to apply.
+        """
+        if self.pending is not None:
+            self.coalesced += 1
+        self.pending = value
+        self.received += 1
+        self.event.set()
+
+    def cancel(self):
+        """
+        Drop the pending value, superseded by a command applied directly.
+        """
+        if self.pending is not None:
+            self.coalesced += 1
+            self.pending = None
+
+    async def run(self):
+        """
+        Task that applies the pending value, waiting the interval after every one.
+        """
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            if self.pending is None:
+                continue # Cancelled meanwhile
+            value = self.pending
+            self.pending = None
+            spLock.acquire() # Lock to avoid race conditions
+            try:
+                self.apply(value)
+                notify_change() # Send the new state to the subscribers if it changed
+            finally:
+                spLock.release() # Release the lock
+            self.applied += 1
+            await asyncio.sleep_ms(self.interval_ms)
+
+    def json(self):
+        """
+        Get the counters of the updates.
+
+        Returns:
+            bytes: The JSON-formatted number of updates received, applied and coalesced.
+        """
+        return ('{"received": ' + str(self.received) + ', "applied": ' + str(self.applied) \
+                + ', "coalesced": ' + str(self.coalesced) + '}').encode()
+
+
+# Colors sent by the clients, applied at a bounded rate
+color_updates = Coalescer(apply_color, UPDATE_INTERVAL_MS)
+
+
+def dispatch(method, endpoint, parameters, body, if_none_match):
     """
-    Start a web server to handle client requests for controlling the RGB Matrix.
+    Run the handler of an endpoint. The caller holds spLock.
 
     Args:
-        connection (socket): The socket connection to handle.
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        body (memoryview): The body of the request.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply.
     """
     data_send = False
+    data = None
+    content_type = CONTENT_TEXT
+    etag = None
+
+    if method == 'POST':
+        color_updates.cancel() # A command applied directly supersedes the pending one
+
+    if endpoint == 'change_color':
+        status_code = change_color(method, parameters)
+
+    elif endpoint == 'frame':
+        status_code = change_frame(method, body)
+
+    elif endpoint == 'pixels':
+        status_code = change_pixels(method, body)
+
+    elif endpoint == 'effect':
+        status_code, data_send, data = change_effect(method, parameters, body)
+        content_type = CONTENT_JSON
+
+    elif endpoint == 'coalescing':
+        status_code, data_send, data = check_coalescing(method)
+        content_type = CONTENT_JSON
+
+    elif endpoint == 'check_status':
+        status_code, data_send, data = check_status(method, if_none_match)
+        content_type = CONTENT_JSON
+        if status_code == 200 or status_code == 304:
+            etag = state.etag()
+
+    elif endpoint == 'metrics':
+        status_code, data_send, data = check_metrics(method)
+
+    else:
+        status_code = 400 # Bad request for invalid endpoints
+
+    if data_send == False:
+        data = b""
+
+    return status_code, content_type, data, etag
+
+
+def run_batch(method, body):
+    """
+    Runs a list of operations one after the other and gathers their replies, so a client can
+    change several values and read the state in one request. The caller holds spLock.
+
+    Args:
+        method (str): The HTTP method (only accepts 'POST').
+        body (memoryview): JSON list of the operations, each one an object with the endpoint
+                           ('op'), and optionally its parameters ('params', a query string or
+                           an object) and its HTTP method ('method', 'POST' by default).
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+        data (bytes): JSON list with the status code of every operation and its reply if any.
+    """
+    if method != 'POST':
+        return 405, b"" # Method Not Allowed (only POST is allowed)
+
+    # Check the whole list before running anything, so a malformed batch changes nothing
+    try:
+        operations = []
+        for operation in json.loads(bytes(body)):
+            parameters = operation.get("params", "")
+            if isinstance(parameters, dict):
+                parameters = "&".join([key + "=" + str(value) for key, value in parameters.items()])
+            operations.append((operation.get("method", "POST"), operation["op"], parameters))
+    except:
+        return 400, b"" # Bad Request
+    if len(operations) == 0 or len(operations) > MAX_BATCH:
+        return 400, b"" # Bad Request
+
+    results = []
+    for method, endpoint, parameters in operations:
+        if endpoint == 'batch':
+            status_code = 400 # Bad Request, batches can not be nested
+            content_type = CONTENT_TEXT
+            data = b""
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None, None)
+        result = b'{"op": ' + json.dumps(endpoint).encode() + b', "status": ' + str(status_code).encode()
+        if content_type == CONTENT_JSON and len(data) > 0:
+            result += b', "data": ' + data
+        results.append(result + b"}")
+
+    return 200, b"[" + b", ".join(results) + b"]"
+
+
+def submit_update(method, endpoint, parameters):
+    """
+    Hand a color over to the coalescing task instead of applying it at once, for the requests
+    that arrive in floods (HTTP and UDP). The batches and the MQTT commands are applied directly.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+
+    Returns:
+        int: The HTTP status code, or None if the request is not coalesced.
+    """
+    if endpoint == 'change_color' and method == 'POST':
+        return change_color(method, parameters, color_updates)
+    return None
+
+
+def route_request(method, endpoint, parameters, body, if_none_match):
+    """
+    Route the request to the appropriate handler based on the endpoint.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        body (memoryview): The body of the request.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply.
+    """
+    started = ticks_us()
+    status_code = submit_update(method, endpoint, parameters)
+    if status_code is not None:
+        metrics.observe(PHASE_HANDLER, ticks_diff(ticks_us(), started))
+        return status_code, CONTENT_TEXT, b"", None # Answered before the update is applied
+
+    spLock.acquire() # Lock to avoid race conditions
+    locked = ticks_us()
+    metrics.observe(PHASE_LOCK, ticks_diff(locked, started))
+    try:
+        if endpoint == 'batch':
+            status_code, data = run_batch(method, body) # Every operation runs under this single lock
+            content_type = CONTENT_JSON
+            etag = None
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, body, if_none_match)
+
+        notify_change() # Send the new state to the subscribers if it changed, once for a whole batch
+    finally:
+        spLock.release() # Release the lock
+    metrics.observe(PHASE_HANDLER, ticks_diff(ticks_us(), locked))
+
+    return status_code, content_type, data, etag
+
+
+class Metrics:
+    """
+    Lightweight counters of the web server, served in the Prometheus text format by '/metrics'.
+    The time of every phase of the requests is counted in a histogram of fixed buckets, so
+    recording it only increases two numbers.
+    """
+    __slots__ = ("counts", "sums", "requests", "connections")
+
+    def __init__(self):
+        # Times counted in every bucket of every phase, the last bucket is above all the bounds
+        self.counts = [[0] * (len(METRICS_BUCKETS_US) + 1) for _ in PHASES]
+        self.sums = [0] * len(PHASES) # Total time in us of every phase
+        self.requests = {} # Requests answered for every pair of endpoint and status code
+        self.connections = 0 # Connections accepted
+
+    def observe(self, phase, us):
+        """
+        Count the time taken by a phase of a request.
+
+        Args:
+            phase (int): The index of the phase in PHASES.
+            us (int): The time taken in us.
+        """
+        index = 0
+        for bound in METRICS_BUCKETS_US:
+            if us <= bound:
+                break
+            index += 1
+        self.counts[phase][index] += 1
+        self.sums[phase] += us
+
+    def count(self, endpoint, status_code):
+        """
+        Count a request answered.
+
+        Args:
+            endpoint (str): The requested endpoint, None if the request was malformed.
+            status_code (int): The HTTP status code of the reply.
+        """
+        key = (endpoint or "", status_code)
+        if key not in self.requests and len(self.requests) >= METRICS_MAX_SERIES:
+            key = ("other", status_code) # Endpoints sent by the clients could fill the memory
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def text(self):
+        """
+        Format the metrics in the Prometheus text format.
+
+        Returns:
+            bytes: One line for every value, with the histograms in us.
+        """
+        lines = ["# HELP request_phase_us Time spent in every phase of the requests in us",
+                 "# TYPE request_phase_us histogram"]
+        for phase in range(len(PHASES)):
+            label = 'request_phase_us_bucket{phase="' + PHASES[phase] + '",le="'
+            counts = self.counts[phase]
+            total = 0
+            for index in range(len(METRICS_BUCKETS_US)):
+                total += counts[index]
+                lines.append(label + str(METRICS_BUCKETS_US[index]) + '"} ' + str(total))
+            total += counts[-1]
+            lines.append(label + '+Inf"} ' + str(total))
+            lines.append('request_phase_us_sum{phase="' + PHASES[phase] + '"} ' + str(self.sums[phase]))
+            lines.append('request_phase_us_count{phase="' + PHASES[phase] + '"} ' + str(total))
+
+        lines.append("# HELP requests_total Requests answered by endpoint and status code")
+        lines.append("# TYPE requests_total counter")
+        for key, value in self.requests.items():
+            endpoint = key[0].replace("\\", "\\\\").replace('"', '\\"') # Escaped for the label
+            lines.append('requests_total{endpoint="' + endpoint + '",status="' + str(key[1]) + '"} ' + str(value))
+
+        lines.append("# HELP connections_total Connections accepted")
+        lines.append("# TYPE connections_total counter")
+        lines.append("connections_total " + str(self.connections))
+        lines.append("# HELP memory_free_bytes Free memory of the heap")
+        lines.append("# TYPE memory_free_bytes gauge")
+        lines.append("memory_free_bytes " + str(gc.mem_free()))
+        lines.append("# HELP memory_allocated_bytes Allocated memory of the heap")
+        lines.append("# TYPE memory_allocated_bytes gauge")
+        lines.append("memory_allocated_bytes " + str(gc.mem_alloc()))
+        lines.append("# HELP uptime_seconds Time since the boot")
+        lines.append("# TYPE uptime_seconds gauge")
+        lines.append("uptime_seconds " + str(time() - BOOT_TIME))
+        return ("\n".join(lines) + "\n").encode()
+
+
+metrics = Metrics() # Counters of the web server
+
+
+async def receive_into(reader, view):
+    """
+    Receive data from the client directly into a preallocated buffer.
+
+    Args:
+        reader (StreamReader): The stream to receive the data from.
+        view (memoryview): The free part of the receive buffer.
+
+    Returns:
+        int: The number of bytes received, 0 if the connection was closed.
+    """
+    if hasattr(reader, "readinto"):
+        return await reader.readinto(view)
+    chunk = await reader.read(len(view)) # CPython streams have no readinto()
+    view[:len(chunk)] = chunk
+    return len(chunk)
+
+
+async def handle_client(reader, writer):
+    """
+    Handle a persistent client connection, answering pipelined requests in order.
+
+    Args:
+        reader (StreamReader): The stream to receive the requests from.
+        writer (StreamWriter): The stream to send the replies to.
+    """
+    # Requests are received into a preallocated buffer and parsed in place
+    buffer = buffer_pool.pop() if buffer_pool else bytearray(MAX_REQUEST_SIZE)
+    view = memoryview(buffer)
+    start = 0 # Position of the next request in the buffer
+    end = 0 # Position where the received data ends
+    served = 0
+    keep_alive = True
+    metrics.connections += 1
+    try:
+        while keep_alive:
+            parsing = ticks_us()
+            try:
+                request = parse_request(buffer, start, end)
+            except ValueError as e:
+                print(e) # Malformed request, reply and close the connection
+                request = (None, None, None, None, end - start, False, None)
+
+            if request is None:
+                # Move the partial request to the front of the buffer and receive the rest
+                if start > 0:
+                    view[:end - start] = view[start:end]
+                    end -= start
+                    start = 0
+                timeout = READ_TIMEOUT if end else KEEPALIVE_TIMEOUT
+                waiting = ticks_us()
+                received = await asyncio.wait_for(receive_into(reader, view[end:]), timeout)
+                if not received:
+                    return # Connection closed by the client
+                if end:
+                    metrics.observe(PHASE_RECEIVE, ticks_diff(ticks_us(), waiting)) # Not the idle time between requests
+                end += received
+                continue
+
+            metrics.observe(PHASE_PARSE, ticks_diff(ticks_us(), parsing))
+
+            method, endpoint, parameters, body, size, keep_alive, if_none_match = request
+            start += size
+            if start == end:
+                start = end = 0
+            served += 1
+            if served >= MAX_REQUESTS:
+                keep_alive = False
+            print(method, endpoint, parameters)
+
+            if endpoint == 'events':
+                # Server-Sent Events keep the connection until the client leaves
+                if method != 'GET':
+                    status_code, content_type, data, etag = 405, CONTENT_TEXT, b"", None
+                elif len(subscribers) >= MAX_SUBSCRIBERS:
+                    status_code, content_type, data, etag = 503, CONTENT_TEXT, b"", None
+                else:
+                    metrics.count(endpoint, 200)
+                    await stream_events(writer)
+                    break
+            else:
+                # Long-poll requests ('wait' parameter) are answered on the next change
+                if endpoint == 'check_status' and parameters != None:
+                    await wait_for_change(parameters)
+                status_code, content_type, data, etag = route_request(method, endpoint, parameters, body, if_none_match)
+
+            metrics.count(endpoint, status_code)
+
+            # Send HTTP status code and data in a single write
+            sending = ticks_us()
+            writer.write(build_response(status_code, content_type, data, keep_alive, etag))
+
+            # Replies to pipelined requests are flushed together
+            if not keep_alive or find_head_end(buffer, start, end) < 0:
+                await writer.drain()
+            metrics.observe(PHASE_SEND, ticks_diff(ticks_us(), sending))
+    except Exception as e:
+        print(e) # Timed out or connection lost
+    finally:
+        if len(buffer_pool) < BACKLOG:
+            buffer_pool.append(buffer) # Keep the buffer for the next connection
+        writer.close() # Close the client connection
+        await writer.wait_closed()
+
+
+def run_opcode(opcode, payload):
+    """
+    Run the handler of a binary control message, as an HTTP request to the same endpoint would.
+
+    Args:
+        opcode (int): The operation, a key of UDP_OPCODES.
+        payload (memoryview): The values of the operation, packed as its layout tells.
+
+    Returns:
+        status_code (int): The HTTP status code of the handler (400 for unknown or malformed messages).
+        data (bytes): The JSON reply of the handler, empty if it has none.
+    """
+    if opcode not in UDP_OPCODES:
+        return 400, b"" # Bad Request for unknown opcodes
+    method, endpoint, layout, template = UDP_OPCODES[opcode]
+    try:
+        if layout is None:
+            parameters = template
+            body = payload # Sent as it comes, like the body of the HTTP request
+        else:
+            parameters = template % struct.unpack(layout, payload)
+            body = None
+    except:
+        return 400, b"" # Bad Request, the payload does not fit the layout
+
+    status_code = submit_update(method, endpoint, parameters)
+    if status_code is not None:
+        return status_code, b"" # Answered before the update is applied
+
+    spLock.acquire() # Lock to avoid race conditions
+    try:
+        status_code, content_type, data, etag = dispatch(method, endpoint, parameters, body, None)
+        notify_change() # Send the new state to the subscribers if it changed
+    finally:
+        spLock.release() # Release the lock
+
+    return status_code, data
+
+
+async def serve_udp(ip):
+    """
+    Serve the binary control messages received on the UDP port, polling the socket between the
+    other tasks. A message holds the opcode (1 byte), a sequence number (2 bytes, big-endian, one
+    more for every message of the client) and the payload. Messages older than the last one of the
+    same client are dropped, and the rest are answered with the opcode, the sequence number, the
+    HTTP status code (2 bytes, big-endian) and the JSON reply if any.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(socket.getaddrinfo(ip, UDP_PORT)[0][-1])
+    sock.setblocking(False)
+    sequences = {} # Last sequence number received from every client
+
     while True:
-        client = connection.accept()[0] # Accept a client connection
-        request = client.recv(1024) # Receive the request
-        request = str(request)
-        print(request)
         try:
-            method, endpoint, parameters = request_data_extractor(request) # Extract request details
+            packet, address = sock.recvfrom(UDP_MAX_SIZE)
+        except OSError:
+            await asyncio.sleep_ms(UDP_POLL_MS) # Nothing received
+            continue
+        if len(packet) < 3:
+            continue # Too short to be a message
+
+        # Drop the messages overtaken by a newer one, a client starts again from 0 after a restart
+        opcode = packet[0]
+        sequence = packet[1] << 8 | packet[2]
+        last = sequences.get(address)
+        if last is not None and sequence != 0 and not 0 < (sequence - last) & 0xFFFF < 0x8000:
+            continue
+        if last is None and len(sequences) >= UDP_MAX_CLIENTS:
+            sequences.clear() # Forget the clients gone quiet
+        sequences[address] = sequence
+
+        status_code, data = run_opcode(opcode, memoryview(packet)[3:])
+        try:
+            sock.sendto(struct.pack(">BHH", opcode, sequence, status_code) + data, address)
+        except OSError:
+            pass # The reply is lost like any datagram, the next message carries the new state anyway
+        await asyncio.sleep_ms(0) # Let the other tasks run between two messages
+
+
+def mqtt_command(topic, message):
+    """
+    Run a command received from the broker, as a POST request to the endpoint named by the last
+    level of its topic would. The message holds the parameters, or the body for the binary endpoints.
+
+    Args:
+        topic (bytes): The topic of the command, '<MQTT_TOPIC>/cmd/<endpoint>'.
+        message (bytes): The parameters of the command, such as 'red=255&green=0&blue=0&brightness=100'.
+    """
+    endpoint = topic[len(MQTT_TOPIC) + 5:].decode()
+    if endpoint == 'frame' or endpoint == 'pixels':
+        parameters = ""
+        body = memoryview(message)
+    else:
+        try:
+            parameters = message.decode()
         except:
-            endpoint = None    
-        
-        spLock.acquire() # Lock to avoid race conditions
-        
-        # Route the request to the appropriate handler based on the endpoint
-        if endpoint == 'change_color':
-            status_code = change_color(method,parameters)
-        
-        elif endpoint == 'check_status':
-            status_code, data_send, data = check_status(method)
-            
-        else:
-            status_code = 400 # Bad request for invalid endpoints
+            return # Not text, ignored like a malformed request
+        body = None
 
+    spLock.acquire() # Lock to avoid race conditions
+    try:
+        status_code, content_type, data, etag = dispatch("POST", endpoint, parameters, body, None)
+        notify_change() # Send the new state to the subscribers if it changed
+    finally:
         spLock.release() # Release the lock
 
-        # Send HTTP response status
-        client.send(status_code_set(status_code))
-        
-        # Send data if needed
-        if data_send == True:
-            client.send(data)
-            data_send = False
-        
-        client.close() # Close the client connection
+    if status_code != 200:
+        print("MQTT command", endpoint, "failed with", status_code)
 
-def button_task():
+
+async def run_mqtt():
     """
-    Task to toggle the RGB Matrix status between on and off using a physical button press.
+    Keep a session with the MQTT broker: publish the state retained on '<MQTT_TOPIC>/state' every
+    time it changes and run the commands received on '<MQTT_TOPIC>/cmd/<endpoint>', reconnecting
+    with an increasing backoff when the broker is lost. The retained '<MQTT_TOPIC>/online' topic
+    tells whether the device is connected.
     """
+    backoff = MQTT_BACKOFF_MIN
+    while True:
+        client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        try:
+            client.set_callback(mqtt_command)
+            client.set_last_will(MQTT_TOPIC + b"/online", b"0", True)
+            client.connect()
+            client.publish(MQTT_TOPIC + b"/online", b"1", True)
+            client.subscribe(MQTT_TOPIC + b"/cmd/+", MQTT_QOS)
+            backoff = MQTT_BACKOFF_MIN
+            published = -1 # Version of the state last published
+            last_sent = ticks_ms()
 
-    old_value_button = 0
-    button = Pin(16, Pin.IN) # Initialize push button on Pin 16 as input
+            while True:
+                client.check_msg() # Run the commands received, if any
+                if state.version != published:
+                    spLock.acquire() # Lock to avoid race conditions
+                    try:
+                        published = state.version
+                        message = state.json()
+                    finally:
+                        spLock.release() # Release the lock
+                    client.publish(MQTT_TOPIC + b"/state", message, True, MQTT_QOS)
+                    last_sent = ticks_ms()
+                elif ticks_diff(ticks_ms(), last_sent) >= MQTT_KEEPALIVE * 500:
+                    client.ping() # Keep the session alive while the state does not change
+                    last_sent = ticks_ms()
+                await asyncio.sleep_ms(MQTT_POLL_MS)
+        except OSError as error:
+            print("MQTT broker lost:", error)
 
+        try:
+            client.sock.close()
+        except:
+            pass # The connection never opened
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MQTT_BACKOFF_MAX)
+
+
+async def serve(ip):
+    """
+    Start the button task and a web server that handles client requests for controlling the RGB Matrix concurrently.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    asyncio.create_task(button.run()) # Handle the physical button presses
+    asyncio.create_task(color_updates.run()) # Apply the colors sent, dropping the stale ones
+    if UDP_ENABLED:
+        asyncio.create_task(serve_udp(ip)) # Serve the binary control messages
+    if MQTT_ENABLED and MQTTClient is not None:
+        asyncio.create_task(run_mqtt()) # Publish the state and receive the commands through the broker
+    await asyncio.start_server(handle_client, ip, PORT, backlog=BACKLOG)
     while True:
-        new_value_button = button.value() # Read button state
-
-        # Detect button press (from 0 to 1)
-        if old_value_button == 0 and new_value_button == 1:
-            spLock.acquire()
-            # Get actual values of the matrix, if all 0 it means it is off
-            values = matrix.get_pixel(1)
-            if values[0] == 0 and values[1] == 0 and values[2] == 0:
-                set_matrix(last_values[0], last_values[1], last_values[2], last_values[3]) #T urn on
+        await asyncio.sleep(3600) # Keep serving forever
+
+
+class Button:
+    """
+    Push button read through pin interrupts, debounced and classified into
+    press, long press and double press without polling.
+    """
+
+    def __init__(self, pin, on_press, on_long_press=None, on_double_press=None,
+                 debounce_ms=DEBOUNCE_MS, long_press_ms=LONG_PRESS_MS, double_press_ms=DOUBLE_PRESS_MS):
+        """
+        Args:
+            pin (Pin): The input pin of the button (1 when pressed).
+            on_press (function): Called on a short press.
+            on_long_press (function): Called when the button is released after being held,
+                                      a short press is reported instead if it is None.
+            on_double_press (function): Called on two short presses in a row, if it is None
+                                        short presses are reported without waiting.
+            debounce_ms (int): Time in ms the contacts need to settle after an edge.
+            long_press_ms (int): Minimum time in ms the button is held for a long press.
+            double_press_ms (int): Maximum time in ms between the presses of a double press.
+        """
+        self.pin = pin
+        self.on_press = on_press
+        self.on_long_press = on_long_press
+        self.on_double_press = on_double_press
+        self.debounce_ms = debounce_ms
+        self.long_press_ms = long_press_ms
+        self.double_press_ms = double_press_ms
+        self.flag = asyncio.ThreadSafeFlag()
+        self.pin.irq(handler=self.edge, trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING, hard=True)
+
+    def edge(self, pin):
+        """
+        Interrupt handler of the pin, it only wakes up the button task.
+
+        Args:
+            pin (Pin): The pin that triggered the interrupt.
+        """
+        self.flag.set()
+
+    async def run(self):
+        """
+        Task that classifies the debounced presses and runs their actions.
+        """
+        pressed = False
+        pressed_at = 0
+        released_at = 0
+        waiting_double = False # A short press may still become a double press
+
+        while True:
+            # Sleep until an edge arrives, or until the double press window ends
+            if waiting_double:
+                remaining = self.double_press_ms - ticks_diff(ticks_ms(), released_at)
+                try:
+                    await asyncio.wait_for_ms(self.flag.wait(), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    waiting_double = False
+                    self.on_press()
+                    continue
             else:
-                set_matrix(0,0,0,matrix.brightnessvalue) # Turn off
-            spLock.release()
+                await self.flag.wait()
+
+            # Ignore the bounces, only the settled level counts
+            edge_at = ticks_ms()
+            await asyncio.sleep_ms(self.debounce_ms)
+            value = self.pin.value()
+
+            if value == 1 and not pressed:
+                pressed = True
+                pressed_at = edge_at
+            elif value == 0 and pressed:
+                pressed = False
+                if self.on_long_press is not None and ticks_diff(edge_at, pressed_at) >= self.long_press_ms:
+                    waiting_double = False
+                    self.on_long_press()
+                elif self.on_double_press is None:
+                    self.on_press()
+                elif waiting_double:
+                    waiting_double = False
+                    self.on_double_press()
+                else:
+                    waiting_double = True
+                    released_at = edge_at
+
 
-        old_value_button = new_value_button
+def button_pressed():
+    """
+    Toggle the RGB Matrix status between on and off when the physical button is pressed.
+    """
+    spLock.acquire()
+    color_updates.cancel() # The button supersedes the color still pending
+    if state.is_on() == False:
+        values = state.last_values
+        set_matrix(values[0], values[1], values[2], values[3]) # Turn on
+    else:
+        set_matrix(0,0,0,state.brightness) # Turn off
+    notify_change()
+    spLock.release()
+
+
+def button_long_pressed():
+    """
+    Restore the default color of the RGB Matrix when the physical button is held.
+    """
+    spLock.acquire()
+    color_updates.cancel() # The button supersedes the color still pending
+    set_matrix(DEFAULT_VALUES[0], DEFAULT_VALUES[1], DEFAULT_VALUES[2], DEFAULT_VALUES[3])
+    notify_change()
+    spLock.release()
 
 
 # Main code execution
 try:
-    _thread.start_new_thread(button_task, ()) # Start button task in a new thread
+    button = Button(Pin(16, Pin.IN), button_pressed, button_long_pressed) # Push button on Pin 16
+    _thread.start_new_thread(animation_task, ()) # Start the animation engine on the second core
     ip = connect() # Connect to the WLAN and get IP address
-    connection = open_socket(ip) # Open socket for communication
-    serve(connection) # Start serving requests
+    asyncio.run(serve(ip)) # Start serving requests
 except KeyboardInterrupt:
     reset() # Reset the device if interrupted
 
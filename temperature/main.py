@@ -1,16 +1,161 @@
 import network
+import micropython
+from time import sleep, ticks_ms, ticks_us, ticks_diff, time
+import gc
+from random import getrandbits
+from array import array
+import struct
 import socket
-from time import sleep
+import json
 from machine import Pin
 import machine
 from wlan import SSID, PASSWORD
+try:
+    import uasyncio as asyncio # Asynchronous I/O on the device
+except ImportError:
+    import asyncio
+try:
+    from umqtt.simple import MQTTClient # MQTT client of micropython-lib, only needed for the MQTT mode
+except ImportError:
+    MQTTClient = None
+from binascii import hexlify
 from dht import DHT11 # Import the DHT11 module in order to interact with the DHT11 sensor
 
 
+class SensorState:
+    """
+    Authoritative last reading of the sensor. Every new value increases the version,
+    so the JSON of the reading is only formatted again after a change.
+    """
+    __slots__ = ("temperature", "humidity", "timestamp", "errors", "version", "cached", "cached_etag", "cached_version")
+
+    def __init__(self):
+        self.temperature = None
+        self.humidity = None
+        self.timestamp = None # ticks_ms of the last successful reading
+        self.errors = 0 # Number of failed readings
+        self.version = 0 # Increased on every change of the values
+        self.cached = b"" # JSON of the reading
+        self.cached_etag = b"" # ETag of the state
+        self.cached_version = -1 # Version the JSON was formatted for
+
+    def update(self, temperature, humidity):
+        """
+        Record a successful reading of the sensor.
+
+        Args:
+            temperature (float): The temperature read.
+            humidity (float): The humidity read.
+        """
+        self.timestamp = ticks_ms()
+        if temperature != self.temperature or humidity != self.humidity:
+            self.temperature = temperature
+            self.humidity = humidity
+            self.version += 1
+
+    def json(self):
+        """
+        Get the JSON of the reading, formatted again only after a change.
+
+        Returns:
+            bytes: The JSON-formatted temperature and humidity.
+        """
+        if self.cached_version != self.version:
+            self.cached = ('{"temperature": ' + str(self.temperature) + ', "humidity": ' + str(self.humidity) + '}').encode()
+            self.cached_etag = ('"' + BOOT_ID + '-' + str(self.version) + '"').encode()
+            self.cached_version = self.version
+        return self.cached
+
+    def etag(self):
+        """
+        Get the entity tag of the state, sent in the ETag header of the status replies.
+
+        Returns:
+            bytes: The quoted tag, made of the boot identifier and the version.
+        """
+        self.json() # The tag is formatted along with the JSON after a change
+        return self.cached_etag
+
+
 # Set up the DHT11 sensor on Pin 26
 dht_pin = Pin(26, Pin.OUT, Pin.PULL_DOWN)
 dht_sensor = DHT11(dht_pin)
 
+# DHT11 sampling configuration
+DHT_INTERVAL = 2 # Seconds between two readings of the sensor (the DHT11 allows one per second)
+
+# Last reading of the sensor, served by the 'check_dht' endpoint
+state = SensorState()
+
+# History configuration
+HISTORY_SIZE = 2160 # Samples kept in the history (6 hours at one sample every 10 seconds)
+HISTORY_INTERVAL = 10 # Seconds between two samples of the history
+HISTORY_CHUNK = 32 # Samples sent in every chunk of the 'history' endpoint
+
+# Rollups configuration, pairs of (resolution in seconds, buckets kept)
+ROLLUPS = ((60, 60), (900, 96), (3600, 48)) # 1 hour by minute, 1 day by 15 minutes, 2 days by hour
+
+# HTTP server configuration
+PORT = 80 # Port the web server listens on
+BACKLOG = 5 # Maximum number of pending client connections
+READ_TIMEOUT = 5 # Seconds to wait for a client to send its request
+KEEPALIVE_TIMEOUT = 10 # Seconds an idle persistent connection is kept open
+MAX_REQUESTS = 100 # Requests served on a persistent connection before closing it
+MAX_REQUEST_SIZE = 1024 # Maximum size in bytes of a request (head and body)
+MAX_BATCH = 16 # Maximum number of operations in a batch request
+
+# Binary control protocol over UDP, for the updates sent continuously (such as a slider being dragged)
+UDP_ENABLED = True # Whether the UDP port is served alongside the HTTP API
+UDP_PORT = 5005 # Port the binary control messages are received on
+UDP_MAX_SIZE = 64 # Maximum size in bytes of a message
+UDP_POLL_MS = 5 # Time in ms between two polls of the UDP socket while it is idle
+UDP_MAX_CLIENTS = 8 # Clients whose last sequence number is kept
+# Handler run for every opcode: (method, endpoint, struct layout of the payload, parameters filled with the payload)
+UDP_OPCODES = {
+    16: ("GET", "check_dht", "", ""),
+}
+
+# MQTT configuration, the state is published retained
+MQTT_ENABLED = False # Whether to connect to the broker (needs the umqtt.simple library)
+MQTT_BROKER = "192.168.1.200" # Address of the MQTT broker
+MQTT_PORT = 1883 # Port of the MQTT broker
+MQTT_TOPIC = b"home/temperature" # Prefix of the topics of this device
+MQTT_CLIENT_ID = b"temperature-" + hexlify(machine.unique_id()) # Unique client identifier
+MQTT_QOS = 1 # Quality of service of the state (0 or 1)
+MQTT_KEEPALIVE = 60 # Seconds the broker waits for a message before dropping the session
+MQTT_POLL_MS = 50 # Time in ms between two checks of the session
+MQTT_BACKOFF_MIN = 1 # Seconds to wait before reconnecting after the first failure
+MQTT_BACKOFF_MAX = 60 # Maximum seconds to wait before reconnecting, doubled after every failure
+
+# Metrics configuration
+PHASES = ("receive", "parse", "lock", "handler", "send") # Phases of a request timed by the metrics
+PHASE_RECEIVE = 0 # Index of the time waiting for the rest of a request
+PHASE_PARSE = 1 # Index of the time parsing a request
+PHASE_LOCK = 2 # Index of the time waiting for spLock
+PHASE_HANDLER = 3 # Index of the time running the handler
+PHASE_SEND = 4 # Index of the time sending the reply
+METRICS_BUCKETS_US = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000) # Upper bounds of the histograms
+METRICS_MAX_SERIES = 32 # Pairs of endpoint and status code counted apart, the rest are counted as 'other'
+BOOT_TIME = time() # Time of the boot in seconds, for the uptime
+
+# Content types of the replies
+CONTENT_TYPES = ("text/plain", "application/json", "text/event-stream")
+CONTENT_TEXT = 0 # Index of the plain text content type
+CONTENT_JSON = 1 # Index of the JSON content type
+CONTENT_EVENTS = 2 # Index of the Server-Sent Events content type
+
+# Identifier of this boot in the ETag of the state, so tags from before a restart never match
+BOOT_ID = str(getrandbits(24))
+
+# Receive buffers reused across connections
+buffer_pool = [bytearray(MAX_REQUEST_SIZE) for _ in range(BACKLOG)]
+
+# Events configuration
+EVENT_QUEUE_SIZE = 8 # Pending events kept for a slow subscriber, the oldest ones are dropped
+MAX_SUBSCRIBERS = 4 # Maximum number of clients streaming events or long-polling at once
+LONG_POLL_MAX = 60 # Maximum seconds a long-poll request waits for a change
+EVENTS_PING = 15 # Seconds between the comments that keep an idle event stream open
+
 
 def connect():
     """
@@ -38,93 +183,548 @@ def connect():
     return ip
     
 
-def open_socket(ip):
+def build_header_table(statuses):
     """
-    Open a socket for communication.
+    Pre-encode the headers of the replies for every status code and content type.
 
     Args:
-        ip (str): The IP address of the device.
+        statuses (tuple): Pairs of (status_code, reason) for the status codes used.
 
     Returns:
-        socket: The opened socket for communication.
+        dict: For each status code, a list indexed by content type with the encoded
+              headers up to the value of the Content-Length header.
     """
-    address = (ip, 80) # IP address and port for the socket
-    connection = socket.socket() # Create a new socket
-    connection.bind(address) # Bind the socket to the address
-    connection.listen(1) # Listen for incoming connections
+    table = {}
+    for status_code, reason in statuses:
+        table[status_code] = [("HTTP/1.1 " + str(status_code) + " " + reason + "\r\n"
+                               + "Content-Type: " + content_type + "\r\n"
+                               + "Access-Control-Allow-Origin: *\r\n"
+                               + "Content-Length: ").encode() for content_type in CONTENT_TYPES]
+    return table
 
-    return connection
 
+# Pre-encoded headers of the replies
+response_headers = build_header_table(((200, "OK"), (400, "Bad Request"), (405, "Method Not Allowed"), (500, "Internal Server Error"), (503, "Service Unavailable")))
+KEEP_ALIVE_END = ("\r\nConnection: keep-alive\r\nKeep-Alive: timeout=" + str(KEEPALIVE_TIMEOUT) \
+    + ", max=" + str(MAX_REQUESTS) + "\r\n\r\n").encode()
+CLOSE_END = b"\r\nConnection: close\r\n\r\n"
+ETAG_HEADER = b"\r\nETag: "
+NOT_MODIFIED_HEAD = b"HTTP/1.1 304 Not Modified\r\nAccess-Control-Allow-Origin: *\r\nETag: " # 304 replies have no body nor length
 
-def status_code_set(status_code):
+# Pre-encoded headers of the Server-Sent Events stream, which lasts until the connection closes
+EVENTS_HEAD = response_headers[200][CONTENT_EVENTS].replace(b"Content-Length: ", b"Cache-Control: no-cache") + CLOSE_END
+
+# Pre-encoded headers of the successful replies streamed in chunks
+chunked_headers = [headers.replace(b"Content-Length: ", b"Transfer-Encoding: chunked") for headers in response_headers[200]]
+
+
+def build_response(status_code, content_type, data, keep_alive, etag=None):
     """
-    Generate HTTP status response based on the given status code.
+    Build a complete HTTP reply from the pre-encoded headers.
 
     Args:
-        status_code (int): The HTTP status code (200, 400, 405, 500).
+        status_code (int): The HTTP status code (200, 304, 400, 405, 500, 503).
+        content_type (int): The content type of the data (CONTENT_TEXT or CONTENT_JSON).
+        data (bytes): The data sent after the headers.
+        keep_alive (bool): Whether the connection is kept open after the reply.
+        etag (bytes): The tag of the state sent in the ETag header, or None.
 
     Returns:
-        str: The corresponding HTTP status response.
+        bytes: The headers followed by the data, to be sent with a single write.
+    """
+    if keep_alive:
+        headers_end = KEEP_ALIVE_END
+    else:
+        headers_end = CLOSE_END
+
+    if etag is None:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), headers_end, data))
+    elif status_code == 304:
+        return b"".join((NOT_MODIFIED_HEAD, etag, headers_end))
+    else:
+        return b"".join((response_headers[status_code][content_type], str(len(data)).encode(), ETAG_HEADER, etag, headers_end, data))
+
+
+async def send_chunked(writer, content_type, chunks, keep_alive):
+    """
+    Send a successful reply with chunked transfer encoding, so it is never built in memory.
+
+    Args:
+        writer (StreamWriter): The stream to send the reply to.
+        content_type (int): The content type of the data (CONTENT_TEXT or CONTENT_JSON).
+        chunks (generator): Generator of the encoded chunks of data.
+        keep_alive (bool): Whether the connection is kept open after the reply.
     """
-    if status_code == 200:
-        status_send = "HTTP/1.0 200 OK\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 400:
-        status_send = "HTTP/1.0 400 Bad Request\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 405:
-        status_send = "HTTP/1.0 405 Method Not Allowed\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
-    elif status_code == 500:
-        status_send = "HTTP/1.0 500 Internal Server Error\r\nContent-type: text/html\r\nAccess-Control-Allow-Origin: *\r\n\r\n"
+    if keep_alive:
+        writer.write(chunked_headers[content_type] + KEEP_ALIVE_END)
+    else:
+        writer.write(chunked_headers[content_type] + CLOSE_END)
 
-    return status_send
+    for chunk in chunks:
+        writer.write("{:x}\r\n".format(len(chunk)).encode())
+        writer.write(chunk)
+        writer.write(b"\r\n")
+        await writer.drain() # Send every chunk before building the next one
+    writer.write(b"0\r\n\r\n")
 
 
-def request_data_extractor(request):
+@micropython.viper
+def find_byte(buffer, start: int, end: int, byte: int) -> int:
     """
-    Extract the HTTP method, endpoint, and parameters from the request.
+    Find the first occurrence of a byte in buffer[start:end].
 
     Args:
-        request (str): The raw HTTP request string.
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+        byte (int): The byte value to look for.
 
     Returns:
-        tuple: (method, endpoint, parameters) extracted from the request.
+        int: The position of the byte, or -1 if it is not found.
     """
-    request = request.split()
-    method = request[0][2:] # Extract the HTTP method (e.g., GET, POST)    
-    request = request[1].split("/")
-    request = request[1].split("?")
-    endpoint = request[0] # Extract the endpoint
+    data = ptr8(buffer)
+    position = start
+    while position < end:
+        if data[position] == byte:
+            return position
+        position += 1
+    return -1
 
-    # Extract parameters (if any)
-    if len(request) == 1:
+
+@micropython.viper
+def find_head_end(buffer, start: int, end: int) -> int:
+    """
+    Find the blank line that ends the head of a request in buffer[start:end].
+
+    Args:
+        buffer (bytearray): The buffer to search in.
+        start (int): Position where the search starts.
+        end (int): Position where the search ends.
+
+    Returns:
+        int: The position of the blank line, or -1 if it is not found.
+    """
+    data = ptr8(buffer)
+    position = start
+    while position + 3 < end:
+        if data[position] == 13 and data[position + 1] == 10 \
+            and data[position + 2] == 13 and data[position + 3] == 10:
+            return position
+        position += 1
+    return -1
+
+
+@micropython.viper
+def header_matches(buffer, start: int, end: int, name) -> bool:
+    """
+    Compare buffer[start:end] with a lowercase name, ignoring the case of the buffer.
+
+    Args:
+        buffer (bytearray): The buffer holding the header.
+        start (int): Position where the header name or value starts.
+        end (int): Position where the header name or value ends.
+        name (bytes): The lowercase name to compare with (e.g., b"connection").
+
+    Returns:
+        bool: True if both are equal, False otherwise.
+    """
+    length = int(len(name))
+    if end - start != length:
+        return False
+    data = ptr8(buffer)
+    expected = ptr8(name)
+    index = 0
+    while index < length:
+        if (data[start + index] | 0x20) != expected[index]:
+            return False
+        index += 1
+    return True
+
+
+def parse_request(buffer, start, end):
+    """
+    Parse the request stored in buffer[start:end] without copying the buffer.
+
+    Args:
+        buffer (bytearray): The receive buffer of the connection.
+        start (int): Position where the request starts.
+        end (int): Position where the received data ends.
+
+    Returns:
+        tuple: (method, endpoint, parameters, body, size, keep_alive, if_none_match) where
+               body is a memoryview over the buffer, size is the length of the whole request
+               and if_none_match the value of the If-None-Match header (None if missing),
+               or None if the request has not been completely received yet.
+
+    Raises:
+        ValueError: If the request is malformed or does not fit in the buffer.
+    """
+    head_end = find_head_end(buffer, start, end)
+    if head_end < 0:
+        if end - start >= MAX_REQUEST_SIZE:
+            raise ValueError("Request too large")
+        return None # Wait for the rest of the head
+    view = memoryview(buffer)
+
+    # Request line (e.g., "POST /endpoint?key=value HTTP/1.1")
+    line_end = find_byte(buffer, start, head_end + 2, 13)
+    method_end = find_byte(buffer, start, line_end, 32)
+    if method_end < 0:
+        raise ValueError("Malformed request line")
+    target_end = find_byte(buffer, method_end + 1, line_end, 32)
+    if target_end < 0 or buffer[method_end + 1] != 47:
+        raise ValueError("Malformed request line")
+    method = str(view[start:method_end], "utf-8") # Extract HTTP method (GET, POST, etc.)
+    query = find_byte(buffer, method_end + 2, target_end, 63)
+    if query < 0:
+        endpoint = str(view[method_end + 2:target_end], "utf-8") # Extract endpoint
         parameters = None
     else:
-        parameters = request[1]
-    
-    return method, endpoint, parameters
+        endpoint = str(view[method_end + 2:query], "utf-8") # Extract endpoint
+        parameters = str(view[query + 1:target_end], "utf-8") # Extract parameters
+
+    # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones must ask for it
+    keep_alive = buffer[line_end - 1] == 49
+    length = 0
+    if_none_match = None
+
+    # Headers, only the ones needed by the server are looked at
+    position = line_end + 2
+    while position < head_end:
+        line_end = find_byte(buffer, position, head_end + 2, 13)
+        colon = find_byte(buffer, position, line_end, 58)
+        if colon > 0:
+            value = colon + 1
+            while value < line_end and buffer[value] == 32:
+                value += 1
+            if header_matches(buffer, position, colon, b"content-length"):
+                length = int(str(view[value:line_end], "utf-8"))
+            elif header_matches(buffer, position, colon, b"connection"):
+                keep_alive = header_matches(buffer, value, line_end, b"keep-alive")
+            elif header_matches(buffer, position, colon, b"if-none-match"):
+                if_none_match = bytes(view[value:line_end])
+        position = line_end + 2
+
+    body = head_end + 4
+    size = body + length - start
+    if size > MAX_REQUEST_SIZE:
+        raise ValueError("Request too large")
+    if start + size > end:
+        return None # Wait for the rest of the body
+
+    return method, endpoint, parameters, view[body:body + length], size, keep_alive, if_none_match
+
+
+def not_modified(if_none_match):
+    """
+    Check whether the client already has the current state, from the tags it sent.
+
+    Args:
+        if_none_match (bytes): The value of the If-None-Match header, or None.
+
+    Returns:
+        bool: True if one of the tags sent is the tag of the current state.
+    """
+    if if_none_match is None:
+        return False
+    return if_none_match == b"*" or state.etag() in if_none_match
+
+
+def read_dht():
+    """
+    Read the temperature and humidity from the DHT11 sensor and store them in the state.
+
+    Returns:
+        bool: True if the reading succeeded, False otherwise.
+    """
+    try:
+        temperature = dht_sensor.temperature
+        humidity = dht_sensor.humidity
+    except Exception as e:
+        print(e) # Print error message if the sensor reading fails
+        state.errors += 1
+        return False
+
+    state.update(temperature, humidity)
+    notify_change() # Send the new reading to the subscribers if it changed
+    return True
 
 
-def check_dht(method):
+def format_tenths(value):
     """
-    Handles the 'check_dht' endpoint, which returns the temperature and humidity data from the DHT11 sensor.
+    Format a fixed-point value in tenths as a decimal number.
+
+    Args:
+        value (int): The value in tenths (e.g., 215 for 21.5).
+
+    Returns:
+        str: The decimal representation of the value.
+    """
+    if value < 0:
+        return "-" + format_tenths(-value)
+    return str(value // 10) + "." + str(value % 10)
+
+
+class History:
+    """
+    Fixed-size ring buffer with the history of temperature and humidity, stored as
+    int16 tenths together with the timestamp of every sample in seconds.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size (int): Maximum number of samples kept, the oldest ones are overwritten.
+        """
+        self.size = size
+        self.timestamps = array("L", [0] * size)
+        self.temperatures = array("h", [0] * size)
+        self.humidities = array("h", [0] * size)
+        self.next = 0 # Position where the next sample is written
+        self.count = 0 # Number of samples stored
+
+    def append(self, timestamp, temperature, humidity):
+        """
+        Store a sample, overwriting the oldest one when the buffer is full.
+
+        Args:
+            timestamp (int): Time of the sample in seconds.
+            temperature (float): Temperature in degrees Celsius.
+            humidity (float): Relative humidity in percent.
+        """
+        self.timestamps[self.next] = timestamp
+        self.temperatures[self.next] = round(temperature * 10)
+        self.humidities[self.next] = round(humidity * 10)
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def first_since(self, since):
+        """
+        Find the oldest sample taken at or after a time, with a binary search.
+
+        Args:
+            since (int): Time in seconds.
+
+        Returns:
+            int: Index of the sample counted from the oldest one (count if there is none).
+        """
+        oldest = self.next - self.count
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[(oldest + middle) % self.size] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def chunks(self, since, limit):
+        """
+        Generate the samples taken at or after a time as encoded JSON chunks.
+
+        Args:
+            since (int): Time in seconds of the oldest sample sent.
+            limit (int): Maximum number of samples sent.
+
+        Yields:
+            bytes: Consecutive parts of the JSON document with the samples.
+        """
+        # The samples stored when the request arrives are the ones sent
+        oldest = self.next - self.count
+        first = self.first_since(since)
+        last = min(self.count, first + limit)
+
+        yield ('{"now": ' + str(int(time())) + ', "interval": ' + str(HISTORY_INTERVAL) + ', "samples": [').encode()
+        for chunk_start in range(first, last, HISTORY_CHUNK):
+            parts = []
+            for index in range(chunk_start, min(chunk_start + HISTORY_CHUNK, last)):
+                position = (oldest + index) % self.size
+                parts.append("[" + str(self.timestamps[position]) + ", " + format_tenths(self.temperatures[position]) \
+                    + ", " + format_tenths(self.humidities[position]) + "]")
+            if chunk_start > first:
+                parts.insert(0, "") # Separate this chunk from the previous one
+            yield ", ".join(parts).encode()
+        yield b"]}"
+
+
+class Rollup:
+    """
+    Minimum, maximum and mean of temperature and humidity aggregated in fixed-length
+    time buckets, updated in O(1) per sample and kept in a fixed-size ring buffer.
+    """
+
+    def __init__(self, resolution, size):
+        """
+        Args:
+            resolution (int): Length in seconds of every bucket.
+            size (int): Maximum number of buckets kept, the oldest ones are overwritten.
+        """
+        self.resolution = resolution
+        self.size = size
+        self.starts = array("L", [0] * size) # Start time of every bucket
+        self.counts = array("H", [0] * size) # Samples aggregated in every bucket
+        self.temperature_min = array("h", [0] * size)
+        self.temperature_max = array("h", [0] * size)
+        self.temperature_sum = array("l", [0] * size)
+        self.humidity_min = array("h", [0] * size)
+        self.humidity_max = array("h", [0] * size)
+        self.humidity_sum = array("l", [0] * size)
+        self.current = -1 # Position of the bucket being filled
+        self.count = 0 # Number of buckets stored
+
+    def add(self, timestamp, temperature, humidity):
+        """
+        Aggregate a sample into the bucket of its time, starting a new bucket if needed.
+
+        Args:
+            timestamp (int): Time of the sample in seconds.
+            temperature (int): Temperature in tenths of degree Celsius.
+            humidity (int): Relative humidity in tenths of percent.
+        """
+        start = timestamp - timestamp % self.resolution
+        position = self.current
+        if position < 0 or self.starts[position] != start:
+            # Start a new bucket, overwriting the oldest one when the buffer is full
+            position = (position + 1) % self.size
+            self.current = position
+            if self.count < self.size:
+                self.count += 1
+            self.starts[position] = start
+            self.counts[position] = 1
+            self.temperature_min[position] = temperature
+            self.temperature_max[position] = temperature
+            self.temperature_sum[position] = temperature
+            self.humidity_min[position] = humidity
+            self.humidity_max[position] = humidity
+            self.humidity_sum[position] = humidity
+            return
+
+        self.counts[position] += 1
+        self.temperature_sum[position] += temperature
+        self.humidity_sum[position] += humidity
+        if temperature < self.temperature_min[position]:
+            self.temperature_min[position] = temperature
+        elif temperature > self.temperature_max[position]:
+            self.temperature_max[position] = temperature
+        if humidity < self.humidity_min[position]:
+            self.humidity_min[position] = humidity
+        elif humidity > self.humidity_max[position]:
+            self.humidity_max[position] = humidity
+
+    def chunks(self, limit):
+        """
+        Generate the most recent buckets, oldest first, as encoded JSON chunks.
+
+        Args:
+            limit (int): Maximum number of buckets sent.
+
+        Yields:
+            bytes: Consecutive parts of the JSON document with the buckets.
+        """
+        count = min(self.count, limit)
+        oldest = self.current - count + 1
+
+        yield ('{"resolution": ' + str(self.resolution) + ', "fields": ["start", "samples", "temperature_min", '
+               + '"temperature_max", "temperature_mean", "humidity_min", "humidity_max", "humidity_mean"], "buckets": [').encode()
+        for index in range(count):
+            position = (oldest + index) % self.size
+            samples = self.counts[position]
+            bucket = "[" + str(self.starts[position]) + ", " + str(samples) \
+                + ", " + format_tenths(self.temperature_min[position]) + ", " + format_tenths(self.temperature_max[position]) \
+                + ", " + format_tenths(round(self.temperature_sum[position] / samples)) \
+                + ", " + format_tenths(self.humidity_min[position]) + ", " + format_tenths(self.humidity_max[position]) \
+                + ", " + format_tenths(round(self.humidity_sum[position] / samples)) + "]"
+            if index > 0:
+                bucket = ", " + bucket
+            yield bucket.encode()
+        yield b"]}"
+
+
+# History of the readings, served by the 'history' endpoint
+history = History(HISTORY_SIZE)
+
+# Aggregates of the readings by resolution, served by the 'stats' endpoint
+rollups = {}
+for resolution, size in ROLLUPS:
+    rollups[resolution] = Rollup(resolution, size)
+
+
+async def sample_dht():
+    """
+    Task that reads the DHT11 sensor periodically, so requests never wait for it,
+    and records the readings in the history and the aggregates.
+    """
+    last_sample = None
+    while True:
+        if read_dht():
+            timestamp = int(time())
+            now = ticks_ms()
+            if last_sample is None or ticks_diff(now, last_sample) >= HISTORY_INTERVAL * 1000:
+                history.append(timestamp, state.temperature, state.humidity)
+                last_sample = now
+
+            # Every reading updates the aggregates of every resolution
+            temperature = round(state.temperature * 10)
+            humidity = round(state.humidity * 10)
+            for rollup in rollups.values():
+                rollup.add(timestamp, temperature, humidity)
+        await asyncio.sleep(DHT_INTERVAL)
+
+
+def check_metrics(method):
+    """
+    Handles the 'metrics' endpoint, which returns the counters of the web server.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+
+    Returns:
+        status_code (int): The HTTP status code (200 or 405).
+        data_send (bool): Whether data should be sent in the response.
+        data (bytes): The metrics in the Prometheus text format.
+    """
+    if method == 'GET':
+        data_send = True
+        data = metrics.text()
+        status_code = 200 # OK status
+    else:
+        status_code = 405 # Method Not Allowed (only GET is allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
+
+
+def check_dht(method, if_none_match):
+    """
+    Handles the 'check_dht' endpoint, which returns the last temperature and humidity read from the DHT11 sensor.
 
     Args:
         method (str): The HTTP method (only accepts 'GET').
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
 
     Returns:
-        status_code (int): The HTTP status code (200, 405, 500).
+        status_code (int): The HTTP status code (200, 304, 405, 500).
         data_send (bool): Flag indicating whether to send the sensor data in the response.
-        data (str): The JSON-formatted string containing temperature and humidity data, if successful.
+        data (bytes): The JSON-formatted temperature and humidity data, the age of the
+                      reading in ms and the number of failed readings, if available.
     """
     if method == 'GET':
-        try:
-            # Format the temperature and humidity data into a JSON string
-            data = '{"temperature": ' + str(dht_sensor.temperature) + ', "humidity": ' + str(dht_sensor.humidity) + '}'
+        if not_modified(if_none_match):
+            data_send = False
+            data = None
+            status_code = 304 # Not Modified, the client already has the current reading
+        elif state.timestamp is not None:
+            # Complete the cached JSON of the reading with its age and the failed readings
+            data = state.json()[:-1] + (', "age_ms": ' + str(ticks_diff(ticks_ms(), state.timestamp)) \
+                + ', "errors": ' + str(state.errors) + '}').encode()
             data_send = True
             status_code = 200 # OK status
-        except Exception as e:
-            print(e) # Print error message if the sensor reading fails
+        else:
             data_send = False
-            status_code = 500 # Internal Server Error if the sensor fails
+            status_code = 500 # Internal Server Error if the sensor was never read
             data = None
     else:
         status_code = 405 # Method not allowed (only GET allowed)
@@ -134,47 +734,657 @@ def check_dht(method):
     return status_code, data_send, data
         
 
-def serve(connection):
+def check_history(method, parameters):
     """
-    Start a web server to handle client requests for obtaining the status of the sensor.
+    Handles the 'history' endpoint, which streams the stored temperature and humidity samples.
 
     Args:
-        connection (socket): The socket connection to handle.
+        method (str): The HTTP method (only accepts 'GET').
+        parameters (str): The optional parameters 'since' (time in seconds of the oldest
+                          sample) and 'limit' (maximum number of samples).
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, 405, 503).
+        data_send (bool): Flag indicating whether to send the samples in the response.
+        data (generator): The generator of the JSON chunks with the samples, if successful.
+    """
+    if method == 'GET':
+        try:
+            since = 0
+            limit = HISTORY_SIZE
+            if parameters != None:
+                for parameter in parameters.split("&"):
+                    key, value = parameter.split("=")
+                    if key == "since":
+                        since = int(value)
+                    elif key == "limit":
+                        limit = int(value)
+            if since >= 0 and limit >= 0:
+                data = history.chunks(since, limit)
+                data_send = True
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad request for invalid values
+                data_send = False
+                data = None
+        except:
+            status_code = 400 # Bad request if an error occurs
+            data_send = False
+            data = None
+    else:
+        status_code = 405 # Method not allowed (only GET allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
+
+
+def check_stats(method, parameters):
+    """
+    Handles the 'stats' endpoint, which returns the aggregates of temperature and humidity.
+
+    Args:
+        method (str): The HTTP method (only accepts 'GET').
+        parameters (str): The parameter 'resolution' (length in seconds of the buckets, one
+                          of the configured ones) and the optional 'limit' (maximum number of buckets).
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, 405, 503).
+        data_send (bool): Flag indicating whether to send the aggregates in the response.
+        data (generator): The generator of the JSON chunks with the buckets, if successful.
+    """
+    if method == 'GET':
+        try:
+            resolution = None
+            limit = None
+            for parameter in parameters.split("&"):
+                key, value = parameter.split("=")
+                if key == "resolution":
+                    resolution = int(value)
+                elif key == "limit":
+                    limit = int(value)
+            if resolution in rollups and (limit is None or limit >= 0):
+                rollup = rollups[resolution]
+                data = rollup.chunks(rollup.size if limit is None else limit)
+                data_send = True
+                status_code = 200 # OK status
+            else:
+                status_code = 400 # Bad request for invalid values
+                data_send = False
+                data = None
+        except:
+            status_code = 400 # Bad request if an error occurs
+            data_send = False
+            data = None
+    else:
+        status_code = 405 # Method not allowed (only GET allowed)
+        data_send = False
+        data = None
+
+    return status_code, data_send, data
+
+
+class Subscriber:
+    """
+    Bounded queue of the state change events waiting to be sent to a client.
+    """
+
+    def __init__(self, size):
+        """
+        Args:
+            size (int): Maximum number of pending events, the oldest ones are dropped.
+        """
+        self.size = size
+        self.queue = []
+        self.event = asyncio.Event()
+
+    def put(self, event):
+        """
+        Queue an event, dropping the oldest one if the client is too slow.
+
+        Args:
+            event (bytes): The encoded event.
+        """
+        if len(self.queue) >= self.size:
+            self.queue.pop(0)
+        self.queue.append(event)
+        self.event.set()
+
+    async def get(self, timeout):
+        """
+        Wait for the next event.
+
+        Args:
+            timeout (int): Maximum seconds to wait.
+
+        Returns:
+            bytes: The encoded event, or None if none arrived in time.
+        """
+        if not self.queue:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self.queue.pop(0)
+
+
+def notify_change():
+    """
+    Send the state to the subscribers as an event if it changed since the last one.
+    """
+    global last_version
+    if state.version != last_version:
+        last_version = state.version
+        event = b"data: " + state.json() + b"\n\n" # Encoded once for every subscriber
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+
+async def wait_for_change(parameters):
+    """
+    Hold a long-poll request until the state changes or its 'wait' time passes.
+
+    Args:
+        parameters (str): The request parameters, the seconds to wait are in 'wait'.
+    """
+    wait = 0
+    try:
+        for parameter in parameters.split("&"):
+            key, value = parameter.split("=")
+            if key == "wait":
+                wait = min(int(value), LONG_POLL_MAX)
+    except:
+        return # Invalid parameters are left to the handler
+    if wait <= 0 or len(subscribers) >= MAX_SUBSCRIBERS:
+        return
+
+    subscriber = Subscriber(1)
+    subscribers.append(subscriber)
+    try:
+        await subscriber.get(wait)
+    finally:
+        subscribers.remove(subscriber)
+
+
+async def stream_events(writer):
+    """
+    Stream the state changes to the client as Server-Sent Events until it disconnects.
+
+    Args:
+        writer (StreamWriter): The stream to send the events to.
+    """
+    subscriber = Subscriber(EVENT_QUEUE_SIZE)
+    subscribers.append(subscriber)
+    try:
+        writer.write(EVENTS_HEAD)
+        writer.write(b"data: " + state.json() + b"\n\n") # Start with the current state
+        await writer.drain()
+        while True:
+            event = await subscriber.get(EVENTS_PING)
+            if event is None:
+                writer.write(b": ping\n\n")
+            else:
+                writer.write(event)
+            await writer.drain()
+    finally:
+        subscribers.remove(subscriber)
+
+
+# Clients waiting for state changes and the version of the last state sent to them
+subscribers = []
+last_version = -1
+
+
+def dispatch(method, endpoint, parameters, if_none_match):
+    """
+    Run the handler of an endpoint.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply
+               or a generator of encoded chunks for the replies that are streamed.
     """
     data_send = False
+    data = None
+    content_type = CONTENT_TEXT
+    etag = None
+
+    if endpoint == 'check_dht':
+        status_code, data_send, data = check_dht(method, if_none_match)
+        content_type = CONTENT_JSON
+        if status_code == 200 or status_code == 304:
+            etag = state.etag()
+
+    elif endpoint == 'history':
+        status_code, data_send, data = check_history(method, parameters)
+        content_type = CONTENT_JSON
+
+    elif endpoint == 'stats':
+        status_code, data_send, data = check_stats(method, parameters)
+        content_type = CONTENT_JSON
+
+    elif endpoint == 'metrics':
+        status_code, data_send, data = check_metrics(method)
+
+    else:
+        status_code = 400 # Bad request for invalid endpoints
+
+    if data_send == False:
+        data = b""
+    elif isinstance(data, str):
+        data = data.encode()
+
+    return status_code, content_type, data, etag
+
+
+def run_batch(method, body):
+    """
+    Runs a list of operations one after the other and gathers their replies, so a client can
+    read several values in one request. Nothing else runs meanwhile, the sensor is read on the
+    same event loop so no reading lands between two operations.
+
+    Args:
+        method (str): The HTTP method (only accepts 'POST').
+        body (memoryview): JSON list of the operations, each one an object with the endpoint
+                           ('op'), and optionally its parameters ('params', a query string or
+                           an object) and its HTTP method ('method', 'POST' by default).
+
+    Returns:
+        status_code (int): The HTTP status code (200, 400, or 405).
+        data (bytes): JSON list with the status code of every operation and its reply if any.
+    """
+    if method != 'POST':
+        return 405, b"" # Method Not Allowed (only POST is allowed)
+
+    # Check the whole list before running anything, so a malformed batch changes nothing
+    try:
+        operations = []
+        for operation in json.loads(bytes(body)):
+            parameters = operation.get("params", "")
+            if isinstance(parameters, dict):
+                parameters = "&".join([key + "=" + str(value) for key, value in parameters.items()])
+            operations.append((operation.get("method", "POST"), operation["op"], parameters))
+    except:
+        return 400, b"" # Bad Request
+    if len(operations) == 0 or len(operations) > MAX_BATCH:
+        return 400, b"" # Bad Request
+
+    results = []
+    for method, endpoint, parameters in operations:
+        if endpoint == 'batch' or endpoint == 'history' or endpoint == 'stats':
+            status_code = 400 # Bad Request, batches can not be nested nor streamed replies gathered
+            content_type = CONTENT_TEXT
+            data = b""
+        else:
+            status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None)
+        result = b'{"op": ' + json.dumps(endpoint).encode() + b', "status": ' + str(status_code).encode()
+        if content_type == CONTENT_JSON and len(data) > 0:
+            result += b', "data": ' + data
+        results.append(result + b"}")
+
+    return 200, b"[" + b", ".join(results) + b"]"
+
+
+def route_request(method, endpoint, parameters, body, if_none_match):
+    """
+    Route the request to the appropriate handler based on the endpoint.
+
+    Args:
+        method (str): The HTTP method used.
+        endpoint (str): The requested endpoint.
+        parameters (str): The request parameters.
+        body (memoryview): The body of the request.
+        if_none_match (bytes): The value of the If-None-Match header of the request, or None.
+
+    Returns:
+        tuple: (status_code, content_type, data, etag) where status_code is HTTP status,
+               content_type is the type of the data, etag is the tag of the state sent
+               with the status replies (None for the rest), and data is the encoded reply
+               or a generator of encoded chunks for the replies that are streamed.
+    """
+    started = ticks_us()
+    if endpoint == 'batch':
+        status_code, data = run_batch(method, body) # Runs without yielding, so no reading lands in between
+        content_type = CONTENT_JSON
+        etag = None
+    else:
+        status_code, content_type, data, etag = dispatch(method, endpoint, parameters, if_none_match)
+    metrics.observe(PHASE_HANDLER, ticks_diff(ticks_us(), started))
+
+    return status_code, content_type, data, etag
+
+
+class Metrics:
+    """
+    Lightweight counters of the web server, served in the Prometheus text format by '/metrics'.
+    The time of every phase of the requests is counted in a histogram of fixed buckets, so
+    recording it only increases two numbers.
+    """
+    __slots__ = ("counts", "sums", "requests", "connections")
+
+    def __init__(self):
+        # Times counted in every bucket of every phase, the last bucket is above all the bounds
+        self.counts = [[0] * (len(METRICS_BUCKETS_US) + 1) for _ in PHASES]
+        self.sums = [0] * len(PHASES) # Total time in us of every phase
+        self.requests = {} # Requests answered for every pair of endpoint and status code
+        self.connections = 0 # Connections accepted
+
+    def observe(self, phase, us):
+        """
+        Count the time taken by a phase of a request.
+
+        Args:
+            phase (int): The index of the phase in PHASES.
+            us (int): The time taken in us.
+        """
+        index = 0
+        for bound in METRICS_BUCKETS_US:
+            if us <= bound:
+                break
+            index += 1
+        self.counts[phase][index] += 1
+        self.sums[phase] += us
+
+    def count(self, endpoint, status_code):
+        """
+        Count a request answered.
+
+        Args:
+            endpoint (str): The requested endpoint, None if the request was malformed.
+            status_code (int): The HTTP status code of the reply.
+        """
+        key = (endpoint or "", status_code)
+        if key not in self.requests and len(self.requests) >= METRICS_MAX_SERIES:
+            key = ("other", status_code) # Endpoints sent by the clients could fill the memory
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def text(self):
+        """
+        Format the metrics in the Prometheus text format.
+
+        Returns:
+            bytes: One line for every value, with the histograms in us.
+        """
+        lines = ["# HELP request_phase_us Time spent in every phase of the requests in us",
+                 "# TYPE request_phase_us histogram"]
+        for phase in range(len(PHASES)):
+            label = 'request_phase_us_bucket{phase="' + PHASES[phase] + '",le="'
+            counts = self.counts[phase]
+            total = 0
+            for index in range(len(METRICS_BUCKETS_US)):
+                total += counts[index]
+                lines.append(label + str(METRICS_BUCKETS_US[index]) + '"} ' + str(total))
+            total += counts[-1]
+            lines.append(label + '+Inf"} ' + str(total))
+            lines.append('request_phase_us_sum{phase="' + PHASES[phase] + '"} ' + str(self.sums[phase]))
+            lines.append('request_phase_us_count{phase="' + PHASES[phase] + '"} ' + str(total))
+
+        lines.append("# HELP requests_total Requests answered by endpoint and status code")
+        lines.append("# TYPE requests_total counter")
+        for key, value in self.requests.items():
+            endpoint = key[0].replace("\\", "\\\\").replace('"', '\\"') # Escaped for the label
+            lines.append('requests_total{endpoint="' + endpoint + '",status="' + str(key[1]) + '"} ' + str(value))
+
+        lines.append("# HELP connections_total Connections accepted")
+        lines.append("# TYPE connections_total counter")
+        lines.append("connections_total " + str(self.connections))
+        lines.append("# HELP memory_free_bytes Free memory of the heap")
+        lines.append("# TYPE memory_free_bytes gauge")
+        lines.append("memory_free_bytes " + str(gc.mem_free()))
+        lines.append("# HELP memory_allocated_bytes Allocated memory of the heap")
+        lines.append("# TYPE memory_allocated_bytes gauge")
+        lines.append("memory_allocated_bytes " + str(gc.mem_alloc()))
+        lines.append("# HELP uptime_seconds Time since the boot")
+        lines.append("# TYPE uptime_seconds gauge")
+        lines.append("uptime_seconds " + str(time() - BOOT_TIME))
+        return ("\n".join(lines) + "\n").encode()
+
+
+metrics = Metrics() # Counters of the web server
+
+
+async def receive_into(reader, view):
+    """
+    Receive data from the client directly into a preallocated buffer.
+
+    Args:
+        reader (StreamReader): The stream to receive the data from.
+        view (memoryview): The free part of the receive buffer.
+
+    Returns:
+        int: The number of bytes received, 0 if the connection was closed.
+    """
+    if hasattr(reader, "readinto"):
+        return await reader.readinto(view)
+    chunk = await reader.read(len(view)) # CPython streams have no readinto()
+    view[:len(chunk)] = chunk
+    return len(chunk)
+
+
+async def handle_client(reader, writer):
+    """
+    Handle a persistent client connection, answering pipelined requests in order.
+
+    Args:
+        reader (StreamReader): The stream to receive the requests from.
+        writer (StreamWriter): The stream to send the replies to.
+    """
+    # Requests are received into a preallocated buffer and parsed in place
+    buffer = buffer_pool.pop() if buffer_pool else bytearray(MAX_REQUEST_SIZE)
+    view = memoryview(buffer)
+    start = 0 # Position of the next request in the buffer
+    end = 0 # Position where the received data ends
+    served = 0
+    keep_alive = True
+    metrics.connections += 1
+    try:
+        while keep_alive:
+            parsing = ticks_us()
+            try:
+                request = parse_request(buffer, start, end)
+            except ValueError as e:
+                print(e) # Malformed request, reply and close the connection
+                request = (None, None, None, None, end - start, False, None)
+
+            if request is None:
+                # Move the partial request to the front of the buffer and receive the rest
+                if start > 0:
+                    view[:end - start] = view[start:end]
+                    end -= start
+                    start = 0
+                timeout = READ_TIMEOUT if end else KEEPALIVE_TIMEOUT
+                waiting = ticks_us()
+                received = await asyncio.wait_for(receive_into(reader, view[end:]), timeout)
+                if not received:
+                    return # Connection closed by the client
+                if end:
+                    metrics.observe(PHASE_RECEIVE, ticks_diff(ticks_us(), waiting)) # Not the idle time between requests
+                end += received
+                continue
+
+            metrics.observe(PHASE_PARSE, ticks_diff(ticks_us(), parsing))
+
+            method, endpoint, parameters, body, size, keep_alive, if_none_match = request
+            start += size
+            if start == end:
+                start = end = 0
+            served += 1
+            if served >= MAX_REQUESTS:
+                keep_alive = False
+            print(method, endpoint, parameters)
+
+            if endpoint == 'events':
+                # Server-Sent Events keep the connection until the client leaves
+                if method != 'GET':
+                    status_code, content_type, data, etag = 405, CONTENT_TEXT, b"", None
+                elif len(subscribers) >= MAX_SUBSCRIBERS:
+                    status_code, content_type, data, etag = 503, CONTENT_TEXT, b"", None
+                else:
+                    metrics.count(endpoint, 200)
+                    await stream_events(writer)
+                    break
+            else:
+                # Long-poll requests ('wait' parameter) are answered on the next change
+                if endpoint == 'check_dht' and parameters != None:
+                    await wait_for_change(parameters)
+                status_code, content_type, data, etag = route_request(method, endpoint, parameters, body, if_none_match)
+
+            metrics.count(endpoint, status_code)
+
+            # Send HTTP status code and data in a single write, or stream it in chunks
+            sending = ticks_us()
+            if isinstance(data, bytes):
+                writer.write(build_response(status_code, content_type, data, keep_alive, etag))
+            else:
+                await send_chunked(writer, content_type, data, keep_alive)
+
+            # Replies to pipelined requests are flushed together
+            if not keep_alive or find_head_end(buffer, start, end) < 0:
+                await writer.drain()
+            metrics.observe(PHASE_SEND, ticks_diff(ticks_us(), sending))
+    except Exception as e:
+        print(e) # Timed out or connection lost
+    finally:
+        if len(buffer_pool) < BACKLOG:
+            buffer_pool.append(buffer) # Keep the buffer for the next connection
+        writer.close() # Close the client connection
+        await writer.wait_closed()
+
+
+def run_opcode(opcode, payload):
+    """
+    Run the handler of a binary control message, as an HTTP request to the same endpoint would.
+
+    Args:
+        opcode (int): The operation, a key of UDP_OPCODES.
+        payload (memoryview): The values of the operation, packed as its layout tells.
+
+    Returns:
+        status_code (int): The HTTP status code of the handler (400 for unknown or malformed messages).
+        data (bytes): The JSON reply of the handler, empty if it has none.
+    """
+    if opcode not in UDP_OPCODES:
+        return 400, b"" # Bad Request for unknown opcodes
+    method, endpoint, layout, template = UDP_OPCODES[opcode]
+    try:
+        parameters = template % struct.unpack(layout, payload)
+    except:
+        return 400, b"" # Bad Request, the payload does not fit the layout
+
+    status_code, content_type, data, etag = dispatch(method, endpoint, parameters, None)
+    return status_code, data
+
+
+async def serve_udp(ip):
+    """
+    Serve the binary control messages received on the UDP port, polling the socket between the
+    other tasks. A message holds the opcode (1 byte), a sequence number (2 bytes, big-endian, one
+    more for every message of the client) and the payload. Messages older than the last one of the
+    same client are dropped, and the rest are answered with the opcode, the sequence number, the
+    HTTP status code (2 bytes, big-endian) and the JSON reply if any.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(socket.getaddrinfo(ip, UDP_PORT)[0][-1])
+    sock.setblocking(False)
+    sequences = {} # Last sequence number received from every client
+
+    while True:
+        try:
+            packet, address = sock.recvfrom(UDP_MAX_SIZE)
+        except OSError:
+            await asyncio.sleep_ms(UDP_POLL_MS) # Nothing received
+            continue
+        if len(packet) < 3:
+            continue # Too short to be a message
+
+        # Drop the messages overtaken by a newer one, a client starts again from 0 after a restart
+        opcode = packet[0]
+        sequence = packet[1] << 8 | packet[2]
+        last = sequences.get(address)
+        if last is not None and sequence != 0 and not 0 < (sequence - last) & 0xFFFF < 0x8000:
+            continue
+        if last is None and len(sequences) >= UDP_MAX_CLIENTS:
+            sequences.clear() # Forget the clients gone quiet
+        sequences[address] = sequence
+
+        status_code, data = run_opcode(opcode, memoryview(packet)[3:])
+        try:
+            sock.sendto(struct.pack(">BHH", opcode, sequence, status_code) + data, address)
+        except OSError:
+            pass # The reply is lost like any datagram, the next message carries the new state anyway
+        await asyncio.sleep_ms(0) # Let the other tasks run between two messages
+
+
+async def run_mqtt():
+    """
+    Keep a session with the MQTT broker and publish the readings retained on '<MQTT_TOPIC>/state'
+    every time they change, reconnecting with an increasing backoff when the broker is lost. The
+    retained '<MQTT_TOPIC>/online' topic tells whether the device is connected.
+    """
+    backoff = MQTT_BACKOFF_MIN
     while True:
-        client = connection.accept()[0] # Accept a client connection
-        request = client.recv(1024) # Receive the request
-        request = str(request)
-        print(request)
+        client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, keepalive=MQTT_KEEPALIVE)
         try:
-            method, endpoint, parameters = request_data_extractor(request) # Extract request details
+            client.set_last_will(MQTT_TOPIC + b"/online", b"0", True)
+            client.connect()
+            client.publish(MQTT_TOPIC + b"/online", b"1", True)
+            backoff = MQTT_BACKOFF_MIN
+            published = -1 # Version of the state last published
+            last_sent = ticks_ms()
+
+            while True:
+                if state.version != published and state.timestamp is not None: # Once the sensor was read
+                    published = state.version
+                    client.publish(MQTT_TOPIC + b"/state", state.json(), True, MQTT_QOS)
+                    last_sent = ticks_ms()
+                elif ticks_diff(ticks_ms(), last_sent) >= MQTT_KEEPALIVE * 500:
+                    client.ping() # Keep the session alive while the state does not change
+                    last_sent = ticks_ms()
+                await asyncio.sleep_ms(MQTT_POLL_MS)
+        except OSError as error:
+            print("MQTT broker lost:", error)
+
+        try:
+            client.sock.close()
         except:
-            endpoint = None    
-        
-        # Route the request to the appropriate handler based on the endpoint
-        if endpoint == 'check_dht':
-            status_code, data_send, data = check_dht(method)
+            pass # The connection never opened
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MQTT_BACKOFF_MAX)
 
-        else:
-            status_code = 400 # Bad request for invalid endpoints
 
-        # Send HTTP response status
-        client.send(status_code_set(status_code))
-        
-        # Send data if needed
-        if data_send == True:
-            client.send(data)
-            data_send = False
-        
-        client.close()  
+async def serve(ip):
+    """
+    Start the sampling of the sensor and a web server that handles client requests for obtaining its status concurrently.
+
+    Args:
+        ip (str): The IP address of the device.
+    """
+    asyncio.create_task(sample_dht()) # Read the sensor in the background
+    if UDP_ENABLED:
+        asyncio.create_task(serve_udp(ip)) # Serve the binary control messages
+    if MQTT_ENABLED and MQTTClient is not None:
+        asyncio.create_task(run_mqtt()) # Publish the state and receive the commands through the broker
+    await asyncio.start_server(handle_client, ip, PORT, backlog=BACKLOG)
+    while True:
+        await asyncio.sleep(3600) # Keep serving forever
 
 
 # Main code execution
 try:
     ip = connect() # Connect to the WLAN and get IP address
-    connection = open_socket(ip) # Open socket for communication
-    serve(connection) # Start serving requests
+    asyncio.run(serve(ip)) # Start serving requests
 except KeyboardInterrupt:
     machine.reset() # Reset the device if interrupted
 